@@ -25,11 +25,10 @@ TODO
     * support for state of revision (active, deleted (spam), in-progress etc)
 
 2. Support for composite primary keys.
-
-4. Support for m2m collections other than lists.
 '''
 from base import *
 from tools import Repository
+from timetravel import RevisionView
 
 __all__ = [
         'set_revision', 'get_revision',
@@ -37,8 +36,10 @@ __all__ = [
         'make_table_stateful', 'make_table_revisioned',
         'make_State', 'make_Revision',
         'StatefulObjectMixin', 'RevisionedObjectMixin',
-        'Revisioner', 'modify_base_object_mapper', 'create_object_version',
+        'Revisioner', 'RevisionerSessionExtension', 'HistoryOutbox',
+        'modify_base_object_mapper', 'create_object_version',
         'add_stateful_versioned_m2m', 'add_stateful_versioned_m2m_on_version',
-        'Repository'
+        'Repository', 'RevisionView', 'HistoryCache', 'ChangeCounter',
+        'RevisionTimeline'
         ]
 
@@ -1,15 +1,33 @@
+from __future__ import with_statement
 from datetime import datetime
 import difflib
 import uuid
 import logging
+import threading
 import weakref
+from contextlib import contextmanager
 
 from sqlalchemy import *
 from sqlalchemy.orm.attributes import get_history, PASSIVE_OFF
+from sqlalchemy.orm.attributes import set_committed_value, instance_state
+try:
+    from sqlalchemy.orm.attributes import PASSIVE_NO_INITIALIZE
+except ImportError: # sqlalchemy 0.4
+    PASSIVE_NO_INITIALIZE = PASSIVE_OFF
 from sqlalchemy import __version__ as sqav
 
-from sqla import SQLAlchemyMixin
+from sqla import SQLAlchemyMixin, InsertFromSelect
 from sqla import copy_column, copy_table_columns, copy_table
+from outbox import HistoryOutbox
+from history_cache import HistoryCache
+from changes import ChangeCounter
+from group_commit import GroupCommit
+from temporal import add_interval_columns, has_intervals, as_of_clause
+from temporal import set_interval, close_intervals
+from temporal import add_timestamp_column, set_timestamp
+from temporal import add_sequence_column, add_revision_seq_column
+from temporal import set_revision_seq, revision_order, revision_key
+from temporal import set_revision_columns
 
 make_uuid = lambda: unicode(uuid.uuid4())
 logger = logging.getLogger('vdm')
@@ -17,38 +35,53 @@ logger = logging.getLogger('vdm')
 ## -------------------------------------
 class SQLAlchemySession(object):
     '''Handle setting/getting attributes on the SQLAlchemy session.
+
+    Attributes (revision, HEAD etc) are always held on the actual session
+    object. If given a ScopedSession (Session class in threadlocal case) they
+    are set on/got from the current thread's session, never on the
+    ScopedSession itself (as that is shared between threads).
     
     TODO: update all methods so they can take an object as well as session
     object.
     '''
 
     @classmethod
-    def setattr(self, session, attr, value):
-        setattr(session, attr, value)
-        # check if we are being given the Session class (threadlocal case)
-        # if so set on both class and instance
-        # this is important because sqlalchemy's object_session (used below) seems
-        # to return a Session() not Session
+    def session(self, session):
+        '''Get the actual session for `session` (which may be a
+        ScopedSession).'''
         if isinstance(session, sqlalchemy.orm.scoping.ScopedSession):
-            sess = session()
-            setattr(sess, attr, value)
+            return session()
+        return session
+
+    @classmethod
+    def setattr(self, session, attr, value):
+        setattr(self.session(session), attr, value)
 
     @classmethod
-    def getattr(self, session, attr):
-        return getattr(session, attr)
+    def getattr(self, session, attr, *default):
+        return getattr(self.session(session), attr, *default)
 
     # make explicit to avoid errors from typos (no attribute defns in python!)
     @classmethod
-    def set_revision(self, session, revision):
+    def set_revision(self, session, revision, defer_flush=False):
+        '''Set revision on the session.
+
+        @param defer_flush: if True do not flush a new revision straight away
+            but leave it to be inserted in the same flush as the first objects
+            that reference it (saving a flush and a round trip).
+        '''
         self.setattr(session, 'HEAD', True)
         self.setattr(session, 'revision', revision)
         if revision.id is None:
             # make uuid here so that if other objects in this session are flushed
             # at the same time they know thier revision id
             revision.id = make_uuid()
+            # brand new so no object versions written for it yet
+            revision.written_versions = set()
             # there was a begin_nested here but that just caused flush anyway.
             session.add(revision)
-            session.flush()
+            if not defer_flush:
+                session.flush()
 
     @classmethod
     def get_revision(self, session):
@@ -56,7 +89,7 @@ class SQLAlchemySession(object):
         
         NB: will return None if not set
         '''
-        return getattr(session, 'revision', None)
+        return self.getattr(session, 'revision', None)
 
     @classmethod
     def set_not_at_HEAD(self, session):
@@ -64,7 +97,50 @@ class SQLAlchemySession(object):
 
     @classmethod
     def at_HEAD(self, session):
-        return getattr(session, 'HEAD', True)
+        return self.getattr(session, 'HEAD', True)
+
+    @classmethod
+    def get_view(self, session):
+        '''Get the RevisionView (see timetravel.py) `session` is pinned to
+        (None if none).'''
+        view = self.getattr(session, 'revision_view', None)
+        if view is not None and view.pinned(session):
+            return view
+        return None
+
+    @classmethod
+    def as_of_cache(self, session):
+        '''Get the AsOfCache of `session` (created if need be).'''
+        cache = self.getattr(session, 'as_of_cache', None)
+        if cache is None:
+            cache = AsOfCache()
+            self.setattr(session, 'as_of_cache', cache)
+        return cache
+
+    @classmethod
+    def clear_as_of_cache(self, session):
+        cache = self.getattr(session, 'as_of_cache', None)
+        if cache is not None:
+            cache.clear()
+
+    @classmethod
+    @contextmanager
+    def using_revision(self, session, revision, defer_flush=False):
+        '''Context manager setting `revision` on the session for the duration
+        of the block (restoring the previous revision and HEAD afterwards)::
+
+            with SQLAlchemySession.using_revision(Session, rev):
+                ...
+        '''
+        sess = self.session(session)
+        previous = (self.getattr(sess, 'revision', None),
+                self.at_HEAD(sess))
+        self.set_revision(sess, revision, defer_flush=defer_flush)
+        try:
+            yield revision
+        finally:
+            self.setattr(sess, 'revision', previous[0])
+            self.setattr(sess, 'HEAD', previous[1])
 
 
 ## --------------------------------------------------------
@@ -77,7 +153,12 @@ class State(object):
     PENDING = u'pending'
     all = (ACTIVE, DELETED, PENDING)
 
-def make_revision_table(metadata):
+def make_revision_table(metadata, sequence=False):
+    '''
+    @param sequence: add a seq column numbering the revisions in the order
+        they are created (see temporal.py). Revisions are then ordered by it
+        rather than by timestamp.
+    '''
     revision_table = Table('revision', metadata,
             Column('id', UnicodeText, primary_key=True, default=make_uuid),
             Column('timestamp', DateTime, default=datetime.utcnow),
@@ -85,6 +166,8 @@ def make_revision_table(metadata):
             Column('message', UnicodeText),
             Column('state', UnicodeText, default=State.ACTIVE)
             )
+    if sequence:
+        add_sequence_column(revision_table)
     return revision_table
 
 
@@ -96,6 +179,12 @@ class Revision(SQLAlchemyMixin):
     '''
     # TODO:? set timestamp in ctor ... (maybe not as good to have undefined
     # until actual save ...)
+
+    # Record of the object versions written for this revision as a set of
+    # (revision table name, continuity id). None if unknown (e.g. revision
+    # loaded from the db) in which case the db has to be checked.
+    written_versions = None
+
     @property
     def __id__(self):
         if self.id is None:
@@ -107,16 +196,44 @@ class Revision(SQLAlchemyMixin):
 
         If session is not provided assume there is a contextual session.
         '''
+        timeline = self.timeline(session)
+        if timeline is not None:
+            id = timeline.youngest()
+            return id and session.query(self).get(id)
         q = session.query(self)
         return q.first()
 
+    @classmethod
+    def at(self, session, when):
+        '''Get the active revision current at (naive UTC) datetime `when`,
+        i.e. the youngest made no later (None if none).'''
+        timeline = self.timeline(session)
+        if timeline is not None:
+            id = timeline.at(when)
+            return id and session.query(self).get(id)
+        return session.query(self).filter_by(state=State.ACTIVE).\
+                filter(self.timestamp <= when).first()
+
+    @classmethod
+    def timeline(self, session):
+        '''Get the RevisionTimeline (see timeline.py) to look revisions up
+        in for `session` (None if there is none or the session has new
+        revisions it does not have yet).'''
+        timeline = RevisionTimeline.for_table(class_mapper(self).mapped_table)
+        if timeline is None or \
+                timeline.pending(SQLAlchemySession.session(session)):
+            return None
+        return timeline
+
 
 def make_Revision(mapper, revision_table):
     mapper(Revision, revision_table, properties={
         },
-        order_by=revision_table.c.timestamp.desc())
+        order_by=revision_table.c[revision_key(revision_table)].desc())
     return Revision
 
+from timeline import RevisionTimeline
+
 ## --------------------------------------------------------
 ## Table Helpers
 
@@ -130,12 +247,21 @@ def make_table_revisioned(base_table):
     logger.warn('make_table_revisioned is deprecated: use make_revisioned_table')
     return make_revisioned_table(base_table)
 
-def make_revisioned_table(base_table):
+def make_revisioned_table(base_table, intervals=False, timestamps=False,
+        sequence=False):
     '''Modify base_table and create correponding revision table.
 
     # TODO: (complex) support for complex primary keys on continuity. 
     # Search for "composite foreign key sqlalchemy" for helpful info
 
+    @param intervals: add valid_from/valid_to columns giving the period
+        each object revision was current for (see temporal.py).
+    @param timestamps: add a revision_timestamp column holding the timestamp
+        of each object revision's revision (see temporal.py). Not needed with
+        intervals (valid_from is the same thing).
+    @param sequence: add a revision_seq column holding the seq of each object
+        revision's revision (the revision table must have been made with
+        sequence too).
     @return revision table.
     '''
     base_table.append_column(
@@ -171,6 +297,12 @@ def make_revisioned_table(base_table):
         if col.name == 'revision_id':
             col.primary_key = True
             newtable.primary_key.columns.add(col)
+    if intervals:
+        add_interval_columns(newtable)
+    elif timestamps:
+        add_timestamp_column(newtable)
+    if sequence:
+        add_revision_seq_column(newtable)
     return newtable
 
 
@@ -192,15 +324,112 @@ class StatefulObjectMixin(object):
         return self.state is None or self.state == State.ACTIVE
 
 
+class AsOfStats(object):
+    '''How get_as_of (and get_many_as_of) found object revisions (shared by
+    all threads):
+
+        * unchanged: built from the object itself as it had not changed since
+          the revision asked for
+        * cached: made from a HistoryCache snapshot
+        * queried: looked up in the object's history
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.unchanged = 0
+        self.cached = 0
+        self.queried = 0
+
+    def record(self, unchanged=0, cached=0, queried=0):
+        with self._lock:
+            self.unchanged += unchanged
+            self.cached += cached
+            self.queried += queried
+
+    def as_dict(self):
+        with self._lock:
+            total = self.unchanged + self.cached + self.queried
+            return {
+                'unchanged': self.unchanged,
+                'cached': self.cached,
+                'queried': self.queried,
+                'unchanged_ratio': self.unchanged / float(total or 1),
+                }
+
+
+class AsOfCache(object):
+    '''Results of get_as_of (and get_many_as_of) for one session keyed by
+    (revision class, id, revision id).
+
+    Everything is dropped when the session's revision changes, when it is
+    cleared (expunge_all/close) and after flushes and rollbacks.
+    '''
+    # returned by get when there is nothing cached (None is a valid result)
+    missing = object()
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.clear()
+
+    def clear(self):
+        self._results = {}
+        self._revision_id = None
+        self._identity_map = None
+
+    def _check(self, session):
+        session = SQLAlchemySession.session(session)
+        revision = SQLAlchemySession.get_revision(session)
+        revision_id = revision is not None and revision.id or None
+        if revision_id != self._revision_id or \
+                session.identity_map is not self._identity_map:
+            self.clear()
+            self._revision_id = revision_id
+            self._identity_map = session.identity_map
+
+    def get(self, session, key):
+        self._check(session)
+        result = self._results.get(key, self.missing)
+        if result is self.missing:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def put(self, session, key, result):
+        self._check(session)
+        self._results[key] = result
+
+    def __len__(self):
+        return len(self._results)
+
+    def as_dict(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self)}
+
+
 class RevisionedObjectMixin(object):
     __ignored_fields__ = ['revision_id']
     __revisioned__ = True
 
+    as_of_stats = AsOfStats()
+
+    # class:fields (mapped table and ignored fields are fixed once mapped)
+    _revisioned_fields_cache = {}
+
     @classmethod
     def revisioned_fields(cls):
-        table = sqlalchemy.orm.class_mapper(cls).mapped_table
-        fields = [ col.name for col in table.c if col.name not in
-                cls.__ignored_fields__ ]
+        return list(cls._revisioned_fields())
+
+    @classmethod
+    def _revisioned_fields(cls):
+        fields = cls._revisioned_fields_cache.get(cls)
+        if fields is None:
+            table = sqlalchemy.orm.class_mapper(cls).mapped_table
+            fields = tuple([ col.name for col in table.c if col.name not in
+                    cls.__ignored_fields__ ])
+            cls._revisioned_fields_cache[cls] = fields
         return fields
 
     def get_as_of(self, revision=None):
@@ -211,8 +440,21 @@ class RevisionedObjectMixin(object):
 
         get_as_of does most of the crucial work in supporting the
         versioning.
+
+        If this object has not changed since the revision (i.e. its own
+        revision is no later) its object revision is made from its loaded
+        values without querying the history (see `as_of_stats`). Results are
+        kept in the session's AsOfCache (see `SQLAlchemySession.as_of_cache`).
+
+        @param revision: Revision or (naive UTC) datetime meaning the
+            revision current then (see `Revision.at`).
         '''
         sess = object_session(self)
+        if isinstance(revision, datetime):
+            revision = Revision.at(sess, revision)
+            if revision is None:
+                # before the first revision
+                return None
         if revision: # set revision on the session so dom traversal works
             # TODO: should we test for overwriting current session?
             # if rev != revision:
@@ -229,27 +471,382 @@ class RevisionedObjectMixin(object):
         if SQLAlchemySession.at_HEAD(sess):
             return self
         else:
-            revision_class = self.__revision_class__
-            # TODO: when dealing with multi-col pks will need to update this
-            # (or just use continuity)
-            out = sess.query(revision_class).join('revision').\
-                filter(
-                    Revision.timestamp <= revision.timestamp
-                ).\
-                filter(
-                    revision_class.id == self.id
-                ).\
-                order_by(
-                    Revision.timestamp.desc()
-                )
-            return out.first()
+            view = SQLAlchemySession.get_view(sess)
+            if view is not None:
+                return view.get(self.__class__, self)
+            cache = SQLAlchemySession.as_of_cache(sess)
+            key = (self.__revision_class__, self.id, revision.id)
+            revobj = cache.get(sess, key)
+            if revobj is AsOfCache.missing:
+                revobj = self._get_as_of(sess, revision)
+                cache.put(sess, key, revobj)
+            return revobj
+
+    def _get_as_of(self, sess, revision):
+        revobj = self._unchanged_as_of(sess, revision)
+        if revobj is not None:
+            self.as_of_stats.record(unchanged=1)
+            return revobj
+        revision_table = class_mapper(self.__revision_class__).mapped_table
+        cache = HistoryCache.for_table(revision_table)
+        if cache is None or not cache.cacheable(sess):
+            return self._query_as_of(sess, revision)
+        snapshot = cache.get_as_of(revision_table, self.id, revision.id)
+        if snapshot is not cache.missing:
+            self.as_of_stats.record(cached=1)
+            if snapshot is None:
+                return None
+            return self._revision_instance(sess, snapshot.values())
+        generation = cache.generation
+        revobj = self._query_as_of(sess, revision)
+        if revobj is None or instance_state(revobj).key is not None:
+            # (not from the history outbox)
+            cache.put_as_of(revision_table, self.id, revision.id, revobj,
+                    generation)
+        return revobj
+
+    def _query_as_of(self, sess, revision):
+        self.as_of_stats.record(queried=1)
+        revision_class = self.__revision_class__
+        revision_table = class_mapper(revision_class).mapped_table
+        if has_intervals(revision_table):
+            out = sess.query(revision_class).filter(
+                    as_of_clause(revision_table, revision.timestamp)).\
+                filter(revision_class.continuity_id == self.id).\
+                order_by(None)
+            return self._latest_as_of(out.first(),
+                    self._pending_revisions(), revision)
+        out, order = self._history_query(sess)
+        column, key = order
+        out = out.filter(column <= getattr(revision, key))
+        return self._latest_as_of(out.first(), self._pending_revisions(),
+                revision)
+
+    def _unchanged_as_of(self, sess, revision):
+        '''Get the object revision of this object as of `revision` if that is
+        its current version (it has not changed since `revision`) from the
+        values already loaded in this object.
+
+        @return: object revision (from the session if already there, else a
+            new persistent instance) or None if this object has changed
+            since, has unflushed changes or values not loaded.
+        '''
+        state = instance_state(self)
+        if state.key is None or state.modified:
+            return None
+        table = class_mapper(self.__class__).mapped_table
+        if state.unloaded.intersection(table.c.keys()):
+            return None
+        if self.revision_id == revision.id:
+            last = revision
+        else:
+            key = revision_key(class_mapper(Revision).mapped_table)
+            last = sess.query(Revision).get(self.revision_id)
+            if last is None or getattr(last, key) is None or \
+                    getattr(revision, key) is None or \
+                    getattr(last, key) > getattr(revision, key):
+                return None
+        revision_table = class_mapper(self.__revision_class__).mapped_table
+        colvalues = dict([ (key, state.dict[key]) for key in table.c.keys() ])
+        colvalues['revision_id'] = last.id
+        colvalues['continuity_id'] = self.id
+        set_revision_columns(revision_table, colvalues, last)
+        return self._revision_instance(sess, colvalues, revision=last,
+                continuity=self)
+
+    @classmethod
+    def _revision_instance(cls, sess, colvalues, **related):
+        '''Get the object revision with column values `colvalues` from the
+        session or, if not there, make it (persistent, as if loaded from the
+        db) without a query.
+
+        @param related: values of relations (e.g. revision) if known.
+        '''
+        mapper = class_mapper(cls.__revision_class__)
+        identity = mapper.identity_key_from_primary_key(
+                [ colvalues[col.key] for col in mapper.primary_key ])
+        if identity in sess.identity_map:
+            return sess.identity_map[identity]
+        revobj = mapper.class_manager.new_instance()
+        for key, value in colvalues.items():
+            set_committed_value(revobj, key, value)
+        # without firing backrefs (which would change the continuity)
+        for key, value in related.items():
+            set_committed_value(revobj, key, value)
+        instance_state(revobj).key = identity
+        sess.add(revobj)
+        return revobj
+
+    @classmethod
+    def _revision_order(cls):
+        '''Get (column, key) to order object revisions of this class by
+        revision: the column (of the revision table if the object revision
+        table has no copy of seq or timestamp) and the Revision attribute
+        giving the corresponding value (see temporal.py).'''
+        column, key = revision_order(
+                class_mapper(cls.__revision_class__).mapped_table)
+        if column is None:
+            column = class_mapper(Revision).mapped_table.c[key]
+        return column, key
+
+    def _history_query(self, sess):
+        '''Get query for all object revisions of this object, youngest first,
+        and the (column, key) they are ordered by (see `_revision_order`).
+        '''
+        revision_class = self.__revision_class__
+        column, key = order = self._revision_order()
+        query = sess.query(revision_class)
+        if column.table is not class_mapper(revision_class).mapped_table:
+            query = query.join('revision')
+        # TODO: when dealing with multi-col pks will need to update this
+        # (or just use continuity)
+        query = query.filter(revision_class.continuity_id == self.id).\
+            order_by(column.desc())
+        return query, order
+
+    @classmethod
+    def _latest_as_of(self, revobj, pending, revision):
+        # most recent of the object revision from the db and those pending
+        # in the history outbox at `revision`
+        key = revision_key(class_mapper(Revision).mapped_table)
+        order = lambda revobj: getattr(revobj.revision, key)
+        pending = [ pending_revobj for pending_revobj in pending
+                if order(pending_revobj) <= getattr(revision, key) ]
+        if pending:
+            latest = max(pending, key=order)
+            if revobj is None or order(latest) >= order(revobj):
+                return latest
+        return revobj
+
+    @classmethod
+    def get_many_as_of(cls, objects, revision=None, session=None,
+            chunk_size=500):
+        '''Get many domain objects at the specified revision.
+
+        Like calling get_as_of on each object but the object revisions are
+        got with one query (per `chunk_size` objects) picking the latest
+        revision of each object at `revision` (greatest per group). As with
+        get_as_of, objects which have not changed since `revision` are not
+        looked up, nor are those in the session's AsOfCache (which is filled
+        with the results).
+
+        @param objects: continuity objects or their ids.
+        @param revision: as for get_as_of (i.e. defaults to the session's).
+        @param session: needed if only ids are given.
+        @return: dict of object revisions (None for objects which did not
+            exist at that revision) keyed by id. At HEAD this is the
+            continuity objects themselves.
+        '''
+        ids = []
+        continuities = []
+        for obj in objects:
+            if isinstance(obj, cls):
+                session = session or object_session(obj)
+                ids.append(obj.id)
+                continuities.append(obj)
+            else:
+                ids.append(obj)
+        if session is None:
+            raise ValueError('get_many_as_of needs a session to work with')
+        if revision:
+            SQLAlchemySession.set_revision(session, revision)
+            SQLAlchemySession.set_not_at_HEAD(session)
+        else:
+            revision = SQLAlchemySession.get_revision(session)
+
+        results = dict.fromkeys(ids)
+        if SQLAlchemySession.at_HEAD(session):
+            for start in range(0, len(ids), chunk_size):
+                chunk = ids[start:start+chunk_size]
+                for obj in session.query(cls).filter(cls.id.in_(chunk)):
+                    results[obj.id] = obj
+            return results
+
+        revision_class = cls.__revision_class__
+        cache = SQLAlchemySession.as_of_cache(session)
+        cached = {}
+        for id in ids:
+            revobj = cache.get(session, (revision_class, id, revision.id))
+            if revobj is not AsOfCache.missing:
+                cached[id] = revobj
+        results.update(cached)
+        ids = [ id for id in ids if id not in cached ]
+        continuities = [ obj for obj in continuities if obj.id not in cached ]
+        looked_up = ids
+
+        # load the revisions needed to check the objects in one go
+        rev_mapper = class_mapper(Revision)
+        revision_ids = set([ obj.revision_id for obj in continuities
+                if 'revision_id' in instance_state(obj).dict ])
+        revision_ids = [ id for id in revision_ids if
+                rev_mapper.identity_key_from_primary_key([id]) not in
+                session.identity_map ]
+        # (keeping hold of them as the identity map is weak referencing)
+        revisions = []
+        for start in range(0, len(revision_ids), chunk_size):
+            chunk = revision_ids[start:start+chunk_size]
+            revisions.extend(session.query(Revision).filter(
+                Revision.id.in_(chunk)))
+        unchanged = {}
+        for obj in continuities:
+            revobj = obj._unchanged_as_of(session, revision)
+            if revobj is not None:
+                unchanged[obj.id] = revobj
+        results.update(unchanged)
+        ids = [ id for id in ids if id not in unchanged ]
+
+        revision_table = class_mapper(revision_class).mapped_table
+        history_cache = HistoryCache.for_table(revision_table)
+        if history_cache is not None and history_cache.cacheable(
+                SQLAlchemySession.session(session)):
+            generation = history_cache.generation
+            snapshots = {}
+            for id in ids:
+                snapshot = history_cache.get_as_of(revision_table, id,
+                        revision.id)
+                if snapshot is not history_cache.missing:
+                    snapshots[id] = snapshot
+            for id, snapshot in snapshots.items():
+                if snapshot is not None:
+                    results[id] = cls._revision_instance(session,
+                            snapshot.values())
+            ids = [ id for id in ids if id not in snapshots ]
+        else:
+            history_cache = None
+            snapshots = {}
+        cls.as_of_stats.record(unchanged=len(unchanged),
+                cached=len(snapshots), queried=len(ids))
+
+        outbox = HistoryOutbox.for_table(revision_table)
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start+chunk_size]
+            query = cls.query_as_of(session, revision,
+                    revision_table.c.continuity_id.in_(chunk))
+            for revobj in query:
+                results[revobj.continuity_id] = revobj
+            if outbox is not None:
+                connection = session.connection(mapper=class_mapper(cls))
+                pending = outbox.pending_many(connection, revision_table,
+                        chunk)
+                for id, colvalues in pending.items():
+                    continuity = session.query(cls).get(id)
+                    results[id] = cls._latest_as_of(results[id],
+                            cls._make_pending_revisions(session, continuity,
+                                colvalues), revision)
+        if history_cache is not None:
+            for id in ids:
+                revobj = results[id]
+                if revobj is None or instance_state(revobj).key is not None:
+                    # (not from the history outbox)
+                    history_cache.put_as_of(revision_table, id, revision.id,
+                            revobj, generation)
+        for id in looked_up:
+            cache.put(session, (revision_class, id, revision.id), results[id])
+        return results
+
+    @classmethod
+    def query_as_of(cls, session, revision, criterion=None):
+        '''Query for the object revisions of all objects of this class as of
+        `revision` (NB: does not include versions still in a history outbox).
+
+        With interval columns (see temporal.py) this is a range lookup on the
+        revision table. Otherwise it picks the latest object revision of each
+        object (greatest per group), without a join with the revision table
+        if the revision table has revision seqs or timestamps.
+
+        @param criterion: optional clause restricting the object revisions
+            considered (applied before picking the latest).
+        '''
+        revision_class = cls.__revision_class__
+        revision_table = class_mapper(revision_class).mapped_table
+        if has_intervals(revision_table):
+            query = session.query(revision_class).filter(
+                    as_of_clause(revision_table, revision.timestamp)).\
+                    order_by(None)
+            if criterion is not None:
+                query = query.filter(criterion)
+            return query
+        column, key = cls._revision_order()
+        where = column <= getattr(revision, key)
+        query = session.query(revision_class)
+        if column.table is not revision_table:
+            rev_table = class_mapper(Revision).mapped_table
+            column = rev_table.c[key]
+            where = and_(revision_table.c.revision_id == rev_table.c.id,
+                    where)
+            query = query.join('revision')
+        if criterion is not None:
+            where = and_(where, criterion)
+        latest = select([revision_table.c.continuity_id,
+                    func.max(column).label('latest')],
+                where).group_by(revision_table.c.continuity_id).\
+                correlate(None).alias()
+        return query.join(
+                (latest, and_(
+                    latest.c.continuity_id == revision_class.continuity_id,
+                    latest.c.latest == column)))
+
+    def _pending_revisions(self):
+        '''Object revisions of this object still in the history outbox (if
+        one is in use) as (unsaved) revision class instances.'''
+        revision_class = self.__revision_class__
+        revision_table = class_mapper(revision_class).mapped_table
+        outbox = HistoryOutbox.for_table(revision_table)
+        if outbox is None:
+            return []
+        sess = object_session(self)
+        connection = sess.connection(mapper=class_mapper(revision_class))
+        pending = outbox.pending(connection, revision_table, self.id)
+        return self._make_pending_revisions(sess, self, pending)
+
+    @classmethod
+    def _make_pending_revisions(cls, sess, continuity, pending):
+        revision_class = cls.__revision_class__
+        results = []
+        for revision_id, colvalues in pending.items():
+            revobj = revision_class()
+            for key, value in colvalues.items():
+                setattr(revobj, key, value)
+            # without firing backrefs (which would add it to the session)
+            set_committed_value(revobj, 'revision',
+                    sess.query(Revision).get(revision_id))
+            set_committed_value(revobj, 'continuity', continuity)
+            results.append(revobj)
+        return results
     
     @property
     def all_revisions(self):
+        revision_table = class_mapper(self.__revision_class__).mapped_table
+        cache = HistoryCache.for_table(revision_table)
+        sess = object_session(self)
+        state = instance_state(self)
+        if cache is not None and sess is not None and \
+                state.key is not None and cache.cacheable(sess) and \
+                'all_revisions_unordered' not in state.dict:
+            snapshots = cache.get_all_revisions(revision_table, self.id)
+            if snapshots is not cache.missing:
+                return [ self._revision_instance(sess, snapshot.values())
+                        for snapshot in snapshots ]
+            generation = cache.generation
+        else:
+            cache = None
         allrevs = self.all_revisions_unordered
-        ourcmp = lambda revobj1, revobj2: cmp(revobj1.revision.timestamp,
-                revobj2.revision.timestamp)
-        sorted_revobjs = sorted(allrevs, cmp=ourcmp, reverse=True)
+        pending = self._pending_revisions()
+        if pending:
+            pending_ids = set([ revobj.revision_id for revobj in pending ])
+            allrevs = [ revobj for revobj in allrevs
+                    if revobj.revision_id not in pending_ids ] + pending
+        column, key = self._revision_order()
+        if column.table is \
+                class_mapper(self.__revision_class__).mapped_table:
+            # no need to load each revision
+            order = lambda revobj: getattr(revobj, column.key)
+        else:
+            order = lambda revobj: getattr(revobj.revision, key)
+        sorted_revobjs = sorted(allrevs, key=order, reverse=True)
+        if cache is not None and not pending:
+            cache.put_all_revisions(revision_table, self.id, sorted_revobjs,
+                    generation)
         return sorted_revobjs
 
     def diff(self, to_revision=None, from_revision=None):
@@ -265,22 +862,20 @@ class RevisionedObjectMixin(object):
         commits (NB: no changes may have occurred to *this* object in those
         commits).
         '''
-        obj_rev_class = self.__revision_class__
         sess = object_session(self)
-        obj_rev_query = sess.query(obj_rev_class).join('revision').\
-                        filter(obj_rev_class.id==self.id).\
-                        order_by(Revision.timestamp.desc())
+        obj_rev_query, order = self._history_query(sess)
         obj_class = self
         to_obj_rev, from_obj_rev = self.get_obj_revisions_to_diff(\
             obj_rev_query,
             to_revision=to_revision,
-            from_revision=from_revision)
+            from_revision=from_revision,
+            order=order)
         return self.diff_revisioned_fields(to_obj_rev, from_obj_rev,
                                            obj_class)
 
     
     def get_obj_revisions_to_diff(self, obj_revision_query, to_revision=None,
-                           from_revision=None):
+                           from_revision=None, order=None):
         '''Diff this object returning changes between `from_revision` and
         `to_revision`.
 
@@ -289,6 +884,8 @@ class RevisionedObjectMixin(object):
         @param to_revision: revision to diff to (defaults to the youngest rev)
         @param from_revision: revision to diff from (defaults to one revision
         older than to_revision)
+        @param order: (column, Revision attribute) obj_revision_query is
+        ordered by (see `_revision_order`, defaults to Revision.timestamp)
         @return: dict of diffs keyed by field name
 
         e.g. diff(HEAD, HEAD-2) will show diff of changes made in last 2
@@ -296,19 +893,31 @@ class RevisionedObjectMixin(object):
         commits).
         '''
         sess = object_session(self)
+        if order is None:
+            order = (Revision.timestamp, 'timestamp')
+        column, key = order
         if to_revision is None:
             to_revision = Revision.youngest(sess)
         out = obj_revision_query.\
-              filter(Revision.timestamp<=to_revision.timestamp)
+              filter(column<=getattr(to_revision, key))
         to_obj_rev = out.first()
         if not from_revision:
-            from_revision = sess.query(Revision).\
-                filter(Revision.timestamp<to_revision.timestamp).first()
+            # the one before (revisions are ordered youngest first)
+            revision_table = class_mapper(Revision).mapped_table
+            timeline = Revision.timeline(sess)
+            if timeline is not None:
+                id = timeline.previous(to_revision)
+                from_revision = id and sess.query(Revision).get(id)
+            else:
+                rev_key = revision_key(revision_table)
+                from_revision = sess.query(Revision).\
+                    filter(getattr(Revision, rev_key) <
+                            getattr(to_revision, rev_key)).first()
         # from_revision may be None, e.g. if to_revision is rev when object was
         # created
         if from_revision:
             out = obj_revision_query.\
-                filter(Revision.timestamp<=from_revision.timestamp)
+                filter(column<=getattr(from_revision, key))
             from_obj_rev = out.first()
         else:
             from_obj_rev = None
@@ -437,6 +1046,10 @@ def add_fake_relation(revision_class, name, is_many=False):
     relation.
     '''
     def _pget(self):
+        view = SQLAlchemySession.get_view(object_session(self))
+        if view is not None:
+            # got with the related objects of similar objects in one go
+            return view.related(self, name)
         related_object = getattr(self.continuity, name)
         if is_many:
             # do not need to do anything to get to right revision since either
@@ -463,6 +1076,11 @@ def add_stateful_versioned_m2m(*args, **kwargs):
 
     newkwargs = dict(kwargs)
     newkwargs['base_modifier'] = get_as_of
+    if newkwargs.get('load_active_only') is True:
+        # the join objects active as of another revision may be deleted now
+        def load_active_only(obj):
+            return SQLAlchemySession.at_HEAD(object_session(obj))
+        newkwargs['load_active_only'] = load_active_only
     add_stateful_m2m(*args, **newkwargs)
 
 def add_stateful_versioned_m2m_on_version(revision_class, m2m_property_name):
@@ -475,6 +1093,7 @@ def add_stateful_versioned_m2m_on_version(revision_class, m2m_property_name):
 
 
 from sqlalchemy.orm import MapperExtension
+from sqlalchemy.orm import SessionExtension
 from sqlalchemy.orm import object_session
 from sqlalchemy.orm import EXT_CONTINUE
 
@@ -494,11 +1113,15 @@ class Revisioner(MapperExtension):
 
     def __init__(self, revision_table):
         self.revision_table = revision_table
+        self.intervals = has_intervals(revision_table)
+        self.timestamps = 'revision_timestamp' in revision_table.c
+        self.sequence = 'revision_seq' in revision_table.c
         # Sometimes (not predictably) the after_update method is called
         # *after* the next instance's before_update! So to avoid this,
-        # we store the instance with the is_changed flag.
+        # we store the instance with its changed fields.
         # It is a weak key dictionary to make sure the instance is garbage
-        # collected.
+        # collected. (Only used if there is no RevisionerSessionExtension to
+        # hold this for the duration of the flush.)
         self._is_changed = weakref.WeakKeyDictionary() # instance:is_changed
 
     def revisioning_disabled(self, instance):
@@ -536,7 +1159,7 @@ class Revisioner(MapperExtension):
         # database which requires we use *column* values. In particular, we
         # need revision_id not revision object to create revision_object
         # properly!
-        logger.debug('Revisioner.set_revision: revision is %s' % current_rev)
+        logger.debug('Revisioner.set_revision: revision is %s', current_rev)
         assert current_rev.id, 'Must have a revision.id to create object revision'
         instance.revision = current_rev
         # must set both since we are already in flush so setting object will
@@ -544,21 +1167,44 @@ class Revisioner(MapperExtension):
         instance.revision_id = current_rev.id
 
     def check_real_change(self, instance, mapper, connection):
-        # check each attribute to see if they have been changed
-        logger.debug('check_real_change: %s' % instance)
+        return bool(self.changed_fields(instance))
+
+    def changed_fields(self, instance):
+        '''Get the revisioned fields of `instance` which have 'really'
+        changed.
+
+        Only attribute state already loaded is looked at so this never causes
+        expired or deferred attributes to be loaded (if they are not loaded
+        they cannot have been changed).
+
+        @return: set of field names.
+        '''
+        fields = instance._revisioned_fields()
         if sqav.startswith("0.4"):
             state = instance._state
+            candidates = fields
         else:
             state = instance
-        for key in instance.revisioned_fields():
+            _state = sqlalchemy.orm.attributes.instance_state(instance)
+            if _state.key is None: # pending: any field set is a change
+                candidates = [ key for key in fields if key in _state.dict ]
+            else:
+                # only fields modified since load can have changed (mutable
+                # types are only compared against their original on demand)
+                modified = set(_state.committed_state)
+                modified.update(getattr(_state.manager, 'mutable_attributes',
+                    ()))
+                candidates = [ key for key in fields if key in modified ]
+        changed = set()
+        for key in candidates:
             (added, unchanged, deleted) = get_history(state,
                                                       key,
-                                                      passive = PASSIVE_OFF)
+                                                      passive = PASSIVE_NO_INITIALIZE)
             if added or deleted:
-                logger.debug('check_real_change: True')
-                return True
-        logger.debug('check_real_change: False')
-        return False
+                changed.add(key)
+        logger.debug('changed_fields: %s %s', instance.__class__.__name__,
+                changed)
+        return changed
 
     def make_revision(self, instance, mapper, connection):
         # NO GOOD working with the object as that only gets committed at next
@@ -573,60 +1219,188 @@ class Revisioner(MapperExtension):
         assert instance.revision.id
         colvalues['revision_id'] = instance.revision.id
         colvalues['continuity_id'] = instance.id
+        if self.intervals:
+            set_interval(colvalues, instance.revision)
+        if self.timestamps:
+            set_timestamp(colvalues, instance.revision)
+        if self.sequence:
+            set_revision_seq(colvalues, instance.revision)
+
+        flush = RevisionerSessionExtension.get_flush(object_session(instance))
+        if flush is not None:
+            # written out in one go at the end of the flush
+            logger.debug('Queueing version of %s: %s', instance, colvalues)
+            flush.add_revision(self, connection, instance.revision, colvalues)
+        else:
+            self.write_revisions(connection, [(instance.revision, colvalues)])
+            cache = HistoryCache.for_table(self.revision_table)
+            if cache is not None:
+                cache.invalidate(self.revision_table, [instance.id])
+
+        # set to None to avoid accidental reuse
+        # ERROR: cannot do this as after_* is called per object and may be run
+        # before_update on other objects ...
+        # probably need a SessionExtension to deal with this properly
+        # object_session(instance).revision = None
 
-        # Allow for multiple SQLAlchemy flushes/commits per VDM revision
+    def write_revisions(self, connection, revisions):
+        '''Write object revisions to the revision table.
+
+        @param revisions: list of (revision, colvalues) tuples where colvalues
+            is the dict of column values created by make_revision.
+
+        Rows are inserted (or updated if that object already has a version
+        for the revision) using one executemany statement for each. Whether a
+        version already exists is looked up in the revision's record of the
+        versions written for it (see Revision.written_versions). Only if the
+        revision has no such record do we have to ask the database: via an
+        upsert where the dialect supports it (see `upsert_revisions`),
+        otherwise with a count query for each version.
+        '''
+        inserts = []
+        updates = []
+        upserts = []
+        for revision, colvalues in revisions:
+            # Allow for multiple SQLAlchemy flushes/commits per VDM revision
+            written = revision.written_versions
+            if written is not None:
+                key = (self.revision_table.name, colvalues['continuity_id'])
+                revision_already = key in written
+                written.add(key)
+            elif self.supports_upsert(connection):
+                logger.debug('Upserting version: %s', colvalues)
+                upserts.append(colvalues)
+                continue
+            else:
+                revision_already = self.revision_exists(connection, colvalues)
+
+            if revision_already:
+                logger.debug('Updating version: %s', colvalues)
+                updates.append(colvalues)
+            else:
+                logger.debug('Creating version: %s', colvalues)
+                inserts.append(colvalues)
+
+        if self.intervals:
+            close_intervals(connection, self.revision_table,
+                    [ colvalues for revision, colvalues in revisions ])
+        if inserts:
+            connection.execute(self.revision_table.insert(), inserts)
+        if upserts:
+            self.upsert_revisions(connection, upserts)
+        if updates:
+            upd, params = self._update_revisions(updates)
+            result = connection.execute(upd, params)
+            sane_rowcount = (len(params) == 1 or
+                    connection.dialect.supports_sane_multi_rowcount)
+            if sane_rowcount and result.rowcount != len(params):
+                # record was out of date (e.g. versions were rolled back) so
+                # check each one
+                logger.debug('Revision written versions out of date: %s' %
+                        self.revision_table.name)
+                for colvalues in updates:
+                    if not self.revision_exists(connection, colvalues):
+                        connection.execute(self.revision_table.insert(),
+                                colvalues)
+
+    def _update_revisions(self, updates):
+        # bindparam names must not clash with the column names being SET
+        existing_revision_clause = and_(
+                self.revision_table.c.continuity_id == bindparam('_continuity_id'),
+                self.revision_table.c.revision_id == bindparam('_revision_id'))
+        upd = self.revision_table.update(existing_revision_clause)
+        params = []
+        for colvalues in updates:
+            colvalues = dict(colvalues)
+            colvalues['_continuity_id'] = colvalues['continuity_id']
+            colvalues['_revision_id'] = colvalues['revision_id']
+            params.append(colvalues)
+        return upd, params
+
+    def revision_exists(self, connection, colvalues):
         revision_already_query = self.revision_table.count()
         existing_revision_clause = and_(
-                self.revision_table.c.continuity_id == instance.id,
-                self.revision_table.c.revision_id == instance.revision.id)
+                self.revision_table.c.continuity_id == colvalues['continuity_id'],
+                self.revision_table.c.revision_id == colvalues['revision_id'])
         revision_already_query = revision_already_query.where(
                 existing_revision_clause
                 )
         num_revisions = connection.execute(revision_already_query).scalar()
-        revision_already = num_revisions > 0
-
-        if revision_already:
-            logger.debug('Updating version of %s: %s' % (instance, colvalues))
-            connection.execute(self.revision_table.update(existing_revision_clause).values(colvalues))
+        return num_revisions > 0
+
+    def supports_upsert(self, connection):
+        return connection.dialect.name in ('sqlite', 'postgresql')
+
+    def upsert_revisions(self, connection, upserts):
+        '''Write the versions in `upserts` (list of colvalues), replacing
+        those the revision table already has, in one statement on sqlite and
+        two on postgresql (see `_update_insert_revisions`).'''
+        if connection.dialect.name == 'sqlite':
+            # revision table primary key is (id, revision_id) so a
+            # conflicting insert is one for the same continuity and revision
+            ins = self.revision_table.insert().prefix_with('OR REPLACE')
+            connection.execute(ins, upserts)
         else:
-            logger.debug('Creating version of %s: %s' % (instance, colvalues))
-            ins = self.revision_table.insert().values(colvalues)
-            connection.execute(ins)
-
-        # set to None to avoid accidental reuse
-        # ERROR: cannot do this as after_* is called per object and may be run
-        # before_update on other objects ...
-        # probably need a SessionExtension to deal with this properly
-        # object_session(instance).revision = None
+            self._update_insert_revisions(connection, upserts)
+
+    def _update_insert_revisions(self, connection, upserts):
+        # update the versions there are, then insert those there are not:
+        # INSERT ... SELECT :values WHERE NOT EXISTS (that version), as the
+        # rowcount of executemany does not tell which rows were updated
+        upd, params = self._update_revisions(upserts)
+        connection.execute(upd, params)
+        columns = upserts[0].keys()
+        table = self.revision_table
+        existing = select([table.c.continuity_id], and_(
+                table.c.continuity_id == bindparam('_continuity_id'),
+                table.c.revision_id == bindparam('_revision_id')))
+        query = select([ bindparam(key, type_=table.c[key].type) for key in
+            columns ], not_(exists(existing)))
+        connection.execute(InsertFromSelect(table, columns, query), params)
+
+    def _changes(self, instance):
+        '''Get instance:changed_fields mapping for the current flush.
+
+        With RevisionerSessionExtension installed this only lives as long as
+        the flush itself.
+        '''
+        flush = RevisionerSessionExtension.get_flush(object_session(instance))
+        if flush is not None:
+            return flush.changed_fields
+        return self._is_changed
 
     def before_update(self, mapper, connection, instance):
-        self._is_changed[instance] = self.check_real_change(instance, mapper, connection)
-        if not self.revisioning_disabled(instance) and self._is_changed[instance]:
-            logger.debug('before_update: %s' % instance)
+        changes = self._changes(instance)
+        changes[instance] = self.changed_fields(instance)
+        if not self.revisioning_disabled(instance) and changes[instance]:
+            logger.debug('before_update: %s', instance)
+            # NB: only changes revision_id which is not a revisioned field so
+            # no need to check for changes again
             self.set_revision(instance)
-            self._is_changed[instance] = self.check_real_change(
-                instance, mapper, connection)
         return EXT_CONTINUE
 
     # We do most of the work in after_insert/after_update as at that point
     # instance has been properly created (which means e.g. instance.id is
     # available ...)
     def before_insert(self, mapper, connection, instance):
-        self._is_changed[instance] = self.check_real_change(instance, mapper, connection)
-        if not self.revisioning_disabled(instance) and self._is_changed[instance]:
-            logger.debug('before_insert: %s' % instance)
+        changes = self._changes(instance)
+        changes[instance] = self.changed_fields(instance)
+        if not self.revisioning_disabled(instance) and changes[instance]:
+            logger.debug('before_insert: %s', instance)
             self.set_revision(instance)
         return EXT_CONTINUE
 
     def after_update(self, mapper, connection, instance):
-        if not self.revisioning_disabled(instance) and self._is_changed[instance]:
-            logger.debug('after_update: %s' % instance)
+        if not self.revisioning_disabled(instance) and \
+                self._changes(instance)[instance]:
+            logger.debug('after_update: %s', instance)
             self.make_revision(instance, mapper, connection)
         return EXT_CONTINUE
 
     def after_insert(self, mapper, connection, instance):
-        if not self.revisioning_disabled(instance) and self._is_changed[instance]:
-            logger.debug('after_insert: %s' % instance)
+        if not self.revisioning_disabled(instance) and \
+                self._changes(instance)[instance]:
+            logger.debug('after_insert: %s', instance)
             self.make_revision(instance, mapper, connection)
         return EXT_CONTINUE
 
@@ -635,3 +1409,130 @@ class Revisioner(MapperExtension):
         # TODO: 2009-02-13 why is this needed? Can we remove this?
         return EXT_CONTINUE
 
+
+class RevisionerFlush(object):
+    '''Object revisions queued by Revisioner during a single session flush.
+    '''
+
+    def __init__(self):
+        # revisioner:(connection, [(revision, colvalues), ...]) plus order of
+        # first use
+        self.revisions = {}
+        self.revisioners = []
+        # instance:changed_fields (see Revisioner.changed_fields)
+        self.changed_fields = {}
+
+    def add_revision(self, revisioner, connection, revision, colvalues):
+        if revisioner not in self.revisions:
+            self.revisioners.append(revisioner)
+            self.revisions[revisioner] = (connection, [])
+        self.revisions[revisioner][1].append((revision, colvalues))
+
+    def write(self):
+        for revisioner in self.revisioners:
+            connection, revisions = self.revisions[revisioner]
+            revisioner.write_revisions(connection, revisions)
+        self.revisions = {}
+        self.revisioners = []
+
+
+class RevisionerSessionExtension(SessionExtension):
+    '''SQLAlchemy SessionExtension which batches up the object revisions
+    created by Revisioner.
+
+    Without it each versioned object results in its own INSERT/UPDATE on the
+    revision table as it is flushed. With it the object revisions are
+    collected during the flush and written out at the end of the flush with a
+    single executemany per revision table (and statement type). Install it
+    when creating your session::
+
+        Session = scoped_session(sessionmaker(
+            extension=RevisionerSessionExtension()))
+    '''
+    flush_attr = '_vdm_revisioner_flush'
+
+    def __init__(self, history_outbox=None):
+        '''
+        @param history_outbox: HistoryOutbox to put the object revisions in
+            rather than writing them to the revision tables (see outbox.py).
+        '''
+        self.history_outbox = history_outbox
+
+    @classmethod
+    def get_flush(self, session):
+        '''Get RevisionerFlush for the flush in progress on `session`.
+
+        NB: will return None if extension not installed on this session.
+        '''
+        return getattr(session, self.flush_attr, None)
+
+    def before_flush(self, session, flush_context, instances):
+        if SQLAlchemySession.get_view(session) is not None and \
+                (session.new or session.dirty or session.deleted):
+            raise ValueError('Session pinned to a revision by a '
+                    'RevisionView is read only')
+        for obj in session.new:
+            if isinstance(obj, Revision):
+                RevisionTimeline.record(session, obj)
+        setattr(session, self.flush_attr, RevisionerFlush())
+
+    def after_flush(self, session, flush_context):
+        flush = self.get_flush(session)
+        if flush is not None:
+            self._invalidate_history(session, flush)
+            # we are still inside the flush's transaction
+            if self.history_outbox is not None:
+                self.history_outbox.enqueue(flush)
+            else:
+                flush.write()
+            delattr(session, self.flush_attr)
+        # history may have changed
+        SQLAlchemySession.clear_as_of_cache(session)
+
+    def _invalidate_history(self, session, flush):
+        # drop cached object revisions of objects written in this flush (and
+        # have other processes do so once committed)
+        for revisioner in flush.revisioners:
+            revision_table = revisioner.revision_table
+            ChangeCounter.record(session, revision_table)
+            cache = HistoryCache.for_table(revision_table)
+            if cache is not None:
+                connection, revisions = flush.revisions[revisioner]
+                cache.invalidate(revision_table, [ colvalues['continuity_id']
+                    for revision, colvalues in revisions ], session)
+
+    def before_commit(self, session):
+        # (commit only flushes after this)
+        session.flush()
+        ChangeCounter.publish(session)
+
+    def after_commit(self, session):
+        HistoryCache.end_transaction(session)
+        ChangeCounter.end_transaction(session, committed=True)
+        RevisionTimeline.end_transaction(session, committed=True)
+        GroupCommit.end_transaction(session, committed=True)
+
+    def after_bulk_update(self, session, query, query_context, result):
+        self._warn_bulk(query, 'update')
+
+    def after_bulk_delete(self, session, query, query_context, result):
+        self._warn_bulk(query, 'delete')
+
+    def _warn_bulk(self, query, operation):
+        cls = query.column_descriptions[0]['type']
+        if getattr(cls, '__revisioned__', False):
+            logger.warn('Query.%s() on %s does not create object revisions '
+                    '(see Repository.bulk_%s)' % (operation, cls.__name__,
+                        operation))
+
+    def after_rollback(self, session):
+        SQLAlchemySession.clear_as_of_cache(session)
+        HistoryCache.end_transaction(session)
+        ChangeCounter.end_transaction(session, committed=False)
+        RevisionTimeline.end_transaction(session, committed=False)
+        GroupCommit.end_transaction(session, committed=False)
+        revision = SQLAlchemySession.get_revision(session)
+        if revision is not None:
+            # versions written for it may or may not have been rolled back
+            revision.written_versions = None
+
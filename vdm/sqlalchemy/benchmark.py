@@ -0,0 +1,377 @@
+'''Simple benchmarks for vdm using the domain model in demo.py.
+
+Run with::
+
+    $ python -m vdm.sqlalchemy.benchmark [num-objects]
+
+(Uses the database configured by TEST_ENGINE in demo.py.)
+'''
+from __future__ import with_statement
+import sys
+import time
+
+from demo import *
+from timetravel import RevisionView
+from history_cache import HistoryCache
+from timeline import RevisionTimeline
+from stateful import StatefulList, StatefulSet, StatefulDict
+
+
+def timed(func, num, setup=None):
+    repo.rebuild_db()
+    if setup:
+        setup(num)
+        Session.remove()
+    start = time.time()
+    func(num)
+    duration = time.time() - start
+    Session.remove()
+    return duration
+
+def report(name, num, duration):
+    print '%-30s %8d objects %8.2fs %10.0f objects/s' % (name, num, duration,
+            num / duration)
+
+
+## -------------------------------------
+## Bulk import
+
+def import_orm(num):
+    repo.new_revision()
+    lic = License(name=u'lic')
+    Session.add(lic)
+    tag = Tag(name=u'tag')
+    Session.add(tag)
+    for ii in range(num):
+        pkg = Package(name=u'pkg%s' % ii, license=lic)
+        Session.add(pkg)
+        pkg.package_tags.append(PackageTag(tag=tag))
+    repo.commit()
+
+def import_bulk(num):
+    repo.new_revision()
+    tag = Tag(name=u'tag')
+    Session.add(tag)
+    keys = repo.bulk_import({License: [ {'name': u'lic'} ]})
+    licid = keys[License][0]
+    pkgs = [ {'name': u'pkg%s' % ii, 'license_id': licid} for ii in
+            range(num) ]
+    pkgids = repo.bulk_import({Package: pkgs})[Package]
+    Session.flush()
+    pkgtags = [ {'package_id': pkgid, 'tag_id': tag.id} for pkgid in pkgids ]
+    repo.bulk_import({PackageTag: pkgtags})
+    repo.commit()
+
+def bench_bulk_import(num):
+    report('import (orm)', num, timed(import_orm, num))
+    report('import (bulk_import)', num, timed(import_bulk, num))
+
+
+## -------------------------------------
+## Bulk update
+
+def relicense_orm(num):
+    repo.new_revision()
+    lic = License(name=u'newlic')
+    Session.add(lic)
+    for pkg in Session.query(Package):
+        pkg.license = lic
+    repo.commit()
+
+def relicense_bulk(num):
+    repo.new_revision()
+    lic = License(name=u'newlic')
+    Session.add(lic)
+    Session.flush()
+    repo.bulk_update(Package, None, {'license_id': lic.id})
+    repo.commit()
+
+def bench_bulk_update(num):
+    report('relicense (orm)', num, timed(relicense_orm, num, import_bulk))
+    report('relicense (bulk_update)', num, timed(relicense_bulk, num,
+        import_bulk))
+
+
+## -------------------------------------
+## Group commit
+
+def small_revisions(num):
+    for ii in range(num):
+        repo.new_revision()
+        Session.add(Package(name=u'pkg%s' % ii))
+        repo.commit()
+    repo.commit_and_remove()
+
+def bench_group_commit(num):
+    report('small revisions', num, timed(small_revisions, num))
+    repo.group_commit = True
+    try:
+        report('small revisions (group)', num, timed(small_revisions, num))
+        print repo.group_commit_stats.as_dict()
+    finally:
+        repo.group_commit = False
+
+
+## -------------------------------------
+## Objects as of an old revision
+
+def history_setup(num):
+    import_bulk(num)
+    relicense_bulk(num)
+
+def as_of_each(num):
+    rev = Session.query(Revision).order_by(Revision.timestamp).first()
+    for pkg in Session.query(Package):
+        pkg.get_as_of(rev)
+
+def as_of_many(num):
+    rev = Session.query(Revision).order_by(Revision.timestamp).first()
+    Package.get_many_as_of(Session.query(Package).all(), rev)
+
+def bench_as_of(num):
+    Package.as_of_stats.reset()
+    report('as of (get_as_of)', num, timed(as_of_each, num, history_setup))
+    report('as of (get_many_as_of)', num, timed(as_of_many, num,
+        history_setup))
+    print Package.as_of_stats.as_dict()
+
+def as_of_twice(num):
+    # second session answered from the HistoryCache
+    as_of_each(num)
+    Session.remove()
+    as_of_each(num)
+
+def bench_history_cache(num):
+    report('as of twice', num * 2, timed(as_of_twice, num, history_setup))
+    cache = HistoryCache(metadata)
+    try:
+        report('as of twice (HistoryCache)', num * 2, timed(as_of_twice, num,
+            history_setup))
+        print cache.as_dict()
+    finally:
+        cache.close()
+
+
+## -------------------------------------
+## Walking package -> license -> tags as of an old revision
+
+def walk_get_as_of(num):
+    rev = Session.query(Revision).order_by(Revision.timestamp).first()
+    for pkg in Session.query(Package):
+        pkgrev = pkg.get_as_of(rev)
+        pkgrev.license
+        [ tag.name for tag in pkgrev.tags ]
+
+def walk_view(num):
+    rev = Session.query(Revision).order_by(Revision.timestamp).first()
+    with RevisionView(Session, rev) as view:
+        for pkgrev in view.find(Package):
+            pkgrev.license
+            [ tag.name for tag in pkgrev.tags ]
+
+def bench_walk(num):
+    report('walk (get_as_of)', num, timed(walk_get_as_of, num,
+        history_setup))
+    report('walk (RevisionView)', num, timed(walk_view, num, history_setup))
+
+
+## -------------------------------------
+## Long history of one object
+## (Package revisions have revision timestamps, License revisions intervals
+## and PackageTag revisions neither.)
+
+def long_history(num):
+    repo.new_revision()
+    lic = License(name=u'lic0')
+    pkg = Package(name=u'pkg', title=u'0', license=lic)
+    pkgtag = PackageTag(package=pkg, tag=Tag(name=u'tag'))
+    Session.add_all([lic, pkg, pkgtag])
+    repo.commit()
+    for ii in range(1, num):
+        repo.new_revision()
+        lic.name = u'lic%s' % ii
+        pkg.title = u'%s' % ii
+        pkgtag.state = [State.ACTIVE, State.DELETED][ii % 2]
+        repo.commit()
+
+def as_of_history(cls):
+    def func(num):
+        obj = Session.query(cls).first()
+        for rev in Session.query(Revision):
+            obj.get_as_of(rev)
+    return func
+
+def bench_history(num):
+    for cls in [Package, License, PackageTag]:
+        report('history as of (%s)' % cls.__name__, num,
+                timed(as_of_history(cls), num, long_history))
+
+
+## -------------------------------------
+## Revision lookups (youngest, previous, at time)
+
+def revision_lookups(num):
+    revs = Session.query(Revision).all()
+    for rev in revs:
+        Revision.youngest(Session)
+        Revision.at(Session, rev.timestamp)
+        pkg = Session.query(Package).first()
+        pkg.get_obj_revisions_to_diff(pkg._history_query(Session)[0],
+                to_revision=rev)
+
+def bench_timeline(num):
+    setup = lambda num: small_revisions(num)
+    report('revision lookups', num, timed(revision_lookups, num, setup))
+    timeline = RevisionTimeline(metadata)
+    try:
+        report('revision lookups (timeline)', num, timed(revision_lookups,
+            num, setup))
+        print {'revisions': len(timeline), 'bytes': timeline.nbytes()}
+    finally:
+        timeline.close()
+
+
+## -------------------------------------
+## Positional access to long stateful lists (in memory, every third item
+## deleted)
+
+class Item(object):
+    def __init__(self, state):
+        self.state = state
+
+    def is_active(self):
+        return self.state == State.ACTIVE
+
+def stateful_list_access(indexed):
+    def func(num):
+        items = [ Item([State.ACTIVE, State.DELETED][ii % 3 == 1]) for ii in
+                range(num) ]
+        slist = StatefulList(items, indexed=indexed)
+        for ii in range(len(slist)):
+            slist[ii]
+            len(slist)
+    return func
+
+def bench_stateful_list(num):
+    for indexed in [False, True]:
+        start = time.time()
+        stateful_list_access(indexed)(num)
+        report('stateful list access%s' % (indexed and ' (indexed)' or ''),
+                num, time.time() - start)
+
+def stateful_membership(cls):
+    def func(num):
+        items = [ Item([State.ACTIVE, State.DELETED][ii % 3 == 1]) for ii in
+                range(num) ]
+        for ii, item in enumerate(items):
+            item.name = ii
+        collection = cls(items, identifier=lambda item: item.name)
+        for item in items:
+            item in collection
+    return func
+
+def bench_stateful_set(num):
+    for cls in [StatefulList, StatefulSet]:
+        start = time.time()
+        stateful_membership(cls)(num)
+        report('stateful membership (%s)' % cls.__name__, num,
+                time.time() - start)
+
+def stateful_dict_access(indexed):
+    def func(num):
+        items = dict([ (ii, Item([State.ACTIVE, State.DELETED][ii % 3 == 1]))
+            for ii in range(num) ])
+        kwargs = {}
+        if not indexed:
+            # (states seen through a base_modifier are not counted)
+            kwargs['base_modifier'] = lambda item: item
+        sdict = StatefulDict(items, **kwargs)
+        for ii in range(num):
+            sdict[ii] = Item(State.ACTIVE)
+            len(sdict)
+    return func
+
+def bench_stateful_dict(num):
+    for indexed in [False, True]:
+        start = time.time()
+        stateful_dict_access(indexed)(num)
+        report('stateful dict set and len%s' % (indexed and ' (indexed)' or
+            ''), num, time.time() - start)
+
+
+## -------------------------------------
+## Replacing the tags of a package with many (mostly the same) tags
+
+def many_tags(num):
+    repo.new_revision()
+    pkg = Package(name=u'pkg')
+    Session.add(pkg)
+    pkg.tags = [ Tag(name=u'tag%s' % ii) for ii in range(num) ]
+    repo.commit()
+
+def retag(replace):
+    def func(num):
+        repo.new_revision()
+        pkg = Session.query(Package).first()
+        tags = Session.query(Tag).all()[1:] + [Tag(name=u'new')]
+        if replace:
+            pkg.tags = tags
+        else:
+            # one by one, as assignment used to
+            pkg.tags_active.clear()
+            pkg.tags.extend(tags)
+        repo.commit()
+    return func
+
+def bench_retag(num):
+    report('retag (clear and extend)', num, timed(retag(False), num,
+        many_tags))
+    report('retag (replace)', num, timed(retag(True), num, many_tags))
+
+
+## -------------------------------------
+## Reading the tags of a package most of whose tags have been deleted
+
+# the same as Package.tags but loading only active PackageTags
+add_stateful_versioned_m2m(Package, PackageTag, 'tags_loaded_active', 'tag',
+        'package_tags', load_active_only=True)
+
+def churned_tags(num):
+    many_tags(num)
+    repo.new_revision()
+    pkg = Session.query(Package).first()
+    pkg.tags = Session.query(Tag).limit(5).all()
+    repo.commit()
+
+def read_tags(name):
+    def func(num):
+        pkg = Session.query(Package).first()
+        for ii in range(100):
+            Session.expire(pkg)
+            assert len(getattr(pkg, name)) == 5
+    return func
+
+def bench_churned_tags(num):
+    report('read churned tags', num, timed(read_tags('tags'), num,
+        churned_tags))
+    report('read churned tags (active)', num,
+            timed(read_tags('tags_loaded_active'), num, churned_tags))
+
+
+if __name__ == '__main__':
+    num = 1000
+    if len(sys.argv) > 1:
+        num = int(sys.argv[1])
+    bench_bulk_import(num)
+    bench_bulk_update(num)
+    bench_group_commit(num)
+    bench_as_of(num)
+    bench_history_cache(num)
+    bench_walk(num)
+    bench_history(num)
+    bench_timeline(num)
+    bench_stateful_list(num)
+    bench_stateful_set(num)
+    bench_stateful_dict(num)
+    bench_retag(num)
+    bench_churned_tags(num)
@@ -0,0 +1,231 @@
+'''Invalidation of process local caches across processes.
+
+Caches such as `HistoryCache` only see the changes made in their own process.
+When several processes write to the same vdm database a `ChangeCounter`
+keeps a counter per revision table in a small table of that database::
+
+    counter = ChangeCounter(metadata, interval=1.0)
+
+(before creating the tables as this adds a `revision_changes` table to the
+metadata).
+
+Each transaction which changes object revisions (through the ORM in
+RevisionerSessionExtension, by the Repository bulk operations or by
+`Repository.purge_revision`) increments the counters of the revision tables it
+changed just before it commits. Caches poll the counters (at most every
+`interval` seconds, one small query) and drop what they have for a table
+whose counter has moved. No outside service is needed, just the same
+ChangeCounter in every process.
+
+Objects listening for changes are registered in `ChangeCounter.listeners`
+(callables taking the metadata and a list of the revision tables changed, or
+None if anything may have changed).
+
+NB: needs RevisionerSessionExtension. Counters are only incremented at
+commit to keep the time their rows are locked short.
+'''
+from __future__ import with_statement
+import logging
+import threading
+import time
+
+from sqlalchemy import Table, Column, Integer, UnicodeText
+from sqlalchemy import select
+try:
+    from sqlalchemy import event
+except ImportError:
+    # sqlalchemy < 0.7
+    event = None
+
+logger = logging.getLogger('vdm')
+
+
+def make_changes_table(metadata, name='revision_changes'):
+    if name in metadata.tables:
+        return metadata.tables[name]
+    table = Table(name, metadata,
+            Column('table_name', UnicodeText, primary_key=True),
+            Column('counter', Integer, nullable=False),
+            )
+    def add_counters(target, connection, **kw):
+        # one row per revision table (and the revision table itself, see
+        # timeline.py) up front so that the first changes of concurrent
+        # transactions do not both insert it
+        rows = [ {'table_name': unicode(other.name), 'counter': 0} for other
+                in metadata.sorted_tables if 'continuity_id' in other.c or
+                other.name == 'revision' ]
+        if rows:
+            connection.execute(table.insert(), rows)
+    if event is not None:
+        event.listen(table, 'after_create', add_counters)
+    elif hasattr(table, 'append_ddl_listener'):
+        # sqlalchemy 0.5 and 0.6
+        table.append_ddl_listener('after-create',
+                lambda event_name, target, bind, **kw: add_counters(target,
+                    bind))
+    # (otherwise the first increment of each table inserts its row)
+    return table
+
+
+class ChangeCounter(object):
+    '''Per revision table change counters shared by all processes using a
+    database (see module docs).
+
+    There is one ChangeCounter per metadata (i.e. per vdm database).
+    '''
+    # metadata:counter
+    _registry = {}
+    # callables called as listener(metadata, revision tables or None)
+    listeners = []
+    # on sessions: set of revision tables changed in the current transaction
+    session_attr = '_vdm_changed_tables'
+    # on sessions: [(counter, {table name: value}), ...] set by publish
+    published_attr = '_vdm_published_counters'
+
+    def __init__(self, metadata, bind=None, interval=1.0):
+        '''
+        @param metadata: metadata of the versioned tables. The counter table
+            is added to it.
+        @param bind: engine to poll with (defaults to the one bound to
+            metadata).
+        @param interval: minimum number of seconds between polls.
+        '''
+        self.metadata = metadata
+        self.table = make_changes_table(metadata)
+        self._bind = bind
+        self.interval = interval
+        self._lock = threading.Lock()
+        # table name:counter value as of the last poll (None before the
+        # first one)
+        self._seen = None
+        self._polled = 0
+        self.polls = 0
+        self._registry[metadata] = self
+
+    @property
+    def bind(self):
+        return self._bind or self.metadata.bind
+
+    @classmethod
+    def for_metadata(self, metadata):
+        '''Get the counter used for `metadata` (None if none).'''
+        return self._registry.get(metadata)
+
+    @classmethod
+    def for_table(self, table):
+        '''Get the counter used for revision table `table` (None if none).'''
+        return self._registry.get(table.metadata)
+
+    def close(self):
+        '''Stop using this counter.'''
+        if self._registry.get(self.metadata) is self:
+            del self._registry[self.metadata]
+
+    @classmethod
+    def record(self, session, revision_table):
+        '''Note that `revision_table` was changed in the current transaction
+        of `session` (its counter is incremented when it commits).'''
+        if self.for_table(revision_table) is None:
+            return
+        changed = getattr(session, self.session_attr, None)
+        if changed is None:
+            changed = set()
+            setattr(session, self.session_attr, changed)
+        changed.add(revision_table)
+
+    @classmethod
+    def publish(self, session):
+        '''Increment the counters of the revision tables changed in the
+        transaction of `session` (which is about to commit).'''
+        changed = getattr(session, self.session_attr, None)
+        if not changed:
+            return
+        delattr(session, self.session_attr)
+        published = []
+        for revision_table in sorted(changed, key=lambda t: t.name):
+            counter = self.for_table(revision_table)
+            if counter is None:
+                continue
+            connection = session.connection(clause=counter.table)
+            published.append((counter,
+                counter.increment(connection, [revision_table.name])))
+        setattr(session, self.published_attr, published)
+
+    @classmethod
+    def end_transaction(self, session, committed):
+        '''Forget about changes (and counters published) in the transaction
+        of `session` which has just committed or rolled back.'''
+        if hasattr(session, self.session_attr):
+            delattr(session, self.session_attr)
+        published = getattr(session, self.published_attr, None)
+        if published is None:
+            return
+        delattr(session, self.published_attr)
+        if committed:
+            for counter, values in published:
+                counter._advance(values)
+
+    def increment(self, connection, table_names):
+        '''Increment the counters of `table_names` in the transaction of
+        `connection`.
+
+        @return: dict of the new values keyed by table name.
+        '''
+        t = self.table
+        values = {}
+        for name in table_names:
+            name = unicode(name)
+            result = connection.execute(t.update(t.c.table_name == name).
+                    values(counter=t.c.counter + 1))
+            if not result.rowcount:
+                # revision table added after the counter table was created
+                connection.execute(t.insert(), table_name=name, counter=1)
+            values[name] = connection.execute(select([t.c.counter],
+                t.c.table_name == name)).scalar()
+        return values
+
+    def _advance(self, values):
+        # our own increments need not invalidate anything when no other
+        # process has incremented the counter since the last poll
+        with self._lock:
+            if self._seen is None:
+                return
+            for name, value in values.items():
+                if self._seen.get(name, 0) == value - 1:
+                    self._seen[name] = value
+
+    def counters(self, connection=None):
+        '''Get the current counter values keyed by table name.'''
+        t = self.table
+        query = select([t.c.table_name, t.c.counter])
+        return dict([ (name, value) for name, value in
+            (connection or self.bind).execute(query) ])
+
+    def poll(self, force=False):
+        '''Check the counters (unless polled less than `interval` seconds
+        ago) and tell the listeners about the revision tables changed since
+        the last poll.
+
+        @return: list of the revision tables changed (None if anything may
+            have changed, as on the first poll).
+        '''
+        now = time.time()
+        if not force and now - self._polled < self.interval:
+            return []
+        with self._lock:
+            self._polled = now
+            self.polls += 1
+            current = self.counters()
+            if self._seen is None:
+                changed = None
+            else:
+                names = set(current) | set(self._seen)
+                changed = [ self.metadata.tables[name] for name in
+                        sorted(names) if name in self.metadata.tables and
+                        current.get(name) != self._seen.get(name) ]
+            self._seen = current
+        if changed is None or changed:
+            logger.debug('Revision tables changed elsewhere: %s', changed)
+            for listener in self.listeners:
+                listener(self.metadata, changed)
+        return changed
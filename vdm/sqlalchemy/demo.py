@@ -127,7 +127,8 @@ if sqla_version <= '0.4.99':
 else:
     Session = scoped_session(sessionmaker(autoflush=True,
                                           expire_on_commit=False,
-                                          autocommit=False))
+                                          autocommit=False,
+                                          extension=vdm.sqlalchemy.RevisionerSessionExtension()))
 
 # mapper = Session.mapper
 from sqlalchemy.orm import mapper
@@ -106,8 +106,8 @@ def test_it():
 
     # You can set up the revision directly e.g.
     # rev = Revision()
-    # SQLAlchemySession.set_revision(rev)
-    # (or even just Session.revision = rev)
+    # SQLAlchemySession.set_revision(Session, rev)
+    # or only for a block: with SQLAlchemySession.using_revision(Session, rev):
     # However this will do the same and is simpler
     rev = repo.new_revision()
 
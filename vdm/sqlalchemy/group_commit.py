@@ -0,0 +1,273 @@
+'''Group commit of revisions (see `Repository` group_commit).
+
+A `GroupCommit` holds the revisions flushed but not yet committed on one
+session along with a `CommitHandle` for each. RevisionerSessionExtension
+tells it when the session's transaction ends other than through
+`GroupCommit.commit`.
+
+The group is committed by its thread when it is full or its oldest revision
+has waited long enough (checked as the repository is used) and otherwise by a
+timer once the wait is up, unless a revision is being made on the session
+(between Repository.new_revision and commit) at the time: the group is then
+committed when that revision is.
+'''
+from __future__ import with_statement
+import logging
+import threading
+import time
+
+logger = logging.getLogger('vdm')
+
+
+class GroupCommitStats(object):
+    '''Batch size and latency figures for group commits of a Repository
+    (shared by all threads using it).'''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.batches = 0
+        self.revisions = 0
+        self.max_batch_size = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def record(self, handles, now):
+        with self._lock:
+            self.batches += 1
+            self.revisions += len(handles)
+            self.max_batch_size = max(self.max_batch_size, len(handles))
+            for handle in handles:
+                latency = now - handle.submitted
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+
+    def as_dict(self):
+        with self._lock:
+            batches = self.batches or 1
+            revisions = self.revisions or 1
+            return {
+                'batches': self.batches,
+                'revisions': self.revisions,
+                'mean_batch_size': self.revisions / float(batches),
+                'max_batch_size': self.max_batch_size,
+                'mean_latency': self.total_latency / revisions,
+                'max_latency': self.max_latency,
+                }
+
+
+class CommitHandle(object):
+    '''Handle on a revision committed in group commit mode (see
+    `Repository`).
+
+    The revision (and its changes) has been flushed but is only durable once
+    the group it is in has been committed.
+    '''
+    # seconds between checks for a closed session in wait
+    poll = 0.1
+
+    def __init__(self, group, revision):
+        self.group = group
+        self.revision = revision
+        self.submitted = time.time()
+        self.error = None
+        self._durable = threading.Event()
+
+    @property
+    def done(self):
+        '''True once the group has been committed or has failed.'''
+        if not self._durable.isSet():
+            self.group.check()
+        return self._durable.isSet()
+
+    @property
+    def durable(self):
+        return self.done and self.error is None
+
+    def wait(self, timeout=None):
+        '''Wait until the revision is durable and return it.
+
+        Called from the thread owning the session this commits the pending
+        group straight away. From other threads it waits (at most `timeout`
+        seconds) for the owner or the group's timer to do so.
+
+        @raise: the error the group commit failed with (if any).
+        '''
+        if not self.done and self.group.is_owner():
+            self.group.commit()
+        end = timeout is not None and time.time() + timeout
+        while not self.done:
+            # (poll so that a session closed by its owner is noticed)
+            left = end and end - time.time()
+            if end and left <= 0:
+                break
+            self._durable.wait(end and min(left, self.poll) or self.poll)
+        if self.error is not None:
+            raise self.error
+        return self.revision
+
+    def _resolve(self, error=None):
+        self.error = error
+        self._durable.set()
+
+
+class GroupCommitAborted(Exception):
+    '''The transaction of a group of revisions was rolled back or closed
+    before the group was committed.'''
+    pass
+
+
+class GroupCommit(object):
+    '''Revisions flushed but not yet committed on one session.
+
+    Handles pending when the session's transaction ends other than through
+    `commit` are resolved as well: as durable if the session was committed
+    directly, with a `GroupCommitAborted` error if it was rolled back or
+    closed (e.g. by Session.remove()).
+
+    The lock is held while the group commits, so that the timer and the
+    session's thread never use the session at the same time.
+    '''
+    # on sessions: the session's GroupCommit
+    session_attr = '_vdm_group_commit'
+
+    def __init__(self, repository, session):
+        self.repository = repository
+        self.session = session
+        self.thread = threading.currentThread()
+        self.handles = []
+        # transaction the pending revisions were flushed in
+        self.transaction = None
+        # set while Repository.commit flushes (it fails the handles itself
+        # with the flush error)
+        self.flushing = False
+        # set while a revision is being made on the session
+        self.busy = False
+        self._timer = None
+        self._lock = threading.RLock()
+
+    @classmethod
+    def end_transaction(self, session, committed):
+        '''Resolve the revisions pending on `session` whose transaction has
+        just committed or rolled back (called by RevisionerSessionExtension).
+        '''
+        group = getattr(session, self.session_attr, None)
+        if group is None:
+            return
+        if committed:
+            group._committed()
+        else:
+            group._rolled_back()
+
+    def is_owner(self):
+        return threading.currentThread() is self.thread
+
+    def begin_revision(self):
+        '''Note that a revision is being made on the session (committing the
+        group first if it is due).'''
+        with self._lock:
+            if self.due():
+                self.commit()
+            self.busy = True
+
+    def add(self, revision):
+        '''Add `revision` (flushed) to the group and note that it is no
+        longer being made (committing the group if it is due).
+
+        @return: the CommitHandle of `revision`.
+        '''
+        handle = CommitHandle(self, revision)
+        with self._lock:
+            if not self.handles:
+                self.transaction = self.session.transaction
+                self._start_timer()
+            self.handles.append(handle)
+            self.busy = False
+            if self.due():
+                self.commit()
+        return handle
+
+    def _start_timer(self):
+        wait = self.repository.group_commit_wait
+        if wait is None:
+            return
+        self._timer = threading.Timer(wait, self._deadline)
+        self._timer.setDaemon(True)
+        self._timer.start()
+
+    def _deadline(self):
+        with self._lock:
+            self._timer = None
+            # (when busy the group is committed along with the revision)
+            if self.busy or not self.handles:
+                return
+            self.check()
+            try:
+                self.commit()
+            except Exception, inst:
+                # (the handles have the error)
+                logger.warn('Group commit at its deadline failed: %s', inst)
+
+    def _take(self):
+        with self._lock:
+            handles, self.handles = self.handles, []
+            self.transaction = None
+            self.busy = False
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        return handles
+
+    def _committed(self):
+        # committed outside of commit (which takes the handles first)
+        handles = self._take()
+        if handles:
+            now = time.time()
+            for handle in handles:
+                handle._resolve()
+            self.repository.group_commit_stats.record(handles, now)
+
+    def _rolled_back(self):
+        if self.flushing:
+            return
+        self.fail(GroupCommitAborted('Transaction rolled back before the '
+            'group commit'))
+
+    def check(self):
+        '''Fail the pending revisions if the session has been closed (which
+        rolls back the transaction without any session event).'''
+        transaction = self.transaction
+        if transaction is not None and transaction.session is None:
+            self.fail(GroupCommitAborted('Session closed before the group '
+                'commit'))
+
+    def due(self):
+        repo = self.repository
+        wait = repo.group_commit_wait
+        return self.handles and (
+                len(self.handles) >= repo.group_commit_size or
+                (wait is not None and
+                    time.time() - self.handles[0].submitted >= wait))
+
+    def commit(self):
+        with self._lock:
+            handles = self._take()
+            if not handles:
+                return
+            try:
+                self.session.commit()
+            except Exception, inst:
+                self.session.rollback()
+                for handle in handles:
+                    handle._resolve(inst)
+                raise
+        now = time.time()
+        for handle in handles:
+            handle._resolve()
+        self.repository.group_commit_stats.record(handles, now)
+
+    def fail(self, error):
+        handles = self._take()
+        for handle in handles:
+            handle._resolve(error)
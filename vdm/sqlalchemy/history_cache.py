@@ -0,0 +1,293 @@
+'''Process wide cache of object revisions.
+
+Object revisions (rows of the `*_revision` tables) of past revisions do not
+change (bar `Repository.purge_revision`) so they can be shared by all
+sessions (and threads) of a process. A `HistoryCache` keeps the results of
+`RevisionedObjectMixin.get_as_of` (and `get_many_as_of`) and of
+`all_revisions` in an LRU cache with a memory budget::
+
+    cache = HistoryCache(metadata, max_bytes=64 * 1024 * 1024)
+    ...
+    cache.as_dict() # statistics
+
+Entries are detached, read-only `RevisionSnapshot` objects (just the column
+values). Each session gets its own ORM instances made from them without a
+query.
+
+Entries of an object are dropped when object revisions are written for it
+(through the ORM, in RevisionerSessionExtension, and again once the
+transaction has committed), by the Repository bulk operations, by
+`Repository.purge_revision` and `revert`, and when the database is cleaned.
+Results are not cached from sessions with uncommitted object revisions, nor
+if they include object revisions still in a history outbox.
+
+NB: only changes made in this process are seen unless a `ChangeCounter`
+(changes.py) is used too, in which case the cache polls it before lookups
+and drops the entries of revision tables changed by other processes.
+'''
+from __future__ import with_statement
+import sys
+import threading
+
+try:
+    from collections import OrderedDict
+except ImportError: # python < 2.7
+    OrderedDict = None
+
+from changes import ChangeCounter
+
+
+class RevisionSnapshot(object):
+    '''Read-only copy of the column values of an object revision.'''
+    __slots__ = ['_values']
+
+    def __init__(self, values):
+        object.__setattr__(self, '_values', dict(values))
+
+    def __getattr__(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('RevisionSnapshot is read only')
+
+    def values(self):
+        '''Get (a copy of) the column values.'''
+        return dict(self._values)
+
+    def __repr__(self):
+        return '<RevisionSnapshot %r>' % self._values
+
+    @classmethod
+    def of(self, revobj):
+        from sqlalchemy.orm import object_mapper
+        table = object_mapper(revobj).mapped_table
+        return self([ (key, getattr(revobj, key)) for key in table.c.keys() ])
+
+
+def _sizeof(value):
+    # rough size in bytes of a cached value
+    if value is None:
+        return 16
+    if isinstance(value, RevisionSnapshot):
+        values = value._values
+        return sys.getsizeof(values) + sum([ sys.getsizeof(item) for item in
+            values.itervalues() ])
+    return sys.getsizeof(value) + sum([ _sizeof(item) for item in value ])
+
+
+class HistoryCache(object):
+    '''LRU cache of object revisions with a memory budget (see module docs).
+
+    There is one cache per metadata (i.e. per vdm database).
+    '''
+    # returned by get when there is nothing cached (None is a valid result)
+    missing = object()
+    # metadata:cache
+    _registry = {}
+    # on sessions: [(revision table, continuity ids), ...] changed in the
+    # current transaction
+    session_attr = '_vdm_history_written'
+
+    def __init__(self, metadata, max_bytes=32*1024*1024):
+        '''
+        @param max_bytes: (rough) limit of memory used by the entries.
+        '''
+        if OrderedDict is None:
+            raise ValueError('HistoryCache needs python 2.7 or later')
+        self.metadata = metadata
+        self.max_bytes = max_bytes
+        self._lock = threading.RLock()
+        # key:(value, size) with least recently used first
+        self._entries = OrderedDict()
+        # (table name, continuity id):set of keys
+        self._by_object = {}
+        # incremented on every invalidation so that results read from the db
+        # before it are not put in the cache after it
+        self.generation = 0
+        self.reset_stats()
+        self.bytes = 0
+        self._registry[metadata] = self
+
+    @classmethod
+    def for_metadata(self, metadata):
+        '''Get the cache used for `metadata` (None if none).'''
+        return self._registry.get(metadata)
+
+    @classmethod
+    def for_table(self, table):
+        '''Get the cache used for revision table `table` (None if none).'''
+        return self._registry.get(table.metadata)
+
+    def close(self):
+        '''Stop using this cache.'''
+        self.clear()
+        if self._registry.get(self.metadata) is self:
+            del self._registry[self.metadata]
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def as_dict(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / float(lookups or 1),
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_as_of(self, revision_table, continuity_id, revision_id):
+        '''Get the cached snapshot of object `continuity_id` as of
+        `revision_id` (None if the object did not exist then, `missing` if
+        not cached).'''
+        self._poll()
+        return self._get((revision_table.name, continuity_id, revision_id))
+
+    def put_as_of(self, revision_table, continuity_id, revision_id, revobj,
+            generation):
+        '''Cache object revision `revobj` (or None) as the one of
+        `continuity_id` as of `revision_id`.
+
+        @param generation: value of `generation` before `revobj` was got.
+        '''
+        if revobj is not None:
+            revobj = RevisionSnapshot.of(revobj)
+        self._put((revision_table.name, continuity_id, revision_id), revobj,
+                generation)
+
+    def get_all_revisions(self, revision_table, continuity_id):
+        '''Get the cached snapshots of all object revisions of
+        `continuity_id` (youngest first) or `missing`.'''
+        self._poll()
+        return self._get((revision_table.name, continuity_id, None))
+
+    def put_all_revisions(self, revision_table, continuity_id, revobjs,
+            generation):
+        snapshots = tuple([ RevisionSnapshot.of(revobj) for revobj in
+            revobjs ])
+        self._put((revision_table.name, continuity_id, None), snapshots,
+                generation)
+
+    def _poll(self):
+        # pick up changes made by other processes
+        counter = ChangeCounter.for_metadata(self.metadata)
+        if counter is not None:
+            counter.poll()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return self.missing
+            # most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def _put(self, key, value, generation):
+        size = _sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size)
+            self._by_object.setdefault(key[:2], set()).add(key)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                oldest = iter(self._entries).next()
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key):
+        value, size = self._entries.pop(key)
+        self.bytes -= size
+        keys = self._by_object.get(key[:2])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_object[key[:2]]
+
+    def cacheable(self, session):
+        '''Can results read in `session` be cached (i.e. it has not changed
+        any object revisions in its current transaction).'''
+        return getattr(session, self.session_attr, None) is None
+
+    def invalidate(self, revision_table, continuity_ids=None, session=None):
+        '''Drop the entries of objects `continuity_ids` of `revision_table`
+        (all its objects if None).
+
+        @param session: session in whose transaction the object revisions
+            were changed: the entries are dropped again when the transaction
+            ends (see `end_transaction`) and until then nothing read in it
+            is cached.
+        '''
+        if session is not None:
+            written = getattr(session, self.session_attr, None)
+            if written is None:
+                written = []
+                setattr(session, self.session_attr, written)
+            written.append((revision_table, continuity_ids))
+        with self._lock:
+            self.generation += 1
+            self.invalidations += 1
+            if continuity_ids is None:
+                objects = [ key for key in self._by_object if key[0] ==
+                        revision_table.name ]
+            else:
+                objects = [ (revision_table.name, id) for id in
+                        continuity_ids ]
+            for obj in objects:
+                for key in list(self._by_object.get(obj, ())):
+                    self._remove(key)
+
+    @classmethod
+    def end_transaction(self, session):
+        '''Drop again the entries invalidated in the transaction of
+        `session` which has just committed or rolled back.'''
+        written = getattr(session, self.session_attr, None)
+        if written is None:
+            return
+        delattr(session, self.session_attr)
+        for revision_table, continuity_ids in written:
+            cache = self.for_table(revision_table)
+            if cache is not None:
+                cache.invalidate(revision_table, continuity_ids)
+
+    def clear(self):
+        '''Drop all entries.'''
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._by_object.clear()
+            self.bytes = 0
+
+
+def _changed_elsewhere(metadata, revision_tables):
+    cache = HistoryCache.for_metadata(metadata)
+    if cache is None:
+        return
+    if revision_tables is None:
+        cache.clear()
+    else:
+        for revision_table in revision_tables:
+            cache.invalidate(revision_table)
+
+ChangeCounter.listeners.append(_changed_elsewhere)
@@ -0,0 +1,285 @@
+'''Asynchronous writing of object revisions via an outbox table.
+
+Normally the object revision (`*_revision` table) rows are written as part of
+the flush which changes the objects. With a `HistoryOutbox` they are instead
+put in an outbox table in the same database (in the same transaction so they
+are just as durable as the change itself) and later moved into the revision
+tables in batches, either by a background `HistoryWorker` thread or by
+calling `HistoryOutbox.flush`::
+
+    outbox = HistoryOutbox(metadata)
+    Session = scoped_session(sessionmaker(
+        extension=RevisionerSessionExtension(history_outbox=outbox)))
+    ...
+    outbox.start()
+
+While rows are pending `RevisionedObjectMixin.get_as_of` and `all_revisions`
+also look in the outbox. Other history queries (e.g. `diff` or querying the
+revision classes directly) only see rows once they have been moved so call
+`flush` (or `wait` when a worker is running) first if you need them.
+'''
+from __future__ import with_statement
+import logging
+import threading
+import time
+
+from sqlalchemy import Table, Column, Integer, UnicodeText, PickleType
+from sqlalchemy import Index, select, and_, bindparam, func
+
+from temporal import has_intervals, close_intervals
+
+logger = logging.getLogger('vdm')
+
+
+def make_outbox_table(metadata, name='revision_outbox'):
+    if name in metadata.tables:
+        return metadata.tables[name]
+    table = Table(name, metadata,
+            Column('id', Integer, primary_key=True),
+            Column('table_name', UnicodeText, nullable=False),
+            Column('continuity_id', UnicodeText, nullable=False),
+            Column('revision_id', UnicodeText, nullable=False),
+            Column('data', PickleType, nullable=False),
+            )
+    Index('idx_%s_continuity' % name, table.c.table_name,
+            table.c.continuity_id)
+    return table
+
+
+class HistoryOutbox(object):
+    '''Outbox table for object revisions plus the means to move them into
+    the revision tables.
+
+    There is one outbox per metadata (i.e. per vdm database).
+    '''
+    # metadata:outbox
+    _registry = {}
+
+    def __init__(self, metadata, bind=None, batch_size=500):
+        '''
+        @param metadata: metadata of the versioned tables. The outbox table is
+            added to it.
+        @param bind: engine to use for moving rows (defaults to the one bound
+            to metadata).
+        @param batch_size: maximum number of rows moved in one transaction.
+        '''
+        self.metadata = metadata
+        self.table = make_outbox_table(metadata)
+        self._bind = bind
+        self.batch_size = batch_size
+        self.worker = None
+        # rows are moved by one thread at a time (per process)
+        self._lock = threading.RLock()
+        self._registry[metadata] = self
+
+    @property
+    def bind(self):
+        return self._bind or self.metadata.bind
+
+    @classmethod
+    def for_metadata(self, metadata):
+        '''Get the outbox used for `metadata` (None if none).'''
+        return self._registry.get(metadata)
+
+    @classmethod
+    def for_table(self, table):
+        '''Get the outbox used for revision table `table` (None if none).'''
+        return self._registry.get(table.metadata)
+
+    def close(self):
+        '''Stop any worker and stop using this outbox.
+
+        NB: rows still pending are left where they are.
+        '''
+        self.stop()
+        if self._registry.get(self.metadata) is self:
+            del self._registry[self.metadata]
+
+    def enqueue(self, flush):
+        '''Put the object revisions of a RevisionerFlush into the outbox.'''
+        for revisioner in flush.revisioners:
+            connection, revisions = flush.revisions[revisioner]
+            table_name = unicode(revisioner.revision_table.name)
+            rows = [ {'table_name': table_name,
+                      'continuity_id': unicode(colvalues['continuity_id']),
+                      'revision_id': colvalues['revision_id'],
+                      'data': colvalues}
+                     for revision, colvalues in revisions ]
+            logger.debug('Queueing %s versions for %s', len(rows), table_name)
+            connection.execute(self.table.insert(), rows)
+        flush.revisions = {}
+        flush.revisioners = []
+
+    def pending(self, connection, revision_table, continuity_id):
+        '''Get object revisions of `continuity_id` not yet moved to
+        `revision_table`.
+
+        @return: dict of column values keyed by revision id (the latest for
+            each revision).
+        '''
+        t = self.table
+        query = select([t.c.revision_id, t.c.data],
+                and_(t.c.table_name == unicode(revision_table.name),
+                     t.c.continuity_id == unicode(continuity_id))
+                ).order_by(t.c.id)
+        results = {}
+        for revision_id, data in connection.execute(query):
+            results[revision_id] = data
+        return results
+
+    def pending_many(self, connection, revision_table, continuity_ids):
+        '''Like `pending` for several objects at once.
+
+        @return: dict of `pending` results keyed by continuity id (only for
+            objects with pending rows).
+        '''
+        t = self.table
+        keys = dict([ (unicode(id), id) for id in continuity_ids ])
+        query = select([t.c.continuity_id, t.c.revision_id, t.c.data],
+                and_(t.c.table_name == unicode(revision_table.name),
+                     t.c.continuity_id.in_(keys.keys()))
+                ).order_by(t.c.id)
+        results = {}
+        for continuity_id, revision_id, data in connection.execute(query):
+            results.setdefault(keys[continuity_id], {})[revision_id] = data
+        return results
+
+    def count(self, connection=None):
+        '''Number of object revisions pending.'''
+        query = select([func.count(self.table.c.id)])
+        return (connection or self.bind).execute(query).scalar()
+
+    def drain(self, connection=None, limit=None):
+        '''Move (at most `limit`) of the oldest pending object revisions into
+        the revision tables.
+
+        @param connection: connection (and hence transaction) to do this in.
+            Pass a session's connection to include rows not yet committed
+            in it. If not given a new transaction is used (and committed).
+        @return: number of outbox rows dealt with.
+        '''
+        with self._lock:
+            if connection is not None:
+                return self._drain(connection, limit)
+            connection = self.bind.connect()
+            try:
+                trans = connection.begin()
+                try:
+                    num = self._drain(connection, limit)
+                    trans.commit()
+                except:
+                    trans.rollback()
+                    raise
+            finally:
+                connection.close()
+            return num
+
+    def _drain(self, connection, limit):
+        t = self.table
+        query = select([t.c.id, t.c.table_name, t.c.data]).order_by(t.c.id).\
+                limit(limit or self.batch_size)
+        rows = connection.execute(query).fetchall()
+        if not rows:
+            return 0
+        # table_name:{(continuity_id, revision_id): colvalues} keeping only
+        # the latest version for each object and revision
+        versions = {}
+        table_names = []
+        for id, table_name, colvalues in rows:
+            if table_name not in versions:
+                versions[table_name] = {}
+                table_names.append(table_name)
+            key = (colvalues['continuity_id'], colvalues['revision_id'])
+            versions[table_name][key] = colvalues
+        for table_name in table_names:
+            revision_table = self.metadata.tables[table_name]
+            existing = and_(
+                revision_table.c.continuity_id == bindparam('_continuity_id'),
+                revision_table.c.revision_id == bindparam('_revision_id'))
+            keys = [ {'_continuity_id': continuity_id,
+                      '_revision_id': revision_id}
+                     for continuity_id, revision_id in versions[table_name] ]
+            connection.execute(revision_table.delete(existing), keys)
+            if has_intervals(revision_table):
+                close_intervals(connection, revision_table,
+                        versions[table_name].values())
+            connection.execute(revision_table.insert(),
+                    versions[table_name].values())
+        connection.execute(t.delete(t.c.id.in_([ row[0] for row in rows ])))
+        logger.debug('Moved %s versions from the outbox', len(rows))
+        return len(rows)
+
+    def flush(self, session=None):
+        '''Move all pending object revisions now.
+
+        @param session: session whose uncommitted object revisions should be
+            included (they are then moved in its transaction).
+        '''
+        if session is not None:
+            connection = session.connection(clause=self.table)
+        else:
+            connection = None
+        total = 0
+        while True:
+            num = self.drain(connection)
+            total += num
+            if num < self.batch_size:
+                return total
+
+    def start(self, interval=0.1):
+        '''Start a background worker moving the pending rows.'''
+        if self.worker is None:
+            self.worker = HistoryWorker(self, interval)
+            self.worker.start()
+        return self.worker
+
+    def stop(self):
+        if self.worker is not None:
+            self.worker.stop()
+            self.worker = None
+
+    def wait(self, timeout=None):
+        '''Wait until all object revisions committed so far have been moved
+        (by the worker if one is running, otherwise right now).
+
+        @return: True if done, False if `timeout` (seconds) passed first.
+        '''
+        if self.worker is None:
+            self.flush()
+            return True
+        t = self.table
+        last = self.bind.execute(select([func.max(t.c.id)])).scalar()
+        if last is None:
+            return True
+        query = select([func.count(t.c.id)], t.c.id <= last)
+        deadline = timeout is not None and time.time() + timeout
+        while self.bind.execute(query).scalar():
+            if deadline and time.time() > deadline:
+                return False
+            time.sleep(self.worker.interval)
+        return True
+
+
+class HistoryWorker(threading.Thread):
+    '''Thread moving object revisions out of a HistoryOutbox.'''
+    def __init__(self, outbox, interval=0.1):
+        threading.Thread.__init__(self, name='vdm-history-worker')
+        self.setDaemon(True)
+        self.outbox = outbox
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.isSet():
+            try:
+                num = self.outbox.drain()
+            except Exception, inst:
+                logger.exception('Error moving versions from outbox: %s', inst)
+                num = 0
+            if num < self.outbox.batch_size:
+                self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+        if self.isAlive() and threading.currentThread() is not self:
+            self.join()
@@ -62,3 +62,36 @@ def copy_table(table, newtable):
     for key in table.c.keys():
         copy_column(key, table, newtable)
 
+
+## --------------------------------------------------------
+## SQL Helpers
+
+from sqlalchemy.sql.expression import Executable, ClauseElement
+from sqlalchemy.ext.compiler import compiles
+
+class InsertFromSelect(Executable, ClauseElement):
+    '''INSERT INTO table (columns) SELECT ...
+
+    (Not supported by sqlalchemy itself before v0.8.)
+
+    @param table: table to insert into.
+    @param columns: names of the columns to insert into (in same order as
+        those of the select).
+    @param select: select statement.
+    '''
+    _execution_options = \
+        Executable._execution_options.union({'autocommit': True})
+
+    def __init__(self, table, columns, select):
+        self.table = table
+        self.columns = columns
+        self.select = select
+
+@compiles(InsertFromSelect)
+def visit_insert_from_select(element, compiler, **kw):
+    return 'INSERT INTO %s (%s) %s' % (
+        compiler.process(element.table, asfrom=True),
+        ', '.join([ compiler.preparer.quote(name, False) for name in
+            element.columns ]),
+        compiler.process(element.select)
+        )
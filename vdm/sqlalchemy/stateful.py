@@ -59,13 +59,374 @@ below. It has the effect of restoring expected behaviour in the above examples
 (further demonstrations can be found in the tests).
 
 
+Indexed Stateful Lists
+======================
+
+Finding the n-th active (or deleted) item of a StatefulList means skipping
+the deleted (or active) items before it. Rather than scan the target list
+each time the StatefulLists over a target share an `ActiveIndex` (a Fenwick
+tree over the active flags of its items) so that positional access takes
+O(log n) and len O(1). The index is kept up to date by the operations on the
+lists and rebuilt when the target changes length or when `state_version`
+(an optional callable, see `StateChanges`) says states may have changed
+outside the lists. add_stateful_m2m sets this up for SQLAlchemy objects so
+that e.g. `pkgtag.delete()` is noticed. Without a state_version, state
+changes made other than through the lists must be followed by a call to
+`refresh` on one of them.
+
+Stateful Sets
+=============
+
+Relations with no meaningful order (tags, groups) can use a `StatefulSet`
+(add_stateful_m2m(..., collection_type='set')) which finds items by their
+identifier in a hash (an `IdentifierIndex` shared by the active and deleted
+sets over a target) so that add, discard and membership take O(1) rather
+than a scan. Adding an item whose identifier has a deleted item undeletes
+that one just as a StatefulList does.
+
+Relations keyed by an attribute of the join objects (an
+attribute_mapped_collection) can use a `StatefulDict`
+(collection_type='dict', key_attr=...). Setting a key which has a deleted
+join object updates and undeletes that one. The keys of active and deleted
+objects are kept in an IdentifierIndex so that len and iteration need not
+look at every object.
+
+Loading Active Join Objects Only
+================================
+
+A stateful m2m reads the whole underlying relation, deleted join objects
+included. With add_stateful_m2m(..., load_active_only=True) the active view
+(and the association proxy) instead reads a viewonly relation loading just
+the join objects with state 'active' (added to the mapper as
+`<basic_m2m_name>_active_rows`) while the full relation is not loaded. The
+deleted view and writes use the full relation (loading it then) so that
+existing deleted join objects are still undeleted rather than duplicated.
+
 TODO: create some proper tests for base_modifier stuff.
 TODO: move stateful material from base.py here?
 '''
+from __future__ import with_statement
 import logging
 logger = logging.getLogger('vdm.stateful')
 
 import itertools
+import threading
+import weakref
+from array import array
+
+
+def _is_active(obj):
+    # object may not exist (e.g. with get_as_of in which case it will be None
+    return not(obj is None) and obj.is_active()
+
+
+class StateChanges(object):
+    '''Counters of changes to the states of a class of stateful objects (and
+    to the collections holding them) for use as a StatefulList
+    state_version.
+
+    Changes known to concern one target collection only move the version of
+    that target (`bump_target`), others the version of all (`bump`).
+    '''
+    def __init__(self):
+        self.count = 0
+        # id(target):[weakref to target, count]
+        self._targets = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, target=None):
+        '''Get the version of `target` (which changes when the state of its
+        items may have changed).'''
+        version = self.count
+        if target is not None:
+            entry = self._targets.get(id(target))
+            if entry is not None and entry[0]() is target:
+                version += entry[1]
+        return version
+
+    def bump(self, *args, **kwargs):
+        '''Note a change which may concern any target.'''
+        with self._lock:
+            self.count += 1
+
+    def bump_target(self, target):
+        '''Note a change to the items of collection `target`.'''
+        key = id(target)
+        with self._lock:
+            entry = self._targets.get(key)
+            if entry is None or entry[0]() is not target:
+                targets = self._targets
+                def forget(ref):
+                    if targets.get(key, [None])[0] is ref:
+                        del targets[key]
+                try:
+                    entry = [weakref.ref(target, forget), 0]
+                except TypeError:
+                    # (e.g. a plain list)
+                    self.count += 1
+                    return
+                self._targets[key] = entry
+            entry[1] += 1
+
+
+class ActiveIndex(object):
+    '''Fenwick (binary indexed) tree over the active flags of the items of
+    a target list, shared by the StatefulLists (active and deleted) over it.
+    '''
+    # (id(target), is_active):index
+    _shared = weakref.WeakValueDictionary()
+
+    def __init__(self, target, is_active, state_version=None):
+        self.target = target
+        self.is_active = is_active
+        self.state_version = state_version
+        self.rebuild()
+
+    @classmethod
+    def shared(self, target, is_active, state_version=None):
+        '''Get the index over `target` (making it if there is none).'''
+        key = (id(target), is_active)
+        index = self._shared.get(key)
+        if index is None or index.target is not target:
+            index = self(target, is_active, state_version)
+            self._shared[key] = index
+        return index
+
+    def rebuild(self):
+        flags = [ self.is_active(item) and 1 or 0 for item in self.target ]
+        self._flags = bytearray(flags)
+        # _tree[i] is the number of active items in target[i-lowbit(i):i]
+        size = len(flags)
+        tree = array('l', [0]) * (size + 1)
+        for ii in range(1, size + 1):
+            tree[ii] += flags[ii-1]
+            parent = ii + (ii & -ii)
+            if parent <= size:
+                tree[parent] += tree[ii]
+        self._tree = tree
+        self.active = sum(flags)
+        self._dirty = False
+        self._seen = self._version()
+
+    def _version(self):
+        if self.state_version is None:
+            return None
+        return self.state_version(self.target)
+
+    def __len__(self):
+        return len(self._flags)
+
+    def check(self):
+        '''Rebuild if the target (or its items) may have changed since the
+        last operation.'''
+        if self._dirty or len(self.target) != len(self._flags) or \
+                self._version() != self._seen:
+            self.rebuild()
+
+    def sync(self):
+        '''Note that the index is up to date (after an operation through
+        the lists).'''
+        if len(self.target) != len(self._flags):
+            self._dirty = True
+        self._seen = self._version()
+
+    def invalidate(self):
+        self._dirty = True
+
+    def count(self, active=True):
+        if active:
+            return self.active
+        return len(self._flags) - self.active
+
+    def find(self, position, active=True):
+        '''Get the target index of the `position`-th (from 0) active (or
+        deleted) item.'''
+        if not 0 <= position < self.count(active):
+            raise IndexError(position)
+        tree = self._tree
+        size = len(self._flags)
+        index = 0
+        remaining = position + 1
+        step = 1
+        while step * 2 <= size:
+            step *= 2
+        while step:
+            node = index + step
+            if node <= size:
+                num = tree[node]
+                if not active:
+                    num = step - num
+                if num < remaining:
+                    index = node
+                    remaining -= num
+            step //= 2
+        return index
+
+    def set(self, index, item):
+        '''Update the flag of target[index] (now `item`).'''
+        flag = self.is_active(item) and 1 or 0
+        change = flag - self._flags[index]
+        if not change:
+            return
+        self._flags[index] = flag
+        self.active += change
+        node = index + 1
+        size = len(self._flags)
+        while node <= size:
+            self._tree[node] += change
+            node += node & -node
+
+    def append(self, item):
+        '''Add the flag of `item` just appended to the target.'''
+        if self._dirty or len(self.target) != len(self._flags) + 1:
+            self._dirty = True
+            return
+        flag = self.is_active(item) and 1 or 0
+        self._flags.append(flag)
+        node = len(self._flags)
+        # sum of the flags this node covers before it
+        total = flag
+        child = node - 1
+        stop = node - (node & -node)
+        while child > stop:
+            total += self._tree[child]
+            child -= child & -child
+        self._tree.append(total)
+        self.active += flag
+
+
+class IdentifierIndex(object):
+    '''Hash of the items of a target collection by identifier, shared by the
+    StatefulSets (active and deleted) over it. For a dict target (as used by
+    StatefulDicts) the identifiers are the keys.
+
+    Unless `is_active` is None (the states seen through a base_modifier
+    cannot be kept) it also counts the identifiers with active and deleted
+    items so that the sets' (and dicts') len is O(1).
+    '''
+    # (id(target), identifier, is_active):index
+    _shared = weakref.WeakValueDictionary()
+
+    def __init__(self, target, identifier, is_active=None,
+            state_version=None):
+        self.target = target
+        self.identifier = identifier
+        self.is_active = is_active
+        self.state_version = state_version
+        self.rebuild()
+
+    @classmethod
+    def shared(self, target, identifier, is_active=None, state_version=None):
+        '''Get the index over `target` (making it if there is none).'''
+        key = (id(target), identifier, is_active)
+        index = self._shared.get(key)
+        if index is None or index.target is not target:
+            index = self(target, identifier, is_active, state_version)
+            self._shared[key] = index
+        return index
+
+    def rebuild(self):
+        # identifier:[item, ...]
+        self._by_key = {}
+        # id(item):active
+        self._flags = {}
+        # active:{identifier:number of items}
+        self._counts = {True: {}, False: {}}
+        self._size = 0
+        if hasattr(self.target, 'iteritems'):
+            for key, item in self.target.iteritems():
+                self.add(item, key)
+        else:
+            for item in self.target:
+                self.add(item)
+        self._dirty = False
+        self._seen = self._version()
+
+    def _version(self):
+        if self.state_version is None:
+            return None
+        return self.state_version(self.target)
+
+    def check(self):
+        '''Rebuild if the target (or its items) may have changed since the
+        last operation.'''
+        if self._dirty or len(self.target) != self._size or \
+                self._version() != self._seen:
+            self.rebuild()
+
+    def sync(self):
+        '''Note that the index is up to date (after an operation through
+        the sets).'''
+        if len(self.target) != self._size:
+            self._dirty = True
+        self._seen = self._version()
+
+    def items(self, key):
+        '''Get the items with identifier `key`.'''
+        return self._by_key.get(key, [])
+
+    def keys(self, active=None):
+        '''Get the identifiers (with active or deleted items unless active is
+        None).'''
+        if active is None:
+            return self._by_key.iterkeys()
+        return self._counts[active].iterkeys()
+
+    def count(self, active=True):
+        '''Get the number of identifiers with active (or deleted) items.'''
+        return len(self._counts[active])
+
+    def add(self, item, key=None):
+        '''Add `item` just added to the target (under `key` for a dict).'''
+        if key is None:
+            key = self.identifier(item)
+        self._by_key.setdefault(key, []).append(item)
+        self._size += 1
+        if self.is_active is not None:
+            flag = bool(self.is_active(item))
+            self._flags[id(item)] = flag
+            self._count(key, flag, 1)
+
+    def remove(self, item, key=None):
+        '''Remove `item` just removed from the target.'''
+        if key is None:
+            key = self.identifier(item)
+        items = self._by_key.get(key, [])
+        for ii, existing in enumerate(items):
+            if existing is item:
+                del items[ii]
+                break
+        else:
+            return
+        if not items:
+            del self._by_key[key]
+        self._size -= 1
+        flag = self._flags.pop(id(item), None)
+        if flag is not None:
+            self._count(key, flag, -1)
+
+    def set(self, item, key=None):
+        '''Update the state of `item` (after it has been deleted or
+        undeleted).'''
+        if self.is_active is None:
+            return
+        flag = bool(self.is_active(item))
+        old = self._flags.get(id(item))
+        if old is None or old == flag:
+            return
+        self._flags[id(item)] = flag
+        if key is None:
+            key = self.identifier(item)
+        self._count(key, old, -1)
+        self._count(key, flag, 1)
+
+    def _count(self, key, flag, change):
+        counts = self._counts[flag]
+        num = counts.get(key, 0) + change
+        if num:
+            counts[key] = num
+        else:
+            del counts[key]
 
 
 class StatefulProxy(object):
@@ -111,9 +472,7 @@ class StatefulProxy(object):
         for argname in extra_args:
             setattr(self, argname, kwargs.get(argname, None))
         if self.is_active is None:
-            # object may not exist (e.g. with get_as_of in which case it will
-            # be None
-            self.is_active = lambda x: not(x is None) and x.is_active()
+            self.is_active = _is_active
         if self.delete is None:
             self.delete = lambda x: x.delete()
         if self.undelete is None:
@@ -155,6 +514,13 @@ class StatefulList(StatefulProxy):
         undelete the existing PackageTag rather than adding this new one. But
         what do we with this pkgtag2? We need to 'get rid of it' so it is not
         committed into the the db.
+
+        @param state_version: callable taking the target and returning a
+            value which changes when the state of its items may have changed
+            other than through this list (see module docs).
+
+        @param indexed: if False do not use an ActiveIndex (always the case
+            with a base_modifier).
         '''
         super(StatefulList, self).__init__(target, **kwargs)
         identifier = kwargs.get('identifier', lambda x: x)
@@ -164,8 +530,38 @@ class StatefulList(StatefulProxy):
         self._identity_map = {}
         for obj in self.target:
             self._add_to_identity_map(obj)
+        self._index = None
+        if kwargs.get('indexed', True) and \
+                kwargs.get('base_modifier') is None:
+            self._index = ActiveIndex.shared(self.target, self.is_active,
+                    kwargs.get('state_version'))
+
+    # whether this list shows active (rather than deleted) items
+    _shows_active = True
+
+    def refresh(self):
+        '''Rebuild the index after items have changed state other than
+        through this list.'''
+        if self._index is not None:
+            self._index.rebuild()
+
+    def _check_index(self):
+        if self._index is not None:
+            self._index.check()
+
+    def _sync_index(self):
+        if self._index is not None:
+            self._index.sync()
 
     def _get_base_index(self, idx):
+        if self._index is not None:
+            self._index.check()
+            if idx < 0:
+                idx += self._index.count(self._shows_active)
+            return self._index.find(idx, self._shows_active)
+        return self._scan_base_index(idx)
+
+    def _scan_base_index(self, idx):
         # if we knew items were unique could do
         # return self.target.index(self[myindex])
         count = -1
@@ -208,6 +604,8 @@ class StatefulList(StatefulProxy):
             # we are about to re-add (in active state) so must remove it first
             idx = self.target.index(out_obj)
             del self.target[idx]
+            if self._index is not None:
+                self._index.invalidate()
             # We now have have to deal with original `obj` that was passed in
             self._unneeded_deleter(obj)
 
@@ -215,10 +613,15 @@ class StatefulList(StatefulProxy):
         return out_obj
 
     def append(self, in_obj):
+        self._check_index()
         obj = self._check_for_existing_on_add(in_obj)
         self.target.append(obj)
+        if self._index is not None:
+            self._index.append(obj)
+            self._index.sync()
 
     def insert(self, index, value):
+        self._check_index()
         # have some choice here so just for go for first place
         our_obj = self._check_for_existing_on_add(value)
         try:
@@ -226,6 +629,9 @@ class StatefulList(StatefulProxy):
         except IndexError: # may be list is empty ...
             baseindex = len(self)
         self.target.insert(baseindex, our_obj)
+        if self._index is not None:
+            self._index.invalidate()
+        self._sync_index()
 
     def __getitem__(self, index):
         baseindex = self._get_base_index(index)
@@ -236,7 +642,12 @@ class StatefulList(StatefulProxy):
     
     def __delitem__(self, index):
         if not isinstance(index, slice):
-            self._delete(self[index])
+            baseindex = self._get_base_index(index)
+            item = self.target[baseindex]
+            self._delete(self.base_modifier(item))
+            if self._index is not None:
+                self._index.set(baseindex, item)
+                self._index.sync()
         else:
             start = index.start
             end = index.stop
@@ -261,7 +672,9 @@ class StatefulList(StatefulProxy):
             step = index.step or 1
 
             rng = range(index.start or 0, stop, step)
-            if step == 1:
+            if step == 1 and not index.start and stop == len(self):
+                self.replace(value)
+            elif step == 1:
                 # delete first then insert to avoid problems with indices and
                 # statefulness
                 for ii in rng:
@@ -280,6 +693,100 @@ class StatefulList(StatefulProxy):
                     for ii, item in zip(rng, value):
                         self[ii] = item
 
+    def replace(self, values, create=None):
+        '''Make `values` the items shown by this list (as `self[:] = values`
+        does) in one pass over the target.
+
+        Items already shown with the identifier of a value are left alone.
+        Otherwise an existing hidden item (e.g. deleted for the active list)
+        with that identifier is shown again and only failing that the value
+        is added (at the end). Shown items not matched by a value are hidden.
+        The shown items are then put in the order of `values` by moving them
+        between the places of shown items in the target (hidden items stay
+        where they are).
+
+        @param create: if given `values` are identifiers and create(key) makes
+            the item to add for one with no existing item.
+        '''
+        self._check_index()
+        target = self.target
+        positions = dict([ (id(item), ii) for ii, item in enumerate(target) ])
+        mapped = set([ id(item) for items in self._identity_map.itervalues()
+            for item in items ])
+        for item in target:
+            # added to the target other than through this list
+            if id(item) not in mapped:
+                self._add_to_identity_map(item)
+        # id:item of the items to show (and the items in the order asked for)
+        wanted = {}
+        order = []
+        new = []
+        for value in values:
+            if create is None:
+                key = self._identifier(value)
+            else:
+                key = value
+            if create is None and id(value) in positions and \
+                    id(value) not in wanted:
+                wanted[id(value)] = value
+                order.append(value)
+                continue
+            candidates = [ item for item in self._identity_map.get(key, [])
+                    if id(item) in positions and id(item) not in wanted ]
+            existing = None
+            for item in candidates:
+                if self._is_active(item):
+                    existing = item
+                    break
+            if existing is None and candidates:
+                existing = candidates[0]
+            if existing is not None:
+                wanted[id(existing)] = existing
+                order.append(existing)
+                if create is None:
+                    self._unneeded_deleter(value)
+            else:
+                if create is not None:
+                    value = create(key)
+                wanted[id(value)] = value
+                order.append(value)
+                new.append(value)
+        for ii, item in enumerate(target):
+            shown = self._is_active(item)
+            if shown and id(item) not in wanted:
+                self._delete(self.base_modifier(item))
+            elif not shown and id(item) in wanted:
+                self._undelete(item)
+            else:
+                continue
+            if self._index is not None:
+                self._index.set(ii, item)
+        for item in new:
+            self._add_to_identity_map(item)
+            self._undelete(item)
+            target.append(item)
+            if self._index is not None:
+                self._index.append(item)
+        self._reorder(order)
+        self._sync_index()
+
+    def _reorder(self, order):
+        # put the shown items in `order` (the flags per position, and so the
+        # index, are unchanged)
+        target = self.target
+        slots = [ ii for ii, item in enumerate(target) if self._is_active(item) ]
+        if [ id(target[ii]) for ii in slots ] == [ id(item) for item in order ]:
+            return
+        reordered = list(target)
+        for ii, item in zip(slots, order):
+            reordered[ii] = item
+        if isinstance(target, list):
+            # the same items so bypass the collection events of instrumented
+            # lists (which would see each item removed and added again)
+            list.__setitem__(target, slice(None), reordered)
+        else:
+            target[:] = reordered
+
     # def __setslice__(self, start, end, values):
     #    for ii in range(start, end):
     #        self[ii] = values[ii-start]
@@ -290,6 +797,9 @@ class StatefulList(StatefulProxy):
         return myiter
     
     def __len__(self):
+        if self._index is not None:
+            self._index.check()
+            return self._index.count(self._shows_active)
         return sum([1 for _ in self])
 
     def count(self, item):
@@ -318,6 +828,174 @@ class StatefulList(StatefulProxy):
 
 
 class StatefulListDeleted(StatefulList):
+    _shows_active = False
+
+    def _set_stateful_operators(self):
+        self._is_active = lambda x: not self.is_active(self.base_modifier(x))
+        self._delete = self.undelete
+        self._undelete = self.delete
+
+
+
+class StatefulSet(StatefulProxy):
+    '''A stateful set showing the active items of the underlying collection
+    (a list or set) with membership by identifier.
+
+    Items are the same if they have the same identifier (as for the identity
+    map of StatefulList) and looked up in an IdentifierIndex.
+    '''
+
+    # so that the sqlalchemy assoc proxy treats us as a set
+    __emulates__ = set
+
+    # whether this set shows active (rather than deleted) items
+    _shows_active = True
+
+    def __init__(self, target, **kwargs):
+        '''Same as for StatefulList (bar indexed) i.e. with the additional
+        kwargs identifier, unneeded_deleter and state_version.'''
+        super(StatefulSet, self).__init__(target, **kwargs)
+        self._identifier = kwargs.get('identifier', lambda x: x)
+        self._unneeded_deleter = kwargs.get('unneeded_deleter',
+                lambda x: None)
+        is_active = self.is_active
+        if kwargs.get('base_modifier') is not None:
+            is_active = None
+        self._index = IdentifierIndex.shared(self.target, self._identifier,
+                is_active, kwargs.get('state_version'))
+
+    def refresh(self):
+        '''Rebuild the index after items have changed state other than
+        through this set.'''
+        self._index.rebuild()
+
+    def _find(self, key, shown=True):
+        # first item with identifier key shown (or not) by this set
+        for item in self._index.items(key):
+            if bool(self._is_active(item)) == shown:
+                return item
+
+    def __contains__(self, item):
+        return self.has_key(self._identifier(item))
+
+    def has_key(self, key):
+        '''Is an item with identifier `key` shown.'''
+        self._index.check()
+        return self._find(key) is not None
+
+    def add(self, item):
+        key = self._identifier(item)
+        existing = self._add_existing(key)
+        if existing is None:
+            self._add_new(item)
+        elif existing is not item:
+            self._unneeded_deleter(item)
+
+    def add_key(self, key, create):
+        '''Show an item with identifier `key` (made with create(key) if there
+        is none).'''
+        if self._add_existing(key) is None:
+            self._add_new(create(key))
+
+    def _add_existing(self, key):
+        # show an existing item with identifier key and return it (None if
+        # there is none)
+        self._index.check()
+        existing = self._find(key)
+        if existing is None:
+            existing = self._find(key, False)
+            if existing is not None:
+                self._undelete(existing)
+                self._index.set(existing)
+                self._index.sync()
+        return existing
+
+    def _add_new(self, item):
+        self._undelete(item)
+        if hasattr(self.target, 'append'):
+            self.target.append(item)
+        else:
+            self.target.add(item)
+        self._index.add(item)
+        self._index.sync()
+
+    def discard(self, item):
+        self.discard_key(self._identifier(item))
+
+    def discard_key(self, key):
+        '''Hide the items with identifier `key` (if any).'''
+        self._index.check()
+        item = self._find(key)
+        while item is not None:
+            self._delete(self.base_modifier(item))
+            self._index.set(item)
+            item = self._find(key)
+        self._index.sync()
+
+    def remove(self, item):
+        if item not in self:
+            raise KeyError(item)
+        self.discard(item)
+
+    def update(self, items):
+        for item in items:
+            self.add(item)
+
+    def replace(self, values, create=None):
+        '''Make `values` the items shown by this set (see
+        StatefulList.replace).'''
+        values = list(values)
+        if create is None:
+            keys = [ self._identifier(value) for value in values ]
+        else:
+            keys = list(values)
+        wanted = set(keys)
+        self._index.check()
+        for key in list(self._index.keys()):
+            if key not in wanted:
+                self.discard_key(key)
+        if create is None:
+            self.update(values)
+        else:
+            for key in keys:
+                self.add_key(key, create)
+
+    def clear(self):
+        self.replace([])
+
+    def pop(self):
+        '''Hide and return an arbitrary shown item.'''
+        self._index.check()
+        if self._index.is_active is not None:
+            keys = self._index.keys(self._shows_active)
+        else:
+            keys = self._index.keys()
+        for key in keys:
+            item = self._find(key)
+            if item is not None:
+                self.discard_key(key)
+                return item
+        raise KeyError('pop from an empty set')
+
+    def __iter__(self):
+        return itertools.ifilter(self._is_active, iter(self.target))
+
+    def __len__(self):
+        self._index.check()
+        if self._index.is_active is not None:
+            return self._index.count(self._shows_active)
+        return sum([ 1 for key in self._index.keys() if self._find(key) is
+            not None ])
+
+    def copy(self):
+        return set(self)
+
+    def __repr__(self):
+        return repr(self.target)
+
+
+class StatefulSetDeleted(StatefulSet):
+    _shows_active = False
 
     def _set_stateful_operators(self):
         self._is_active = lambda x: not self.is_active(self.base_modifier(x))
@@ -328,6 +1006,10 @@ class StatefulListDeleted(StatefulList):
 class StatefulDict(StatefulProxy):
     '''A stateful dictionary which only shows object in underlying dictionary
     which are in active state.
+
+    The keys of active (and deleted) objects are kept in an IdentifierIndex
+    (shared with a StatefulDictDeleted over the same dictionary) so len and
+    iteration do not look at every object.
     '''
 
     # sqlalchemy assoc proxy fails to guess this is a dictionary w/o prompting
@@ -335,6 +1017,24 @@ class StatefulDict(StatefulProxy):
     # method but dicts don't have this method!)
     __emulates__ = dict
 
+    # whether this dict shows active (rather than deleted) objects
+    _shows_active = True
+
+    def __init__(self, target, **kwargs):
+        '''Same as for StatefulProxy but with the additional kwarg
+        state_version (see StatefulList).'''
+        super(StatefulDict, self).__init__(target, **kwargs)
+        is_active = self.is_active
+        if kwargs.get('base_modifier') is not None:
+            is_active = None
+        self._index = IdentifierIndex.shared(self.target, None, is_active,
+                kwargs.get('state_version'))
+
+    def refresh(self):
+        '''Rebuild the index after objects have changed state other than
+        through this dict.'''
+        self._index.rebuild()
+
     def __contains__(self, k):
         return k in self.target and self._is_active(self.target[k])
 
@@ -342,7 +1042,10 @@ class StatefulDict(StatefulProxy):
         # will raise KeyError if not there (which is what we want)
         val = self.target[k]
         if self._is_active(val):
+            self._index.check()
             self._delete(val)
+            self._index.set(val, k)
+            self._index.sync()
         else:
             raise KeyError(k)
         # should we raise KeyError if already deleted?
@@ -355,20 +1058,61 @@ class StatefulDict(StatefulProxy):
             raise KeyError(k)
 
     def __iter__(self):
+        self._index.check()
+        if self._index.is_active is not None:
+            # (a copy as deleting while iterating changes the index)
+            return iter(list(self._index.keys(self._shows_active)))
         myiter = itertools.ifilter(lambda x: self._is_active(self.target[x]),
                 iter(self.target))
         return myiter
 
     def __setitem__(self, k, v):
-        self.target[k] = v
+        self._index.check()
+        old = self.target.get(k)
+        if old is not v:
+            self.target[k] = v
+            if old is not None:
+                self._index.remove(old, k)
+            self._index.add(v, k)
+        if not self._is_active(v):
+            self._undelete(v)
+            self._index.set(v, k)
+        self._index.sync()
+
+    def existing(self, k):
+        '''Get the object under `k` whatever its state (None if none).'''
+        return self.target.get(k)
+
+    def show_key(self, k):
+        '''Show the object under `k` again (i.e. undelete it for the active
+        dict) and return it.'''
+        self._index.check()
+        val = self.target[k]
+        if not self._is_active(val):
+            self._undelete(val)
+            self._index.set(val, k)
+            self._index.sync()
+        return val
 
     def __len__(self):
+        self._index.check()
+        if self._index.is_active is not None:
+            return self._index.count(self._shows_active)
         return sum([1 for _ in self])
 
     def clear(self): 
         for k in self:
             del self[k]
 
+    def replace(self, values):
+        '''Make `values` (a dict) the objects shown by this dict.'''
+        values = dict(values)
+        for k in self:
+            if k not in values:
+                del self[k]
+        for k, v in values.items():
+            self[k] = v
+
     def copy(self):
         # return self.__class__(self.target, base_modifier=self.base_modifier)
         return dict(self)
@@ -400,6 +1144,90 @@ class StatefulDict(StatefulProxy):
         return repr(self.target)
 
 
+class StatefulDictDeleted(StatefulDict):
+    _shows_active = False
+
+    def _set_stateful_operators(self):
+        self._is_active = lambda x: not self.is_active(self.base_modifier(x))
+        self._delete = self.undelete
+        self._undelete = self.delete
+
+
+def _use_full(name):
+    # method calling method `name` of the stateful collection over the full
+    # collection instead (and from then on delegating to that collection)
+    def method(self, *args, **kwargs):
+        full = self._load_full()
+        self._full = full
+        return getattr(full, name)(*args, **kwargs)
+    method.__name__ = name
+    return method
+
+
+class _ActiveRows(object):
+    # once a write has loaded the full collection all attributes (and so
+    # all methods, which only use their instance's attributes) come from
+    # the stateful collection over it
+    _full = None
+
+    def __getattribute__(self, name):
+        full = object.__getattribute__(self, '_full')
+        if full is None or name == '_full':
+            return object.__getattribute__(self, name)
+        return getattr(full, name)
+
+
+class ActiveRowsStatefulList(_ActiveRows, StatefulList):
+    '''StatefulList over a collection of just the active join objects (see
+    add_stateful_m2m load_active_only). Writes go to the StatefulList over
+    the full collection, loaded for them by the `load_full` kwarg, which is
+    used instead from then on.
+    '''
+    def __init__(self, target, **kwargs):
+        super(ActiveRowsStatefulList, self).__init__(target, **kwargs)
+        self._load_full = kwargs['load_full']
+
+    append = _use_full('append')
+    insert = _use_full('insert')
+    extend = _use_full('extend')
+    replace = _use_full('replace')
+    clear = _use_full('clear')
+    __setitem__ = _use_full('__setitem__')
+    __delitem__ = _use_full('__delitem__')
+
+
+class ActiveRowsStatefulSet(_ActiveRows, StatefulSet):
+    '''StatefulSet over a collection of just the active join objects (see
+    ActiveRowsStatefulList).'''
+    def __init__(self, target, **kwargs):
+        super(ActiveRowsStatefulSet, self).__init__(target, **kwargs)
+        self._load_full = kwargs['load_full']
+
+    add = _use_full('add')
+    add_key = _use_full('add_key')
+    update = _use_full('update')
+    discard = _use_full('discard')
+    discard_key = _use_full('discard_key')
+    remove = _use_full('remove')
+    replace = _use_full('replace')
+    clear = _use_full('clear')
+
+
+class ActiveRowsStatefulDict(_ActiveRows, StatefulDict):
+    '''StatefulDict over a collection of just the active join objects (see
+    ActiveRowsStatefulList).'''
+    def __init__(self, target, **kwargs):
+        super(ActiveRowsStatefulDict, self).__init__(target, **kwargs)
+        self._load_full = kwargs['load_full']
+
+    # (deleted ones are only in the full collection)
+    existing = _use_full('existing')
+    show_key = _use_full('show_key')
+    replace = _use_full('replace')
+    clear = _use_full('clear')
+    __setitem__ = _use_full('__setitem__')
+    __delitem__ = _use_full('__delitem__')
+
 
 class DeferredProperty(object):
     def __init__(self, target_collection_name, stateful_class, **kwargs):
@@ -421,26 +1249,128 @@ class DeferredProperty(object):
                 self.target_collection_name, id(self))
 
     def __get__(self, obj, class_):
-        try:
-            # return cached instance
-            return getattr(obj, self.cached_instance_key)
-        except AttributeError:
-            # probably should do this using lazy_collections a la assoc proxy
-            target_collection = getattr(obj, self.target_collection_name)
+        # probably should do this using lazy_collections a la assoc proxy
+        target_collection = getattr(obj, self.target_collection_name)
+        stateful_list = getattr(obj, self.cached_instance_key, None)
+        # return cached instance (unless the collection has been reloaded)
+        if stateful_list is None or \
+                stateful_list.target is not target_collection:
             stateful_list = self.stateful_class(target_collection, **self.cached_kwargs)
             # cache
             setattr(obj, self.cached_instance_key, stateful_list)
-            return stateful_list
+        return stateful_list
 
     def __set__(self, obj, values):
         # Must not replace the StatefulList object with a list,
-        # so instead replace the values in the Stateful list with
-        # the list values passed on. The existing values are accessed
-        # using [:] invoking __setitem__.
-        self.__get__(obj, None)[:] = values
+        # so instead replace the values in the Stateful list (set or dict)
+        # with the values passed on (as [:] = values does).
+        self.__get__(obj, None).replace(values)
         
 
+class ActiveRowsDeferredProperty(DeferredProperty):
+    # (held while adding the relation to a mapper)
+    _lock = threading.Lock()
+
+    def __init__(self, target_collection_name, stateful_class,
+            active_rows_class, load_active_only=True, state_column='state',
+            active_state=None, **kwargs):
+        '''DeferredProperty for the active view of a stateful m2m which,
+        unless the full collection is loaded already, proxies to a viewonly
+        relation loading just the active join objects.
+
+        @param active_rows_class: stateful class to use over these (e.g.
+            ActiveRowsStatefulList).
+        @param load_active_only: True or a function taking the object which
+            says whether to load just the active join objects.
+        @param state_column: name of the state column of the join objects'
+            table.
+        @param active_state: its value for active join objects (defaults to
+            State.ACTIVE).
+        '''
+        super(ActiveRowsDeferredProperty, self).__init__(
+                target_collection_name, stateful_class, **kwargs)
+        self.active_rows_class = active_rows_class
+        self.load_active_only = load_active_only
+        self.state_column = state_column
+        self.active_state = active_state
+        self.active_rows_name = target_collection_name + '_active_rows'
+        self.active_rows_key = self.cached_instance_key + '_active_rows'
+
+    def __get__(self, obj, class_):
+        from sqlalchemy.orm.attributes import instance_state
+        state = instance_state(obj)
+        if state.key is None or self.target_collection_name in state.dict or \
+                not (self.load_active_only is True or
+                    self.load_active_only(obj)):
+            # new object or full collection loaded anyway
+            return super(ActiveRowsDeferredProperty, self).__get__(obj,
+                    class_)
+        if event is None:
+            # (see setup)
+            self.add_relation(type(obj))
+        rows = getattr(obj, self.active_rows_name)
+        stateful_list = getattr(obj, self.active_rows_key, None)
+        if stateful_list is None or stateful_list.target is not rows:
+            kwargs = dict(self.cached_kwargs)
+            kwargs['load_full'] = lambda: super(ActiveRowsDeferredProperty,
+                    self).__get__(obj, None)
+            stateful_list = self.active_rows_class(rows, **kwargs)
+            setattr(obj, self.active_rows_key, stateful_list)
+        return stateful_list
+
+    def setup(self, class_):
+        '''Add the relation loading just the active join objects to the
+        mapper of `class_` now if it is configured, otherwise as soon as it
+        is (with SQLAlchemy before 0.7, which has no mapper events, on first
+        use).'''
+        if event is None:
+            return
+        from sqlalchemy.orm import mapper, class_mapper
+        from sqlalchemy.orm.exc import UnmappedClassError
+        try:
+            configured = class_mapper(class_, compile=False).configured
+        except UnmappedClassError:
+            configured = False
+        if configured:
+            self.add_relation(class_)
+            return
+        def mapper_configured(mapper_, configured_class):
+            if configured_class is class_:
+                self.add_relation(class_)
+        event.listen(mapper, 'mapper_configured', mapper_configured)
+
+    def add_relation(self, class_):
+        '''Add the relation to the mapper of `class_` (unless there).'''
+        from sqlalchemy.orm import class_mapper
+        mapper = class_mapper(class_)
+        if mapper.has_property(self.active_rows_name):
+            return
+        with self._lock:
+            if not mapper.has_property(self.active_rows_name):
+                self._add_relation(mapper)
+
+    def _add_relation(self, mapper):
+        from sqlalchemy import and_
+        from sqlalchemy.orm import relation
+        prop = mapper.get_property(self.target_collection_name)
+        m2m_table = prop.mapper.mapped_table
+        active_state = self.active_state
+        if active_state is None:
+            # (base imports this module)
+            from base import State
+            active_state = State.ACTIVE
+        mapper.add_property(self.active_rows_name, relation(prop.mapper,
+            primaryjoin=and_(prop.primaryjoin,
+                m2m_table.c[self.state_column] == active_state),
+            collection_class=prop.collection_class, viewonly=True))
+
+
 from sqlalchemy import __version__ as sqla_version
+try:
+    from sqlalchemy import event
+except ImportError:
+    # sqlalchemy < 0.7 (see MappedStateChanges)
+    event = None
 import sqlalchemy.ext.associationproxy
 import weakref
 # write our own assoc proxy which excludes scalar support and therefore calls
@@ -449,13 +1379,93 @@ import weakref
 class OurAssociationProxy(sqlalchemy.ext.associationproxy.AssociationProxy):
 
     scalar = False
+
+    def __init__(self, *args, **kwargs):
+        '''
+        @param values_are_identifiers: the values proxied are the identifiers
+            of the items of the StatefulList (so assigning to the proxy only
+            creates items for values not already in it).
+        '''
+        self.values_are_identifiers = kwargs.pop('values_are_identifiers',
+                False)
+        super(OurAssociationProxy, self).__init__(*args, **kwargs)
+
     def _target_is_scalar(self):
         return False
 
+    def __set__(self, obj, values):
+        proxy = self.__get__(obj, None)
+        if proxy is values:
+            return
+        stateful_list = proxy.col
+        if isinstance(stateful_list, StatefulDict):
+            values = dict(values)
+            for key in stateful_list:
+                if key not in values:
+                    del stateful_list[key]
+            for key, value in values.items():
+                proxy[key] = value
+            return
+        if not isinstance(stateful_list, (StatefulList, StatefulSet)):
+            return super(OurAssociationProxy, self).__set__(obj, values)
+        # reconcile rather than clear and add everything again
+        if self.values_are_identifiers:
+            stateful_list.replace(list(values), create=proxy._create)
+        else:
+            stateful_list.replace([ proxy._create(value) for value in values ])
+
+    def _new(self, lazy_collection):
+        proxy = super(OurAssociationProxy, self)._new(lazy_collection)
+        collection = lazy_collection()
+        if self.values_are_identifiers and \
+                isinstance(collection, StatefulSet):
+            proxy = _StatefulAssociationSet(lazy_collection, proxy.creator,
+                    proxy.getter, proxy.setter, self)
+        elif isinstance(collection, StatefulDict):
+            proxy = _StatefulAssociationDict(lazy_collection, proxy.creator,
+                    proxy.getter, proxy.setter, self)
+        return proxy
+
+
+class _StatefulAssociationSet(sqlalchemy.ext.associationproxy._AssociationSet):
+    '''Association set proxy over a StatefulSet whose identifiers are the
+    values proxied (so membership, add and discard are hash lookups).'''
+
+    def __contains__(self, value):
+        return self.col.has_key(value)
+
+    def add(self, value):
+        self.col.add_key(value, self._create)
+
+    def discard(self, value):
+        self.col.discard_key(value)
+
+    def remove(self, value):
+        if value not in self:
+            raise KeyError(value)
+        self.col.discard_key(value)
+
+
+class _StatefulAssociationDict(sqlalchemy.ext.associationproxy._AssociationDict):
+    '''Association dict proxy over a StatefulDict which reuses the (possibly
+    deleted) object already under a key rather than replacing it.'''
+
+    def __setitem__(self, key, value):
+        existing = self.col.existing(key)
+        if existing is None:
+            self.col[key] = self._create(key, value)
+            return
+        if key in self.col and self._get(existing) == value:
+            # unchanged
+            return
+        self._set(existing, key, value)
+        self.col.show_key(key)
+
 
-# TODO: 2009-07-24 support dict collections
 def add_stateful_m2m(object_to_alter, m2m_object, m2m_property_name,
-        attr, basic_m2m_name, **kwargs):
+        attr, basic_m2m_name, collection_type='list', key_attr=None,
+        load_active_only=False, state_column='state', active_state=None,
+        **kwargs):
     '''Attach active and deleted stateful lists along with the association
     proxy based on the active list to original object (object_to_alter).
 
@@ -490,9 +1500,38 @@ def add_stateful_m2m(object_to_alter, m2m_object, m2m_property_name,
 
     @param attr: the name of the attribute on the Join object corresponding to
         the target (e.g. in this case 'license' on PackageLicense).
+    @param collection_type: 'list' (StatefulList), 'set' (StatefulSet, for
+        relations with no meaningful order: licenses is then a set) or 'dict'
+        (StatefulDict, for a relation with an attribute_mapped_collection:
+        licenses is then a dict of the attr values by key).
+    @param key_attr: for a dict, the name of the attribute on the Join object
+        the relation is keyed by.
+    @param load_active_only: if True (or a function taking the object which
+        returns True) licenses_active and licenses only load the active
+        PackageLicenses (see module docs). Needs a state column on the Join
+        object's table.
+    @param state_column: with load_active_only the name of that column.
+    @param active_state: with load_active_only its value for active Join
+        objects (defaults to State.ACTIVE).
     @arg **kwargs: these are passed on to the DeferredProperty.
     '''
+    classes = {
+        'list': (StatefulList, StatefulListDeleted),
+        'set': (StatefulSet, StatefulSetDeleted),
+        'dict': (StatefulDict, StatefulDictDeleted),
+        }
+    if collection_type not in classes:
+        raise ValueError('Unknown collection_type: %r' % collection_type)
+    if collection_type == 'dict' and key_attr is None:
+        raise ValueError('A dict collection_type needs a key_attr')
+    active_class, deleted_class = classes[collection_type]
+    active_rows_classes = {
+        'list': ActiveRowsStatefulList,
+        'set': ActiveRowsStatefulSet,
+        'dict': ActiveRowsStatefulDict,
+        }
     active_name = m2m_property_name + '_active'
+    values_are_identifiers = not 'identifier' in kwargs
     # in the join object (e.g. PackageLicense) the License object accessible by
     # the license attribute will be what we need for our identity map
     if not 'identifier' in kwargs:
@@ -511,25 +1550,152 @@ def add_stateful_m2m(object_to_alter, m2m_object, m2m_property_name,
             if sess: # for tests at least must support obj not being sqlalchemy
                 sess.expunge(obj_to_delete)
         kwargs['unneeded_deleter'] = _f
-
-    active_prop = DeferredProperty(basic_m2m_name, StatefulList, **kwargs)
+    if not 'state_version' in kwargs:
+        kwargs['state_version'] = MappedStateChanges(object_to_alter,
+                m2m_object, basic_m2m_name)
+
+    if load_active_only:
+        active_prop = ActiveRowsDeferredProperty(basic_m2m_name, active_class,
+                active_rows_classes[collection_type], load_active_only,
+                state_column, active_state, **kwargs)
+        active_prop.setup(object_to_alter)
+    else:
+        active_prop = DeferredProperty(basic_m2m_name, active_class, **kwargs)
     deleted_name = m2m_property_name + '_deleted'
-    deleted_prop = DeferredProperty(basic_m2m_name, StatefulListDeleted,
-            **kwargs)
+    deleted_prop = DeferredProperty(basic_m2m_name, deleted_class, **kwargs)
     setattr(object_to_alter, active_name, active_prop)
     setattr(object_to_alter, deleted_name, deleted_prop)
-    create_m2m = make_m2m_creator_for_assocproxy(m2m_object, attr)
+    # record m2m_property_name:(basic_m2m_name, attr) for those who need to
+    # get at the underlying relation (e.g. timetravel.RevisionView)
+    if '__stateful_m2m__' not in object_to_alter.__dict__:
+        object_to_alter.__stateful_m2m__ = {}
+    object_to_alter.__stateful_m2m__[m2m_property_name] = (basic_m2m_name,
+            attr)
+    create_m2m = make_m2m_creator_for_assocproxy(m2m_object, attr, key_attr)
     setattr(object_to_alter, m2m_property_name,
-            OurAssociationProxy(active_name, attr, creator=create_m2m)
+            OurAssociationProxy(active_name, attr, creator=create_m2m,
+                values_are_identifiers=values_are_identifiers)
             )
 
 
-def make_m2m_creator_for_assocproxy(m2m_object, attrname):
+class MappedStateChanges(StateChanges):
+    '''StateChanges counting changes (made through SQLAlchemy) to the state
+    of `m2m_object`s and to the `basic_m2m_name` collections of
+    `object_to_alter`.
+
+    A change to a join object moves the version of the collection of its
+    owner if that can be found without a query (through the many-to-one
+    relation of `m2m_object` to `object_to_alter`), of all collections
+    otherwise.
+
+    The listeners are only added once both classes are mapped (add_stateful_m2m
+    is often called before the mappers are set up). Until then, and always
+    with SQLAlchemy before 0.7 (no event API), every call returns a new value
+    so that indexes are rebuilt.
+    '''
+    def __init__(self, object_to_alter, m2m_object, basic_m2m_name):
+        super(MappedStateChanges, self).__init__()
+        self.object_to_alter = object_to_alter
+        self.m2m_object = m2m_object
+        self.basic_m2m_name = basic_m2m_name
+        # many-to-one relation from m2m_object to object_to_alter (if any)
+        self.owner_attr = None
+        self._listening = False
+
+    def __call__(self, target=None):
+        if not self._listening:
+            self._listen()
+            if not self._listening:
+                self.bump()
+        return super(MappedStateChanges, self).__call__(target)
+
+    def _listen(self):
+        if event is None:
+            return
+        from sqlalchemy.orm import class_mapper
+        from sqlalchemy.orm.exc import UnmappedClassError
+        from sqlalchemy.orm.interfaces import MANYTOONE
+        from sqlalchemy.orm.properties import RelationshipProperty
+        try:
+            m2m_mapper = class_mapper(self.m2m_object)
+            class_mapper(self.object_to_alter)
+        except UnmappedClassError:
+            return
+        owners = [ prop.key for prop in m2m_mapper.iterate_properties
+                if isinstance(prop, RelationshipProperty) and
+                prop.direction is MANYTOONE and
+                issubclass(self.object_to_alter, prop.mapper.class_) ]
+        if len(owners) == 1:
+            self.owner_attr = owners[0]
+        state = getattr(self.m2m_object, 'state', None)
+        if state is not None:
+            event.listen(state, 'set', self.state_set, propagate=True)
+        # states reloaded from the db
+        event.listen(self.m2m_object, 'refresh', self.item_changed,
+                propagate=True)
+        event.listen(self.m2m_object, 'expire', self.item_expired,
+                propagate=True)
+        collection = getattr(self.object_to_alter, self.basic_m2m_name)
+        for name in ['append', 'remove']:
+            event.listen(collection, name, self.collection_changed)
+        self._listening = True
+
+    def state_set(self, target, value, oldvalue, initiator):
+        from sqlalchemy.orm.attributes import instance_state
+        from sqlalchemy.orm.attributes import NO_VALUE, NEVER_SET
+        # the state given to a new object (in its constructor) cannot change
+        # the flags of items already indexed
+        if oldvalue in (NO_VALUE, NEVER_SET) and \
+                instance_state(target).key is None:
+            return
+        self.item_changed(target)
+
+    def item_changed(self, target, *args):
+        from sqlalchemy.orm.attributes import instance_state
+        from sqlalchemy.orm.attributes import PASSIVE_NO_FETCH
+        owner = None
+        if self.owner_attr is not None:
+            state = instance_state(target)
+            impl = state.manager[self.owner_attr].impl
+            owner = impl.get(state, state.dict, passive=PASSIVE_NO_FETCH)
+        if owner is None or not isinstance(owner, self.object_to_alter):
+            # (not set, or not known without a query)
+            self.bump()
+            return
+        collection = instance_state(owner).dict.get(self.basic_m2m_name)
+        # (no index over a collection not loaded)
+        if collection is not None:
+            self.bump_target(collection)
+
+    def item_expired(self, target, attribute_names):
+        # NB: the owner of a fully expired object is not known any more
+        if attribute_names is None:
+            self.bump()
+        elif 'state' in attribute_names:
+            self.item_changed(target)
+
+    def collection_changed(self, target, value, initiator):
+        from sqlalchemy.orm.attributes import instance_state
+        collection = instance_state(target).dict.get(self.basic_m2m_name)
+        if collection is None:
+            self.bump()
+        else:
+            self.bump_target(collection)
+        return value
+
+
+def make_m2m_creator_for_assocproxy(m2m_object, attrname, key_attr=None):
     '''This creates a_creator function for SQLAlchemy associationproxy pattern.
 
     @param m2m_object: the m2m object underlying association proxy.
     @param attrname: the attrname to use for the default object passed in to m2m
+    @param key_attr: for a dict proxy the attrname to use for the key
     '''
+    if key_attr is not None:
+        def create_m2m_by_key(key, value):
+            return m2m_object(**{key_attr: key, attrname: value})
+        return create_m2m_by_key
+
     def create_m2m(foreign, **kw):
         mykwargs = dict(kw)
         mykwargs[attrname] = foreign
@@ -0,0 +1,320 @@
+'''Revision ordering: sequence numbers, revision timestamps and validity
+intervals on object revision tables.
+
+Revision sequence
+-----------------
+
+A revision table made with `make_revision_table(metadata, sequence=True)`
+numbers revisions 1, 2, 3, ... in a seq column as they are created. Revisions
+are then ordered and compared on seq rather than on their timestamps (which
+need not be unique). An object revision table made with
+`make_revisioned_table(table, sequence=True)` gets a copy of it in a
+revision_seq column (indexed with continuity_id) which is then used in
+the same way as revision_timestamp below.
+
+The next number is computed within the INSERT of the revision (as
+max(seq) + 1) so numbers are dense. On databases with sequences (postgres) a
+database sequence is used instead so that concurrent transactions do not
+collide, at the cost of a gap for each rolled back revision. seq is unique
+either way so a number is never reused.
+
+Existing tables can be given the columns with `add_sequence` and
+`refresh_sequence`.
+
+Revision timestamps
+-------------------
+
+A revision table made with `make_revisioned_table(table, timestamps=True)`
+gets a copy of the timestamp of each row's revision in a revision_timestamp
+column (indexed with continuity_id) which Revisioner fills in. As-of and
+history queries then filter and order by it rather than joining with the
+revision table.
+
+Existing revision tables can be given the column with `add_timestamps` and
+`refresh_timestamps`.
+
+Intervals
+---------
+
+A revision table made with `make_revisioned_table(table, intervals=True)`
+gets two extra columns giving the period for which each object revision is
+the current one:
+
+    * valid_from: timestamp of its revision
+    * valid_to: timestamp of the object's next revision (VALID_TO_OPEN for
+      the current version)
+
+which Revisioner keeps up to date as it writes object revisions. The object
+revision as of time T is then the one with valid_from <= T < valid_to, an
+indexed range lookup needing neither a join with the revision table nor a
+sort (see `RevisionedObjectMixin.get_as_of` and `query_as_of`).
+
+Existing revision tables can be given the columns with `add_intervals` (for
+the database) and `refresh_intervals` (to fill them in).
+'''
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, Index, Sequence
+from sqlalchemy import select, and_, func, bindparam
+from sqlalchemy.sql.expression import ColumnElement
+from sqlalchemy.ext.compiler import compiles
+
+# valid_to of current object revisions (rather than NULL so that the range
+# lookup can use an index)
+VALID_TO_OPEN = datetime(9999, 12, 31)
+
+
+class next_seq(ColumnElement):
+    '''SQL expression for the seq of a new revision (see module docs).'''
+    type = Integer()
+
+    def __init__(self, rev_table):
+        self.rev_table = rev_table
+        self.sequence = Sequence('%s_seq_seq' % rev_table.name,
+                metadata=rev_table.metadata)
+
+@compiles(next_seq)
+def _compile_next_seq(element, compiler, **kw):
+    seq = element.rev_table.c.seq
+    query = select([func.coalesce(func.max(seq), 0) + 1])
+    return compiler.process(query.as_scalar())
+
+@compiles(next_seq, 'postgresql')
+def _compile_next_seq_pg(element, compiler, **kw):
+    return "nextval('%s')" % compiler.preparer.format_sequence(
+            element.sequence)
+
+def add_sequence_column(rev_table):
+    '''Add seq column numbering revisions to the revision table.'''
+    rev_table.append_column(Column('seq', Integer,
+        default=next_seq(rev_table), unique=True))
+
+def revision_key(rev_table):
+    '''Get the Revision attribute revisions are ordered by.'''
+    if 'seq' in rev_table.c:
+        return 'seq'
+    return 'timestamp'
+
+def add_revision_seq_column(revision_table):
+    '''Add revision_seq column (and index) to (object) `revision_table`.'''
+    revision_table.append_column(Column('revision_seq', Integer))
+    Index('idx_%s_seq' % revision_table.name,
+            revision_table.c.continuity_id, revision_table.c.revision_seq)
+
+def set_revision_seq(colvalues, revision):
+    '''Set revision_seq of a new object revision.'''
+    assert revision.seq, 'Revision must have a seq'
+    colvalues['revision_seq'] = revision.seq
+
+def revision_order(revision_table):
+    '''Get the column of (object) `revision_table` ordering its rows by
+    revision and the Revision attribute with the corresponding value.
+
+    @return: (column, key) where column is None if the revision table has to
+        be joined to order by revision.
+    '''
+    if 'revision_seq' in revision_table.c:
+        return revision_table.c.revision_seq, 'seq'
+    timestamp = timestamp_column(revision_table)
+    if timestamp is not None:
+        return timestamp, 'timestamp'
+    return None, revision_key(revision_table.metadata.tables['revision'])
+
+def add_timestamp_column(revision_table):
+    '''Add revision_timestamp column (and index) to `revision_table`.'''
+    revision_table.append_column(Column('revision_timestamp', DateTime))
+    Index('idx_%s_timestamp' % revision_table.name,
+            revision_table.c.continuity_id,
+            revision_table.c.revision_timestamp)
+
+def timestamp_column(revision_table):
+    '''Get the column of `revision_table` holding the timestamp of each
+    row's revision (None if it has none).
+
+    NB: valid_from of tables with intervals is such a column.
+    '''
+    for name in ['revision_timestamp', 'valid_from']:
+        if name in revision_table.c:
+            return revision_table.c[name]
+    return None
+
+def set_timestamp(colvalues, revision):
+    '''Set revision_timestamp of a new object revision.'''
+    assert revision.timestamp, 'Revision must have a timestamp'
+    colvalues['revision_timestamp'] = revision.timestamp
+
+def add_interval_columns(revision_table):
+    '''Add valid_from/valid_to columns (and index) to `revision_table`.'''
+    revision_table.append_column(Column('valid_from', DateTime))
+    revision_table.append_column(Column('valid_to', DateTime,
+        default=VALID_TO_OPEN))
+    Index('idx_%s_valid' % revision_table.name,
+            revision_table.c.continuity_id, revision_table.c.valid_from,
+            revision_table.c.valid_to)
+
+def has_intervals(revision_table):
+    return 'valid_to' in revision_table.c
+
+def as_of_clause(revision_table, timestamp):
+    '''Clause selecting the object revisions current at `timestamp`.'''
+    return and_(revision_table.c.valid_from <= timestamp,
+                revision_table.c.valid_to > timestamp)
+
+def set_interval(colvalues, revision):
+    '''Set the interval of a new object revision (as current).'''
+    assert revision.timestamp, 'Revision must have a timestamp'
+    colvalues['valid_from'] = revision.timestamp
+    colvalues['valid_to'] = VALID_TO_OPEN
+
+def close_intervals(connection, revision_table, rows):
+    '''End the interval of the previously current object revisions of the
+    objects in `rows` (column values of new object revisions about to be
+    written).
+
+    Where `rows` has several new object revisions of one object all but the
+    latest are closed here too (i.e. `rows` are changed).
+
+    NB: assumes object revisions of an object are written in the order of
+    their revision timestamps (as they are when changes to it are made
+    through the continuity object).
+    '''
+    # continuity_id:[colvalues, ...]
+    by_object = {}
+    for colvalues in rows:
+        by_object.setdefault(colvalues['continuity_id'], []).append(colvalues)
+    earliest = []
+    for new_versions in by_object.values():
+        new_versions.sort(key=lambda colvalues: colvalues['valid_from'])
+        for older, newer in zip(new_versions, new_versions[1:]):
+            if older['revision_id'] != newer['revision_id']:
+                older['valid_to'] = newer['valid_from']
+        earliest.append(new_versions[0])
+    current = and_(
+            revision_table.c.continuity_id == bindparam('_continuity_id'),
+            revision_table.c.valid_to == VALID_TO_OPEN,
+            revision_table.c.revision_id != bindparam('_revision_id'))
+    upd = revision_table.update(current).values(
+            valid_to=bindparam('_valid_from', type_=DateTime))
+    params = [ {'_continuity_id': colvalues['continuity_id'],
+                '_revision_id': colvalues['revision_id'],
+                '_valid_from': colvalues['valid_from']}
+               for colvalues in earliest ]
+    if params:
+        connection.execute(upd, params)
+
+def set_revision_columns(revision_table, colvalues, revision):
+    '''Set whichever of the columns above (revision_seq, revision_timestamp,
+    valid_from/valid_to) `revision_table` has for the current object revision
+    made in `revision`.'''
+    if 'revision_seq' in revision_table.c:
+        set_revision_seq(colvalues, revision)
+    if 'revision_timestamp' in revision_table.c:
+        set_timestamp(colvalues, revision)
+    if has_intervals(revision_table):
+        set_interval(colvalues, revision)
+
+def _add_columns(connection, revision_table, names, index_name):
+    dialect = connection.dialect
+    preparer = dialect.identifier_preparer
+    for name in names:
+        col = revision_table.c[name]
+        connection.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+            preparer.format_table(revision_table),
+            preparer.format_column(col),
+            col.type.compile(dialect=dialect)))
+    for index in revision_table.indexes:
+        if index.name == index_name:
+            index.create(bind=connection)
+
+def add_sequence(connection, rev_table, revision_tables=()):
+    '''Add the seq column to an existing revision table `rev_table` in the
+    database (and the revision_seq column to `revision_tables`). The tables
+    must have been made with sequence.
+
+    Use `refresh_sequence` afterwards to fill them in.
+    '''
+    _add_columns(connection, rev_table, ['seq'], None)
+    preparer = connection.dialect.identifier_preparer
+    connection.execute('CREATE UNIQUE INDEX %s ON %s (%s)' % (
+        preparer.quote_identifier('idx_%s_seq' % rev_table.name),
+        preparer.format_table(rev_table),
+        preparer.format_column(rev_table.c.seq)))
+    for revision_table in revision_tables:
+        _add_columns(connection, revision_table, ['revision_seq'],
+                'idx_%s_seq' % revision_table.name)
+
+def refresh_sequence(connection, rev_table, revision_tables=()):
+    '''Number all revisions in `rev_table` in the order of their timestamps
+    and copy the numbers to the revision_seq column of `revision_tables`.'''
+    query = select([rev_table.c.id]).order_by(rev_table.c.timestamp,
+            rev_table.c.id)
+    ids = [ row[0] for row in connection.execute(query) ]
+    # clear first as seq is unique
+    connection.execute(rev_table.update().values(seq=None))
+    upd = rev_table.update(rev_table.c.id == bindparam('_id')).values(
+            seq=bindparam('_seq'))
+    chunk_size = 1000
+    for start in range(0, len(ids), chunk_size):
+        connection.execute(upd, [ {'_id': id, '_seq': start + ii + 1}
+            for ii, id in enumerate(ids[start:start+chunk_size]) ])
+    if connection.dialect.supports_sequences:
+        sequence = rev_table.c.seq.default.arg.sequence
+        sequence.create(bind=connection, checkfirst=True)
+        connection.execute(select([func.setval(sequence.name,
+            max(len(ids), 1), len(ids) > 0)]))
+    for revision_table in revision_tables:
+        seq = select([rev_table.c.seq],
+                rev_table.c.id == revision_table.c.revision_id).as_scalar()
+        connection.execute(revision_table.update().values(revision_seq=seq))
+
+def add_timestamps(connection, revision_table):
+    '''Add the revision_timestamp column (and index) to an existing
+    `revision_table` in the database. `revision_table` must have been made
+    with timestamps.
+
+    Use `refresh_timestamps` afterwards to fill it in.
+    '''
+    _add_columns(connection, revision_table, ['revision_timestamp'],
+            'idx_%s_timestamp' % revision_table.name)
+
+def refresh_timestamps(connection, revision_table):
+    '''(Re)set revision_timestamp of all object revisions in
+    `revision_table` from their revisions.'''
+    rev_table = revision_table.metadata.tables['revision']
+    timestamp = select([rev_table.c.timestamp],
+            rev_table.c.id == revision_table.c.revision_id).as_scalar()
+    connection.execute(revision_table.update().values(
+        revision_timestamp=timestamp))
+
+def add_intervals(connection, revision_table):
+    '''Add the interval columns (and index) to an existing `revision_table`
+    in the database. `revision_table` must have been made with intervals.
+
+    Use `refresh_intervals` afterwards to fill them in.
+    '''
+    _add_columns(connection, revision_table, ['valid_from', 'valid_to'],
+            'idx_%s_valid' % revision_table.name)
+
+def refresh_intervals(connection, revision_table, continuity_ids=None):
+    '''(Re)compute the intervals of all object revisions in
+    `revision_table` (or just those of `continuity_ids`) from the timestamps
+    of their revisions.
+    '''
+    rev_table = revision_table.metadata.tables['revision']
+    where = None
+    if continuity_ids is not None:
+        if not continuity_ids:
+            return
+        where = revision_table.c.continuity_id.in_(continuity_ids)
+    valid_from = select([rev_table.c.timestamp],
+            rev_table.c.id == revision_table.c.revision_id).as_scalar()
+    connection.execute(revision_table.update(where).values(
+        valid_from=valid_from))
+    later = revision_table.alias('later')
+    next_from = select([func.min(later.c.valid_from)],
+            and_(later.c.continuity_id == revision_table.c.continuity_id,
+                 later.c.valid_from > revision_table.c.valid_from)
+            ).as_scalar()
+    connection.execute(revision_table.update(where).values(
+        valid_to=func.coalesce(next_from,
+            bindparam('open', VALID_TO_OPEN, type_=DateTime))))
@@ -1,11 +1,18 @@
+from __future__ import with_statement
 import logging
+import os
+import time
+from contextlib import contextmanager
 # logging.basicConfig(level=logging.DEBUG)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('vdm')
 
+import sqlalchemy.event
 from sqlalchemy.orm import object_session, class_mapper
 
 import vdm.sqlalchemy
+from vdm.sqlalchemy.temporal import VALID_TO_OPEN, as_of_clause
+from vdm.sqlalchemy.temporal import timestamp_column
 from demo import *
 
 from sqlalchemy import __version__ as sqav
@@ -14,6 +21,81 @@ if sqav.startswith("0.4"):
 else:
     _clear = Session.expunge_all
     
+
+## Statements sent to the database (one listener for the whole module as
+## listeners cannot be removed in sqlalchemy 0.7)
+
+_capturing = []
+
+def _capture(conn, clauseelement, multiparams, params):
+    for statements, accept in _capturing:
+        if accept is None or accept(clauseelement):
+            statements.append(clauseelement)
+
+sqlalchemy.event.listen(engine, 'before_execute', _capture)
+
+@contextmanager
+def executed_statements(accept=None):
+    '''Collect the statements executed in the block into the list given.
+
+    @param accept: if given only statements for which it is true are kept.
+    '''
+    statements = []
+    _capturing.append((statements, accept))
+    try:
+        yield statements
+    finally:
+        _capturing.pop()
+
+
+## Test-local versioned objects whose revision tables have the optional
+## columns (the demo tables have none of them)
+
+def make_thing_tables(name, **options):
+    table = Table(name, metadata,
+            Column('id', Integer, primary_key=True),
+            Column('name', UnicodeText),
+            Column('title', UnicodeText),
+            )
+    vdm.sqlalchemy.make_table_stateful(table)
+    return table, vdm.sqlalchemy.make_revisioned_table(table, **options)
+
+interval_thing_table, interval_thing_revision_table = make_thing_tables(
+        'interval_thing', intervals=True)
+timestamp_thing_table, timestamp_thing_revision_table = make_thing_tables(
+        'timestamp_thing', timestamps=True)
+
+class Thing(vdm.sqlalchemy.RevisionedObjectMixin,
+        vdm.sqlalchemy.StatefulObjectMixin,
+        vdm.sqlalchemy.SQLAlchemyMixin
+        ):
+    def __init__(self, **kwargs):
+        for k,v in kwargs.items():
+            setattr(self, k, v)
+
+class IntervalThing(Thing):
+    pass
+
+class TimestampThing(Thing):
+    pass
+
+def map_thing(cls, table, revision_table):
+    mapper(cls, table,
+        extension=vdm.sqlalchemy.Revisioner(revision_table)
+        )
+    vdm.sqlalchemy.modify_base_object_mapper(cls, Revision, State)
+    return vdm.sqlalchemy.create_object_version(mapper, cls, revision_table)
+
+IntervalThingRevision = map_thing(IntervalThing, interval_thing_table,
+        interval_thing_revision_table)
+TimestampThingRevision = map_thing(TimestampThing, timestamp_thing_table,
+        timestamp_thing_revision_table)
+
+thing_repo = Repository(metadata, Session,
+        versioned_objects=[Package, License, PackageTag, IntervalThing,
+            TimestampThing]
+        )
+
 class Test_01_SQLAlchemySession:
     @classmethod
     def setup_class(self):
@@ -28,7 +110,9 @@ class Test_01_SQLAlchemySession:
         rev = Revision()
         vdm.sqlalchemy.SQLAlchemySession.set_revision(Session, rev)
         assert vdm.sqlalchemy.SQLAlchemySession.at_HEAD(Session)
-        assert Session.revision is not None
+        # only set on the thread's session
+        assert not hasattr(Session, 'revision')
+        assert Session().revision is not None
         out = vdm.sqlalchemy.SQLAlchemySession.get_revision(Session)
         assert out == rev
         out = vdm.sqlalchemy.SQLAlchemySession.get_revision(Session())
@@ -37,6 +121,46 @@ class Test_01_SQLAlchemySession:
         assert vdm.sqlalchemy.SQLAlchemySession.at_HEAD(Session())
         Session.remove()
 
+    def test_using_revision(self):
+        SQLAlchemySession = vdm.sqlalchemy.SQLAlchemySession
+        rev1 = repo.new_revision()
+        rev2 = Revision()
+        with SQLAlchemySession.using_revision(Session, rev2) as rev:
+            assert rev is rev2
+            assert SQLAlchemySession.get_revision(Session) == rev2
+            assert rev2.id
+        assert SQLAlchemySession.get_revision(Session) == rev1
+        with repo.using_revision() as rev:
+            assert SQLAlchemySession.get_revision(Session) == rev
+            assert rev not in [rev1, rev2]
+        assert SQLAlchemySession.get_revision(Session) == rev1
+        Session.remove()
+
+    def test_revision_per_thread(self):
+        import threading
+        SQLAlchemySession = vdm.sqlalchemy.SQLAlchemySession
+        errors = []
+        start = threading.Event()
+        def worker(ii):
+            start.wait()
+            for jj in range(20):
+                rev = Revision(message=u'%s-%s' % (ii, jj))
+                with SQLAlchemySession.using_revision(Session, rev,
+                        defer_flush=True):
+                    time.sleep(0.001)
+                    out = SQLAlchemySession.get_revision(Session)
+                    if out is not rev:
+                        errors.append((rev.message, out.message))
+            Session.remove()
+        threads = [ threading.Thread(target=worker, args=(ii,)) for ii in
+                range(10) ]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        assert not errors, errors
+
 
 class Test_02_Versioning:
     @classmethod
@@ -411,6 +535,40 @@ class Test_04_StatefulVersioned2:
         self._test_package_tags()
         self._test_tags()
 
+    def test_5_unchanged_links_untouched(self):
+        rev2 = repo.new_revision()
+        newp1 = Session.query(Package).filter_by(name=self.name1).one()
+        t1 = Session.query(Tag).filter_by(name='geo').one()
+        pkgtag1 = newp1.package_tags[0]
+        newp1.tags = [ t1, Tag(name='geo2') ]
+        assert pkgtag1 in Session
+        assert not Session.is_modified(pkgtag1)
+        repo.commit_and_remove()
+
+        self._test_package_tags()
+        self._test_tags()
+        pkgtag1 = Session.query(PackageTag).join('tag').filter(
+                Tag.name == 'geo').one()
+        assert len(pkgtag1.all_revisions) == 1
+        Session.remove()
+
+        # reusing the deleted link
+        rev3 = repo.new_revision()
+        newp1 = Session.query(Package).filter_by(name=self.name1).one()
+        newp1.tags = []
+        repo.commit_and_remove()
+        rev4 = repo.new_revision()
+        newp1 = Session.query(Package).filter_by(name=self.name1).one()
+        t1 = Session.query(Tag).filter_by(name='geo').one()
+        newp1.tags = [ t1 ]
+        repo.commit_and_remove()
+        p1 = Session.query(Package).filter_by(name=self.name1).one()
+        assert [ tag.name for tag in p1.tags ] == ['geo']
+        assert len(p1.package_tags) == 2
+        pkgtag1 = Session.query(PackageTag).join('tag').filter(
+                Tag.name == 'geo').one()
+        assert len(pkgtag1.all_revisions) == 3
+
 
 class Test_05_RevertAndPurge:
 
@@ -474,3 +632,1781 @@ class Test_05_RevertAndPurge:
         pkgrevs = Session.query(PackageRevision).all()
         assert len(pkgrevs) == 2, pkgrevs
 
+
+
+class Test_06_BatchedRevisions:
+    '''Object revisions written by RevisionerSessionExtension at end of flush.
+    '''
+
+    @classmethod
+    def setup_class(self):
+        Session.remove()
+        repo.rebuild_db()
+
+    @classmethod
+    def teardown_class(self):
+        Session.remove()
+        repo.rebuild_db()
+
+    def _make_packages(self, session, prefix):
+        rev = Revision()
+        session.add(rev)
+        vdm.sqlalchemy.SQLAlchemySession.set_revision(session, rev)
+        lic = License(name=prefix + 'lic', open=True)
+        pkgs = [ Package(name=prefix + str(ii), title=u'T', license=lic)
+                 for ii in range(5) ]
+        session.add_all([lic] + pkgs)
+        session.commit()
+        # second flush in same revision updates existing object revisions
+        vdm.sqlalchemy.SQLAlchemySession.set_revision(session, rev)
+        for pkg in pkgs:
+            pkg.title = u'T2'
+        session.commit()
+        return rev
+
+    def _history(self, session, rev):
+        pkgrevs = session.query(PackageRevision).\
+            filter_by(revision_id=rev.id).all()
+        return sorted([ (pr.name[1:], pr.title, pr.state, pr.notes,
+                         pr.license.name[1:]) for pr in pkgrevs ])
+
+    @staticmethod
+    def _revision_writes(clauseelement):
+        # revision table writes (and existence checks) but not the ORM's
+        # loading of object revisions
+        if getattr(clauseelement, 'table', None) is package_revision_table:
+            return True
+        return package_revision_table in getattr(clauseelement, 'froms', []) \
+                and 'count' in str(clauseelement)
+
+    def test_batched_same_as_per_row(self):
+        session = Session()
+        with executed_statements(self._revision_writes) as statements:
+            rev = self._make_packages(session, u'a')
+        batched = self._history(session, rev)
+        # 2 flushes with one insert and one update statement respectively
+        assert len(statements) == 2, statements
+        Session.remove()
+
+        from sqlalchemy.orm import sessionmaker
+        session = sessionmaker(bind=engine, autoflush=True,
+                expire_on_commit=False, autocommit=False)()
+        assert vdm.sqlalchemy.RevisionerSessionExtension.get_flush(session) is None
+        rev = self._make_packages(session, u'b')
+        per_row = self._history(session, rev)
+        session.close()
+        assert len(batched) == 5, batched
+        assert batched == per_row, (batched, per_row)
+
+    def test_no_revision_exists_query(self):
+        session = Session()
+        with executed_statements(self._revision_writes) as statements:
+            rev = self._make_packages(session, u'c')
+        # no count queries as revision knows what has been written for it
+        assert len(statements) == 2, statements
+        assert (package_revision_table.name, session.query(Package).
+                filter_by(name=u'c0').one().id) in rev.written_versions
+        Session.remove()
+
+    def test_revision_from_db(self):
+        session = Session()
+        rev = self._make_packages(session, u'd')
+        Session.remove()
+
+        # revision loaded from db so written versions not known
+        rev = Session.query(Revision).get(rev.id)
+        assert rev.written_versions is None
+        vdm.sqlalchemy.SQLAlchemySession.set_revision(Session, rev)
+        pkg = Session.query(Package).filter_by(name=u'd0').one()
+        pkg.title = u'T3'
+        pkg2 = Session.query(Package).filter_by(name=u'd1').one()
+        Revisioner = vdm.sqlalchemy.Revisioner
+        orig = Revisioner.supports_upsert
+        Revisioner.supports_upsert = lambda self, connection: False
+        try:
+            Session.commit()
+            pkg2.title = u'T3'
+        finally:
+            Revisioner.supports_upsert = orig
+        Session.commit()
+        Session.remove()
+        pkgrevs = Session.query(PackageRevision).\
+            filter_by(revision_id=rev.id).all()
+        assert len(pkgrevs) == 5, pkgrevs
+        titles = sorted([ pr.title for pr in pkgrevs ])
+        assert titles == [u'T2', u'T2', u'T2', u'T3', u'T3'], titles
+
+    def test_update_insert_revisions(self):
+        # the upsert used on postgresql (checked on whatever db this is)
+        session = Session()
+        rev = self._make_packages(session, u'f')
+        rev2 = Revision()
+        session.add(rev2)
+        session.flush()
+        table = package_revision_table
+        pkg = session.query(Package).filter_by(name=u'f0').one()
+        connection = session.connection(mapper=class_mapper(Package))
+        versions = table.select(table.c.continuity_id == pkg.id)
+        existing = dict(connection.execute(versions).fetchone())
+        upserts = [dict(existing, title=u'T5'),
+                dict(existing, title=u'T6', revision_id=rev2.id)]
+        revisioner = vdm.sqlalchemy.Revisioner(table)
+        for ii in range(2):
+            with executed_statements(self._revision_writes) as statements:
+                revisioner._update_insert_revisions(connection, upserts)
+            assert len(statements) == 2, statements
+            out = sorted([ (row.revision_id == rev.id, row.title) for row in
+                connection.execute(versions) ])
+            assert out == [(False, u'T6'), (True, u'T5')], out
+        session.commit()
+        Session.remove()
+
+    def test_rollback(self):
+        session = Session()
+        rev = self._make_packages(session, u'e')
+        vdm.sqlalchemy.SQLAlchemySession.set_revision(session, rev)
+        pkg = session.query(Package).filter_by(name=u'e0').one()
+        pkg.title = u'T4'
+        session.flush()
+        session.rollback()
+        assert rev.written_versions is None
+        Session.remove()
+
+
+class Test_07_ChangeDetection:
+
+    @classmethod
+    def setup_class(self):
+        Session.remove()
+        repo.rebuild_db()
+        rev = repo.new_revision()
+        Session.add(Package(name=u'p1', title=u'T', notes=u'N'))
+        repo.commit_and_remove()
+        self.revisioner = vdm.sqlalchemy.Revisioner(package_revision_table)
+
+    @classmethod
+    def teardown_class(self):
+        Session.remove()
+        repo.rebuild_db()
+
+    def test_revisioned_fields_cached(self):
+        assert Package._revisioned_fields() is Package._revisioned_fields()
+        assert 'revision_id' not in Package.revisioned_fields()
+        assert 'title' in Package.revisioned_fields()
+
+    def test_changed_fields_does_not_load(self):
+        pkg = Session.query(Package).filter_by(name=u'p1').one()
+        assert self.revisioner.changed_fields(pkg) == set()
+        Session.expire(pkg, ['notes'])
+        pkg.title = u'T2'
+        pkg.name = u'p1'
+        assert self.revisioner.changed_fields(pkg) == set(['title'])
+        assert 'notes' not in pkg.__dict__
+        Session.remove()
+
+    def test_changed_fields_new(self):
+        pkg = Package(name=u'p2')
+        Session.add(pkg)
+        assert self.revisioner.changed_fields(pkg) == set(['name'])
+        Session.remove()
+
+    def test_flush_state_released(self):
+        rev = repo.new_revision()
+        pkg = Session.query(Package).filter_by(name=u'p1').one()
+        pkg.title = u'T3'
+        Session.flush()
+        flush = vdm.sqlalchemy.RevisionerSessionExtension.get_flush(Session())
+        assert flush is None, flush
+        repo.commit_and_remove()
+        pkg = Session.query(Package).filter_by(name=u'p1').one()
+        assert len(pkg.all_revisions) == 2
+
+
+class Test_08_DeferredRevisionFlush:
+
+    @classmethod
+    def setup_class(self):
+        Session.remove()
+        repo.rebuild_db()
+
+    @classmethod
+    def teardown_class(self):
+        Session.remove()
+        repo.rebuild_db()
+
+    def test_new_revision(self):
+        rev = repo.new_revision(defer_flush=True)
+        assert rev.id
+        # not yet flushed
+        assert rev in Session.new
+        assert rev.timestamp is None
+        assert vdm.sqlalchemy.SQLAlchemySession.get_revision(Session) == rev
+        Session.remove()
+
+    def test_same_flush(self):
+        rev = repo.new_revision(defer_flush=True)
+        lic = License(name=u'l1')
+        pkg = Package(name=u'deferred', license=lic)
+        Session.add_all([lic, pkg])
+        Session.flush()
+        assert rev not in Session.new
+        assert rev.timestamp
+        assert pkg.revision_id == rev.id
+        repo.commit_and_remove()
+
+        pkg = Session.query(Package).filter_by(name=u'deferred').one()
+        assert pkg.revision.id == rev.id
+        pkgrev = pkg.all_revisions[0]
+        assert pkgrev.revision_id == rev.id
+        assert pkgrev.license.name == u'l1'
+
+
+class Test_09_BulkImport:
+
+    @classmethod
+    def setup_class(self):
+        Session.remove()
+        repo.rebuild_db()
+
+    @classmethod
+    def teardown_class(self):
+        Session.remove()
+        repo.rebuild_db()
+
+    def _history(self, rev):
+        out = []
+        for revcls in [LicenseRevision, PackageRevision, PackageTagRevision]:
+            for objrev in Session.query(revcls).filter_by(revision_id=rev.id):
+                continuity = objrev.continuity
+                # compare all columns except keys (and revision timestamps
+                # and seqs)
+                table = class_mapper(revcls).mapped_table
+                values = [ getattr(objrev, key) for key in table.c.keys() if
+                        not key.endswith('id') and key != 'name' and
+                        not key.startswith('valid_') and
+                        not key.startswith('revision_') ]
+                values.append(objrev.revision_id == continuity.revision_id)
+                if 'revision_seq' in table.c:
+                    values.append(objrev.revision_seq == rev.seq)
+                timestamp = timestamp_column(table)
+                if timestamp is not None:
+                    values.append(getattr(objrev, timestamp.key) ==
+                            rev.timestamp)
+                if revcls is PackageRevision:
+                    values.append(objrev.name[1:])
+                    values.append(objrev.license.name)
+                elif revcls is PackageTagRevision:
+                    values.append((objrev.package.name[1:], objrev.tag.name))
+                out.append(tuple(values))
+        return sorted(out)
+
+    def test_bulk_import(self):
+        rev = repo.new_revision()
+        tag = Tag(name=u'geo')
+        Session.add(tag)
+        Session.flush()
+        keys = repo.bulk_import({
+            License: [ {'name': u'l1', 'open': True} ],
+            })
+        licid = keys[License][0]
+        keys = repo.bulk_import({
+            PackageTag: [ {'package_id': u'bulk-pkg-%s' % ii, 'tag_id': tag.id}
+                for ii in range(3) ],
+            Package: [ {'id': u'bulk-pkg-%s' % ii, 'name': u'abulk%s' % ii,
+                'license_id': licid} for ii in range(3) ],
+            }, chunk_size=2)
+        assert keys[Package] == [ u'bulk-pkg-%s' % ii for ii in range(3) ]
+        assert len(keys[PackageTag]) == 3
+        # objects can be changed through the ORM in the same revision
+        pkg = Session.query(Package).get(u'bulk-pkg-0')
+        pkg.title = u'changed'
+        repo.commit_and_remove()
+        bulk = self._history(rev)
+
+        rev = repo.new_revision()
+        tag = Session.query(Tag).filter_by(name=u'geo').one()
+        lic = License(name=u'l1', open=True)
+        for ii in range(3):
+            pkg = Package(name=u'bbulk%s' % ii, license=lic)
+            Session.add(pkg)
+            pkg.tags.append(tag)
+        Session.flush()
+        pkg = Session.query(Package).filter_by(name=u'bbulk0').first()
+        pkg.title = u'changed'
+        repo.commit_and_remove()
+        orm = self._history(rev)
+        assert len(bulk) == 7, bulk
+        assert bulk == orm, (bulk, orm)
+        pkg = Session.query(Package).get(u'bulk-pkg-1')
+        assert pkg.state == State.ACTIVE
+        assert [ t.name for t in pkg.tags ] == [u'geo']
+        assert len(pkg.all_revisions) == 1
+
+    def test_bulk_import_keys(self):
+        rev = repo.new_revision()
+        Session.flush()
+        last = Session.query(License).order_by(License.id.desc()).first().id
+        rows = [ {'name': u'k%s' % ii} for ii in range(4) ]
+        rows[1]['id'] = last + 100
+        def license_insert(clauseelement):
+            return getattr(clauseelement, 'table', None) is license_table
+        with executed_statements(license_insert) as statements:
+            keys = repo.bulk_import({License: rows})[License]
+        assert keys[1] == last + 100, keys
+        assert len(set(keys)) == 4 and min(keys) > last, keys
+        if engine.dialect.name == 'postgresql':
+            # new keys from the sequence so no single row inserts
+            assert len(statements) == 1, statements
+        else:
+            assert len(statements) == 4, statements
+        repo.commit_and_remove()
+        lic = Session.query(License).get(keys[2])
+        assert lic.name == u'k2'
+        assert len(lic.all_revisions) == 1
+        Session.remove()
+
+
+class Test_10_BulkUpdate:
+
+    @classmethod
+    def setup_class(self):
+        Session.remove()
+        repo.rebuild_db()
+        rev1 = repo.new_revision()
+        self.lic1 = License(name=u'l1')
+        self.lic2 = License(name=u'l2')
+        Session.add_all([self.lic1, self.lic2])
+        for ii in range(4):
+            Session.add(Package(name=u'p%s' % ii, license=self.lic1))
+        Session.flush()
+        self.lic1id = self.lic1.id
+        self.lic2id = self.lic2.id
+        self.rev1_id = rev1.id
+        repo.commit_and_remove()
+
+    @classmethod
+    def teardown_class(self):
+        Session.remove()
+        repo.rebuild_db()
+
+    def test_1_bulk_update(self):
+        rev2 = repo.new_revision()
+        pkg = Session.query(Package).filter_by(name=u'p0').one()
+        pkg.title = u'orm'
+        criterion = Package.name.in_([u'p0', u'p1', u'p2'])
+        num = repo.bulk_update(Package, criterion,
+                {'license_id': self.lic2id})
+        assert num == 3, num
+        # already changed
+        num = repo.bulk_update(Package, Package.name == u'p2',
+                {'license_id': self.lic2id})
+        assert num == 0, num
+        # expired so reloaded
+        assert pkg.license_id == self.lic2id
+        # changes through orm in same revision still work
+        pkg.notes = u'orm'
+        repo.commit_and_remove()
+
+        pkgrevs = Session.query(PackageRevision).\
+            filter_by(revision_id=rev2.id).all()
+        assert len(pkgrevs) == 3, pkgrevs
+        for pkgrev in pkgrevs:
+            assert pkgrev.license_id == self.lic2id
+            assert pkgrev.continuity.revision_id == rev2.id
+            if pkgrev.name == u'p0':
+                assert pkgrev.title == u'orm'
+                assert pkgrev.notes == u'orm'
+
+        rev1 = Session.query(Revision).get(self.rev1_id)
+        pkg = Session.query(Package).filter_by(name=u'p1').one()
+        assert pkg.license.name == u'l2'
+        assert pkg.get_as_of(rev1).license_id == self.lic1id
+        assert len(pkg.all_revisions) == 2
+        pkg = Session.query(Package).filter_by(name=u'p3').one()
+        assert len(pkg.all_revisions) == 1
+        Session.remove()
+
+    def test_2_bulk_delete(self):
+        rev3 = repo.new_revision()
+        num = repo.bulk_delete(Package, Package.name.in_([u'p0', u'p3']))
+        assert num == {Package: 2}, num
+        repo.commit_and_remove()
+        pkg = Session.query(Package).filter_by(name=u'p3').one()
+        assert pkg.state == State.DELETED
+        assert pkg.all_revisions[0].state == State.DELETED
+        assert pkg.all_revisions[0].revision_id == rev3.id
+        assert pkg.all_revisions[1].state == State.ACTIVE
+
+    def test_3_bulk_delete_not_stateful(self):
+        try:
+            repo.bulk_delete(Tag, None)
+        except ValueError:
+            pass
+        else:
+            assert False, 'Should raise ValueError'
+
+    def test_4_bulk_delete_cascade(self):
+        rev4 = repo.new_revision()
+        pkg = Session.query(Package).filter_by(name=u'p1').one()
+        pkg.tags = [Tag(name=u't1'), Tag(name=u't2')]
+        pkg = Session.query(Package).filter_by(name=u'p2').one()
+        pkg.tags = [Tag(name=u't3')]
+        repo.commit_and_remove()
+
+        rev5 = repo.new_revision()
+        criterion = Package.name.in_([u'p1', u'p2'])
+        num = repo.bulk_delete(Package, criterion, cascade=True)
+        assert num == {Package: 2, PackageTag: 3}, num
+        repo.commit_and_remove()
+        pkg = Session.query(Package).filter_by(name=u'p1').one()
+        assert pkg.state == State.DELETED
+        assert len(pkg.tags) == 0
+        assert len(pkg.package_tags) == 2
+        ptrevs = Session.query(PackageTagRevision).\
+            filter_by(revision_id=rev5.id).all()
+        assert len(ptrevs) == 3, ptrevs
+        for ptrev in ptrevs:
+            assert ptrev.state == State.DELETED
+        Session.remove()
+
+        rev6 = repo.new_revision()
+        num = repo.bulk_undelete(Package, criterion, cascade=True)
+        assert num == {Package: 2, PackageTag: 3}, num
+        num = repo.bulk_undelete(Package, criterion, cascade=True)
+        assert num == {Package: 0, PackageTag: 0}, num
+        repo.commit_and_remove()
+        pkg = Session.query(Package).filter_by(name=u'p1').one()
+        assert pkg.state == State.ACTIVE
+        assert len(pkg.tags) == 2
+        rev5 = Session.query(Revision).get(rev5.id)
+        assert len(pkg.get_as_of(rev5).tags) == 0
+
+    def _package_tags(self, name):
+        pkg = Session.query(Package).filter_by(name=name).one()
+        return dict([ (pt.tag.name, pt) for pt in pkg.package_tags ])
+
+    def test_5_bulk_delete_cascade_changed_only(self):
+        repo.new_revision()
+        pkg = Package(name=u'p5')
+        Session.add(pkg)
+        pkg.tags = [ Tag(name=name) for name in [u'c1', u'c2', u'c3'] ]
+        repo.commit_and_remove()
+        repo.new_revision()
+        self._package_tags(u'p5')[u'c1'].state = State.DELETED
+        repo.commit_and_remove()
+
+        criterion = Package.name == u'p5'
+        repo.new_revision()
+        num = repo.bulk_delete(Package, criterion, cascade=True)
+        assert num == {Package: 1, PackageTag: 2}, num
+        repo.commit_and_remove()
+        # undeleted by itself afterwards
+        repo.new_revision()
+        self._package_tags(u'p5')[u'c2'].state = State.ACTIVE
+        repo.commit_and_remove()
+        # the package is deleted already so its tags are left alone
+        repo.new_revision()
+        num = repo.bulk_delete(Package, criterion, cascade=True)
+        assert num == {Package: 0, PackageTag: 0}, num
+        repo.commit_and_remove()
+        states = [ (name, pt.state) for name, pt in
+                sorted(self._package_tags(u'p5').items()) ]
+        assert states == [(u'c1', State.DELETED), (u'c2', State.ACTIVE),
+                (u'c3', State.DELETED)], states
+        Session.remove()
+
+    def test_6_bulk_undelete_cascade_deleted_with(self):
+        rev = repo.new_revision()
+        num = repo.bulk_undelete(Package, Package.name == u'p5',
+                cascade=True)
+        # c1 was deleted before the package, c2 is active
+        assert num == {Package: 1, PackageTag: 1}, num
+        repo.commit_and_remove()
+        pts = self._package_tags(u'p5')
+        assert pts[u'c1'].state == State.DELETED
+        assert pts[u'c2'].state == State.ACTIVE
+        assert pts[u'c3'].state == State.ACTIVE
+        assert pts[u'c3'].revision_id == rev.id
+        Session.remove()
+
+
+class ThreadedEngineFixture:
+    '''Engine and session usable from several threads (an in-memory sqlite
+    db is per thread so a file is used instead).'''
+    extension_args = {}
+    # for the sqlite connection
+    connect_args = {'isolation_level': None}
+
+    @classmethod
+    def setup_class(self):
+        import tempfile
+        from sqlalchemy import create_engine
+        self.dbfile = None
+        self.engine = engine
+        if engine.url.drivername == 'sqlite':
+            fd, self.dbfile = tempfile.mkstemp(suffix='.db')
+            os.close(fd)
+            self.engine = create_engine('sqlite:///%s' % self.dbfile,
+                    connect_args=self.connect_args)
+        Session.remove()
+        repo.rebuild_db()
+        metadata.drop_all(bind=self.engine)
+        metadata.create_all(bind=self.engine)
+        self.Session = scoped_session(sessionmaker(bind=self.engine,
+            autoflush=True, autocommit=False, expire_on_commit=False,
+            extension=vdm.sqlalchemy.RevisionerSessionExtension(
+                **self.extension_args)))
+
+    @classmethod
+    def teardown_class(self):
+        self.Session.remove()
+        if self.dbfile:
+            self.engine.dispose()
+            os.remove(self.dbfile)
+
+
+class Test_11_ConcurrentWriters(ThreadedEngineFixture):
+    '''Many threads writing their own revisions through one ScopedSession.'''
+    nthreads = 8
+    nrevs = 5
+
+    def _write(self, ii, errors):
+        SQLAlchemySession = vdm.sqlalchemy.SQLAlchemySession
+        try:
+            for jj in range(self.nrevs):
+                rev = Revision(message=u'%s-%s' % (ii, jj))
+                with SQLAlchemySession.using_revision(self.Session, rev):
+                    pkg = Package(name=u'pkg-%s-%s' % (ii, jj))
+                    self.Session.add(pkg)
+                    time.sleep(0.001)
+                    self.Session.commit()
+        except Exception, inst:
+            errors.append(inst)
+        self.Session.remove()
+
+    def test_no_cross_talk(self):
+        import threading
+        errors = []
+        threads = [ threading.Thread(target=self._write, args=(ii, errors))
+                for ii in range(self.nthreads) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors, errors
+
+        session = self.Session()
+        revs = session.query(Revision).all()
+        assert len(revs) == self.nthreads * self.nrevs, len(revs)
+        for rev in revs:
+            pkgrevs = session.query(PackageRevision).filter_by(
+                    revision_id=rev.id).all()
+            assert len(pkgrevs) == 1, (rev.message, len(pkgrevs))
+            assert pkgrevs[0].name == u'pkg-%s' % rev.message, \
+                    (rev.message, pkgrevs[0].name)
+            pkg = session.query(Package).get(pkgrevs[0].continuity_id)
+            assert pkg.revision_id == rev.id
+
+
+class Test_12_GroupCommit:
+
+    @classmethod
+    def setup_class(self):
+        Session.remove()
+        repo.rebuild_db()
+        self.repo = Repository(metadata, Session,
+                versioned_objects=[Package, License, PackageTag],
+                group_commit=True, group_commit_size=3,
+                group_commit_wait=60)
+
+    @classmethod
+    def teardown_class(self):
+        Session.remove()
+        repo.rebuild_db()
+
+    def _change(self, name):
+        rev = self.repo.new_revision()
+        rev.message = name
+        Session.add(Package(name=name))
+        return rev, self.repo.commit()
+
+    def test_1_batch(self):
+        self.repo.group_commit_stats.reset()
+        rev1, handle1 = self._change(u'g1')
+        rev2, handle2 = self._change(u'g2')
+        assert handle1.revision == rev1
+        # flushed but not yet committed
+        assert rev1.timestamp and rev2.timestamp
+        assert not handle1.done and not handle2.done
+        rev3, handle3 = self._change(u'g3')
+        assert handle1.durable and handle2.durable and handle3.durable
+        stats = self.repo.group_commit_stats.as_dict()
+        assert stats['batches'] == 1, stats
+        assert stats['revisions'] == 3, stats
+        assert stats['max_batch_size'] == 3, stats
+        assert stats['mean_latency'] >= 0, stats
+        Session.remove()
+
+        # each revision has its own row
+        for rev, name in [(rev1, u'g1'), (rev2, u'g2'), (rev3, u'g3')]:
+            pkg = Session.query(Package).filter_by(name=name).one()
+            assert pkg.revision.id == rev.id
+            assert pkg.revision.message == name
+        assert len(set([rev1.id, rev2.id, rev3.id])) == 3
+        Session.remove()
+
+    def test_2_wait(self):
+        self.repo.group_commit_stats.reset()
+        rev, handle = self._change(u'g4')
+        assert not handle.done
+        assert handle.wait() == rev
+        assert handle.durable
+        assert self.repo.group_commit_stats.as_dict()['max_batch_size'] == 1
+        self.repo.commit_and_remove()
+
+    def test_3_bounded_wait(self):
+        self.repo.group_commit_wait = 0
+        try:
+            rev, handle = self._change(u'g5')
+            assert handle.durable
+        finally:
+            self.repo.group_commit_wait = 60
+        Session.remove()
+
+    def test_4_commit_and_remove(self):
+        rev, handle = self._change(u'g6')
+        assert not handle.done
+        self.repo.commit_and_remove()
+        assert handle.durable
+
+    def test_5_failure(self):
+        rev1, handle1 = self._change(u'g7')
+        self.repo.new_revision()
+        # duplicate name
+        Session.add(Package(name=u'g7'))
+        try:
+            self.repo.commit()
+        except Exception, inst:
+            pass
+        else:
+            assert 0, 'should have failed'
+        assert handle1.done
+        assert not handle1.durable
+        try:
+            handle1.wait()
+        except Exception, inst2:
+            assert inst2 is inst
+        else:
+            assert 0, 'should have raised'
+        Session.remove()
+
+    def test_6_remove(self):
+        from vdm.sqlalchemy.tools import GroupCommitAborted
+        rev, handle = self._change(u'g8')
+        assert not handle.done
+        # pending work is lost
+        Session.remove()
+        assert handle.done
+        assert not handle.durable
+        try:
+            handle.wait(1)
+        except GroupCommitAborted:
+            pass
+        else:
+            assert 0, 'should have raised'
+        Session.remove()
+
+    def test_7_rollback(self):
+        from vdm.sqlalchemy.tools import GroupCommitAborted
+        rev, handle = self._change(u'g9')
+        Session.rollback()
+        assert handle.done
+        assert isinstance(handle.error, GroupCommitAborted)
+        Session.remove()
+
+    def test_8_session_commit(self):
+        rev, handle = self._change(u'g10')
+        # committed directly rather than through the repository
+        Session.commit()
+        assert handle.durable
+        Session.remove()
+
+
+class Test_12_GroupCommitDeadline(ThreadedEngineFixture):
+    '''Groups committed by their timer.'''
+    # (the timer thread uses the session's connection)
+    connect_args = {'isolation_level': None, 'check_same_thread': False}
+
+    @classmethod
+    def setup_class(self):
+        ThreadedEngineFixture.setup_class.im_func(self)
+        self.repo = Repository(metadata, self.Session,
+                versioned_objects=[Package, License, PackageTag],
+                group_commit=True, group_commit_size=10,
+                group_commit_wait=0.2)
+
+    def _change(self, name):
+        self.repo.new_revision()
+        self.Session.add(Package(name=name))
+        return self.repo.commit()
+
+    def test_1_deadline(self):
+        handle = self._change(u'd1')
+        assert not handle.done
+        # committed without the repository being used again
+        handle._durable.wait(5)
+        assert handle.durable
+        self.Session.remove()
+        assert self.Session.query(Package).filter_by(name=u'd1').count() == 1
+        self.Session.remove()
+
+    def test_2_not_while_busy(self):
+        handle = self._change(u'd2')
+        self.repo.new_revision()
+        time.sleep(0.4)
+        # not while a revision is being made ...
+        assert not handle.done
+        self.Session.add(Package(name=u'd3'))
+        handle2 = self.repo.commit()
+        # ... but with it as it is due
+        assert handle.durable and handle2.durable
+        self.Session.remove()
+
+
+class Test_13_HistoryOutbox(ThreadedEngineFixture):
+
+    @classmethod
+    def setup_class(self):
+        from vdm.sqlalchemy.outbox import HistoryOutbox
+        self.outbox = HistoryOutbox(metadata)
+        self.extension_args = {'history_outbox': self.outbox}
+        ThreadedEngineFixture.setup_class.im_func(self)
+        self.outbox._bind = self.engine
+        self.repo = Repository(metadata, self.Session,
+                versioned_objects=[Package, License, PackageTag])
+
+    @classmethod
+    def teardown_class(self):
+        self.outbox.close()
+        ThreadedEngineFixture.teardown_class.im_func(self)
+        metadata.remove(self.outbox.table)
+
+    def _revisions_in_db(self, pkg):
+        table = class_mapper(PackageRevision).mapped_table
+        query = select([table.c.name], table.c.continuity_id == pkg.id)
+        return [ row[0] for row in self.engine.execute(query) ]
+
+    def test_1_pending(self):
+        rev1 = self.repo.new_revision()
+        pkg = Package(name=u'ob1', title=u'one')
+        self.Session.add(pkg)
+        self.repo.commit()
+        rev2 = self.repo.new_revision()
+        pkg.title = u'two'
+        self.repo.commit()
+        # only the continuity row was written
+        assert self._revisions_in_db(pkg) == []
+        assert self.outbox.count() == 2
+
+        allrevs = pkg.all_revisions
+        assert [ r.revision_id for r in allrevs ] == [rev2.id, rev1.id]
+        assert allrevs[0].title == u'two'
+        assert allrevs[1].title == u'one'
+        assert allrevs[0].continuity == pkg
+        assert pkg.get_as_of(rev1).title == u'one'
+        assert pkg.get_as_of(rev2).title == u'two'
+        many = Package.get_many_as_of([pkg], rev1)
+        assert many[pkg.id].title == u'one'
+        # pending versions are not added to the session
+        assert not self.Session.new
+        self.Session.remove()
+
+    def test_2_flush(self):
+        self.outbox.flush()
+        assert self.outbox.count() == 0
+        pkg = self.Session.query(Package).filter_by(name=u'ob1').one()
+        assert sorted(self._revisions_in_db(pkg)) == [u'ob1', u'ob1']
+        allrevs = pkg.all_revisions
+        assert [ r.title for r in allrevs ] == [u'two', u'one']
+        assert pkg.get_as_of(allrevs[1].revision).title == u'one'
+        self.Session.remove()
+
+    def test_3_several_flushes_per_revision(self):
+        rev = self.repo.new_revision()
+        pkg = self.Session.query(Package).filter_by(name=u'ob1').one()
+        pkg.title = u'three'
+        self.Session.flush()
+        pkg.title = u'four'
+        self.repo.commit()
+        assert self.outbox.count() == 2
+        assert pkg.get_as_of(rev).title == u'four'
+        assert len(pkg.all_revisions) == 3
+        self.outbox.flush()
+        assert self.outbox.count() == 0
+        self.Session.remove()
+        pkg = self.Session.query(Package).filter_by(name=u'ob1').one()
+        assert [ r.title for r in pkg.all_revisions ] == \
+                [u'four', u'two', u'one']
+        self.Session.remove()
+
+    def test_4_worker(self):
+        self.outbox.start(interval=0.01)
+        try:
+            self.repo.new_revision()
+            pkg = Package(name=u'ob2', title=u'worker')
+            self.Session.add(pkg)
+            self.repo.commit()
+            assert self.outbox.wait(timeout=10)
+            assert self.outbox.count() == 0
+            assert self._revisions_in_db(pkg) == [u'ob2']
+        finally:
+            self.outbox.stop()
+        self.Session.remove()
+
+    def test_intervals(self):
+        revs = []
+        thing = IntervalThing()
+        self.Session.add(thing)
+        for name in [u'ol1', u'ol2', u'ol3']:
+            revs.append(self.repo.new_revision())
+            thing.name = name
+            self.repo.commit()
+        assert thing.get_as_of(revs[1]).name == u'ol2'
+        # several versions of the object are moved together
+        self.outbox.flush()
+        table = interval_thing_revision_table
+        query = select([table.c.valid_from, table.c.valid_to],
+                table.c.continuity_id == thing.id).order_by(
+                        table.c.valid_from)
+        out = [ tuple(row) for row in self.engine.execute(query) ]
+        froms = [ rev.timestamp for rev in revs ]
+        assert out == zip(froms, froms[1:] + [VALID_TO_OPEN]), out
+        assert thing.get_as_of(revs[1]).name == u'ol2'
+        self.Session.remove()
+
+    def test_5_repository_flushes(self):
+        rev = self.repo.new_revision()
+        pkg = Package(name=u'ob3')
+        self.Session.add(pkg)
+        self.Session.flush()
+        changes = self.repo.list_changes(rev)
+        assert [ p.name for p in changes[Package] ] == [u'ob3']
+        self.repo.commit_and_remove()
+
+
+class Test_14_GetManyAsOf:
+
+    @classmethod
+    def setup_class(self):
+        Session.remove()
+        repo.rebuild_db()
+        self.rev1 = repo.new_revision()
+        self.ids = []
+        for ii in range(5):
+            pkg = Package(name=u'many%s' % ii, title=u'1')
+            Session.add(pkg)
+        repo.commit()
+        self.ids = [ pkg.id for pkg in Session.query(Package).
+            order_by(Package.name) ]
+        self.rev2 = repo.new_revision()
+        for pkg in Session.query(Package).filter(Package.id.in_(self.ids[:2])):
+            pkg.title = u'2'
+        Session.add(Package(name=u'many5', title=u'2'))
+        repo.commit()
+        self.ids.append(Session.query(Package).filter_by(name=u'many5').one().id)
+        self.rev3 = repo.new_revision()
+        pkg = Session.query(Package).get(self.ids[0])
+        pkg.title = u'3'
+        repo.commit_and_remove()
+
+    @classmethod
+    def teardown_class(self):
+        Session.remove()
+        repo.rebuild_db()
+
+    def test_same_as_get_as_of(self):
+        for rev in [self.rev1, self.rev2, self.rev3]:
+            rev = Session.query(Revision).get(rev.id)
+            out = Package.get_many_as_of(self.ids, rev, session=Session())
+            assert sorted(out.keys()) == sorted(self.ids)
+            for id in self.ids:
+                pkg = Session.query(Package).get(id)
+                expected = pkg.get_as_of(rev)
+                if expected is None:
+                    assert out[id] is None, (id, out[id])
+                else:
+                    assert out[id].revision_id == expected.revision_id
+                    assert out[id].title == expected.title
+        Session.remove()
+
+    def test_missing(self):
+        rev1 = Session.query(Revision).get(self.rev1.id)
+        out = Package.get_many_as_of(self.ids + [u'missing'], rev1,
+                session=Session())
+        assert out[u'missing'] is None
+        # created after rev1
+        assert out[self.ids[5]] is None
+        assert out[self.ids[0]].title == u'1'
+        Session.remove()
+
+    def test_one_query(self):
+        pkgs = Session.query(Package).all()
+        rev2 = Session.query(Revision).get(self.rev2.id)
+        with executed_statements() as statements:
+            out = Package.get_many_as_of(pkgs, rev2)
+        # one for the revisions of the objects and one for the only object
+        # changed since rev2
+        assert len(statements) == 2, statements
+        assert out[self.ids[0]].title == u'2'
+        assert out[self.ids[3]].title == u'1'
+        assert out[self.ids[5]].title == u'2'
+
+        ids = [ pkg.id for pkg in pkgs ]
+        vdm.sqlalchemy.SQLAlchemySession.clear_as_of_cache(Session)
+        # (not possible with just ids)
+        with executed_statements() as statements:
+            out = Package.get_many_as_of(ids, rev2, session=Session(),
+                    chunk_size=4)
+        assert len(statements) == 2, statements
+        assert len(out) == 6
+        assert out[self.ids[5]].title == u'2'
+        Session.remove()
+
+    def test_unchanged(self):
+        pkgs = Session.query(Package).all()
+        rev2 = Session.query(Revision).get(self.rev2.id)
+        Package.as_of_stats.reset()
+        out = Package.get_many_as_of(pkgs, rev2)
+        assert Package.as_of_stats.as_dict()['unchanged'] == 5
+        assert Package.as_of_stats.as_dict()['queried'] == 1
+        # the same object revisions as from the db
+        vdm.sqlalchemy.SQLAlchemySession.clear_as_of_cache(Session)
+        for pkg in pkgs:
+            assert out[pkg.id] is pkg.get_as_of(rev2)
+        assert Package.as_of_stats.as_dict()['unchanged'] == 10
+        Session.expunge_all()
+        for id in self.ids:
+            expected = Session.query(PackageRevision).filter_by(
+                    continuity_id=id, revision_id=out[id].revision_id).one()
+            for col in package_revision_table.c:
+                assert getattr(out[id], col.key) == \
+                        getattr(expected, col.key), col
+        Session.remove()
+
+    def test_unchanged_not_used(self):
+        rev3 = Session.query(Revision).get(self.rev3.id)
+        pkg = Session.query(Package).get(self.ids[0])
+        Package.as_of_stats.reset()
+        # values not loaded
+        Session.expire(pkg, ['title'])
+        assert pkg.get_as_of(rev3).title == u'3'
+        assert Package.as_of_stats.as_dict()['unchanged'] == 0
+        assert Package.as_of_stats.as_dict()['queried'] == 1
+        Session.remove()
+
+    def test_head(self):
+        pkgs = Session.query(Package).all()
+        out = Package.get_many_as_of(pkgs)
+        assert out[self.ids[0]] is Session.query(Package).get(self.ids[0])
+        Session.remove()
+
+    def test_needs_session(self):
+        try:
+            Package.get_many_as_of(self.ids, self.rev1)
+        except ValueError:
+            pass
+        else:
+            assert 0, 'should raise'
+
+
+class Test_15_Intervals:
+    '''Object revisions with valid_from/valid_to intervals.'''
+
+    @classmethod
+    def setup_class(self):
+        Session.remove()
+        repo.rebuild_db()
+        self.revs = []
+        thing = None
+        for name in [u'i1', u'i2', u'i3']:
+            rev = repo.new_revision()
+            if thing is None:
+                thing = IntervalThing()
+                Session.add(thing)
+            thing.name = name
+            repo.commit()
+            self.revs.append(rev)
+        self.thingid = thing.id
+        Session.remove()
+
+    @classmethod
+    def teardown_class(self):
+        Session.remove()
+        repo.rebuild_db()
+
+    def _intervals(self):
+        table = interval_thing_revision_table
+        query = select([table.c.revision_id, table.c.valid_from,
+            table.c.valid_to], table.c.continuity_id == self.thingid).\
+                    order_by(table.c.valid_from)
+        return [ tuple(row) for row in engine.execute(query) ]
+
+    def _expected(self, revs):
+        revs = [ Session.query(Revision).get(rev.id) for rev in revs ]
+        froms = [ rev.timestamp for rev in revs ]
+        tos = froms[1:] + [VALID_TO_OPEN]
+        return zip([ rev.id for rev in revs ], froms, tos)
+
+    def test_1_written(self):
+        assert self._intervals() == self._expected(self.revs)
+        Session.remove()
+
+    def test_2_get_as_of(self):
+        thing = Session.query(IntervalThing).get(self.thingid)
+        for rev, name in zip(self.revs, [u'i1', u'i2', u'i3']):
+            rev = Session.query(Revision).get(rev.id)
+            assert thing.get_as_of(rev).name == name
+            assert IntervalThing.get_many_as_of([thing], rev)[thing.id].name \
+                    == name
+        query = IntervalThing.query_as_of(Session(), rev)
+        # range lookup only
+        assert 'JOIN' not in str(query), str(query)
+        assert 'ORDER BY' not in str(query), str(query)
+        assert [ t.name for t in query ] == [u'i3']
+        Session.remove()
+
+    def test_3_refresh(self):
+        from vdm.sqlalchemy.temporal import refresh_intervals
+        engine.execute(interval_thing_revision_table.update().values(
+            valid_from=None, valid_to=None))
+        refresh_intervals(engine, interval_thing_revision_table)
+        assert self._intervals() == self._expected(self.revs)
+
+    def test_4_bulk_update(self):
+        rev = repo.new_revision()
+        repo.bulk_update(IntervalThing, None, {'name': u'i4'})
+        repo.commit_and_remove()
+        self.revs.append(rev)
+        assert self._intervals() == self._expected(self.revs)
+
+    def test_5_purge(self):
+        rev = Session.query(Revision).get(self.revs.pop().id)
+        thing_repo.purge_revision(rev)
+        assert self._intervals() == self._expected(self.revs)
+        thing = Session.query(IntervalThing).get(self.thingid)
+        assert thing.name == u'i3'
+        Session.remove()
+
+    def test_6_migration(self):
+        # existing revision table without the interval columns
+        from sqlalchemy import create_engine
+        from vdm.sqlalchemy.temporal import add_intervals, refresh_intervals
+        old_engine = create_engine('sqlite://')
+        old_meta = MetaData()
+        revision = vdm.sqlalchemy.make_revision_table(old_meta)
+        thing = Table('thing', old_meta, Column('id', Integer,
+            primary_key=True), Column('name', UnicodeText))
+        old_thing_revision = vdm.sqlalchemy.make_revisioned_table(thing)
+        old_meta.create_all(bind=old_engine)
+        new_meta = MetaData()
+        vdm.sqlalchemy.make_revision_table(new_meta)
+        new_thing = Table('thing', new_meta, Column('id', Integer,
+            primary_key=True), Column('name', UnicodeText))
+        thing_revision = vdm.sqlalchemy.make_revisioned_table(new_thing,
+                intervals=True)
+
+        conn = old_engine.connect()
+        times = [ datetime(2011, 1, day) for day in [1, 2, 3] ]
+        for ii, timestamp in enumerate(times):
+            conn.execute(revision.insert(), id=u'r%s' % ii,
+                    timestamp=timestamp)
+        conn.execute(thing.insert(), id=1, name=u'c', revision_id=u'r2')
+        conn.execute(thing.insert(), id=2, name=u'b', revision_id=u'r1')
+        for ii, name in enumerate([u'a', u'b', u'c']):
+            conn.execute(old_thing_revision.insert(), id=1, continuity_id=1,
+                    name=name, revision_id=u'r%s' % ii)
+        conn.execute(old_thing_revision.insert(), id=2, continuity_id=2,
+                name=u'b', revision_id=u'r1')
+
+        add_intervals(conn, thing_revision)
+        refresh_intervals(conn, thing_revision)
+        query = select([thing_revision.c.continuity_id,
+            thing_revision.c.revision_id, thing_revision.c.valid_from,
+            thing_revision.c.valid_to]).order_by(
+                    thing_revision.c.continuity_id,
+                    thing_revision.c.valid_from)
+        out = [ tuple(row) for row in conn.execute(query) ]
+        assert out == [
+            (1, u'r0', times[0], times[1]),
+            (1, u'r1', times[1], times[2]),
+            (1, u'r2', times[2], VALID_TO_OPEN),
+            (2, u'r1', times[1], VALID_TO_OPEN),
+            ], out
+        query = select([thing_revision.c.name],
+                as_of_clause(thing_revision, datetime(2011, 1, 2, 12)))
+        assert sorted([ row[0] for row in conn.execute(query) ]) == \
+                [u'b', u'b']
+        conn.close()
+
+
+class Test_16_RevisionTimestamps:
+    '''Object revisions with a copy of their revision's timestamp.'''
+
+    @classmethod
+    def setup_class(self):
+        Session.remove()
+        repo.rebuild_db()
+        self.revs = []
+        for title in [u't1', u't2', u't3']:
+            self.revs.append(repo.new_revision())
+            thing = Session.query(TimestampThing).filter_by(name=u'ts').first()
+            if thing is None:
+                thing = TimestampThing(name=u'ts')
+                Session.add(thing)
+            thing.title = title
+            repo.commit()
+        self.revs.append(repo.new_revision())
+        repo.bulk_update(TimestampThing, None, {'title': u't4'})
+        repo.commit_and_remove()
+
+    @classmethod
+    def teardown_class(self):
+        Session.remove()
+        repo.rebuild_db()
+
+    def test_1_written(self):
+        thing = Session.query(TimestampThing).filter_by(name=u'ts').one()
+        for thingrev in thing.all_revisions_unordered:
+            assert thingrev.revision_timestamp == thingrev.revision.timestamp
+        assert len(thing.all_revisions) == 4
+        Session.remove()
+
+    def test_2_no_join(self):
+        thing = Session.query(TimestampThing).filter_by(name=u'ts').one()
+        revs = [ Session.query(Revision).get(rev.id) for rev in self.revs ]
+        for rev, title in zip(revs[:-1], [u't1', u't2', u't3']):
+            with executed_statements() as statements:
+                out = thing.get_as_of(rev)
+            assert out.title == title
+            assert len(statements) == 1, statements
+            assert 'revision.timestamp' not in str(statements[0]), statements
+        # unchanged since
+        with executed_statements() as statements:
+            out = thing.get_as_of(revs[-1])
+        assert out.title == u't4'
+        assert not statements, statements
+        with executed_statements() as statements:
+            out = TimestampThing.get_many_as_of([thing], revs[1])
+        assert out[thing.id].title == u't2'
+        assert 'revision.timestamp' not in str(statements[0]), statements
+        with executed_statements() as statements:
+            out = thing.all_revisions
+        assert [ r.title for r in out ] == [u't4', u't3', u't2', u't1']
+        # no revisions loaded to sort them
+        assert len(statements) == 1, statements
+        diff = thing.diff(revs[2], revs[0])
+        assert 't3' in diff['title'], diff
+        Session.remove()
+
+    def test_3_purge(self):
+        rev = Session.query(Revision).get(self.revs[-1].id)
+        thing_repo.purge_revision(rev)
+        thing = Session.query(TimestampThing).filter_by(name=u'ts').one()
+        assert thing.title == u't3'
+        Session.remove()
+
+    def test_4_migration(self):
+        from sqlalchemy import create_engine
+        from vdm.sqlalchemy.temporal import add_timestamps, refresh_timestamps
+        old_engine = create_engine('sqlite://')
+        old_meta = MetaData()
+        revision = vdm.sqlalchemy.make_revision_table(old_meta)
+        thing = Table('thing', old_meta, Column('id', Integer,
+            primary_key=True), Column('name', UnicodeText))
+        old_thing_revision = vdm.sqlalchemy.make_revisioned_table(thing)
+        old_meta.create_all(bind=old_engine)
+        new_meta = MetaData()
+        vdm.sqlalchemy.make_revision_table(new_meta)
+        new_thing = Table('thing', new_meta, Column('id', Integer,
+            primary_key=True), Column('name', UnicodeText))
+        thing_revision = vdm.sqlalchemy.make_revisioned_table(new_thing,
+                timestamps=True)
+
+        conn = old_engine.connect()
+        times = [ datetime(2011, 1, day) for day in [1, 2] ]
+        for ii, timestamp in enumerate(times):
+            conn.execute(revision.insert(), id=u'r%s' % ii,
+                    timestamp=timestamp)
+            conn.execute(old_thing_revision.insert(), id=1, continuity_id=1,
+                    name=u'n', revision_id=u'r%s' % ii)
+        add_timestamps(conn, thing_revision)
+        refresh_timestamps(conn, thing_revision)
+        query = select([thing_revision.c.revision_id,
+            thing_revision.c.revision_timestamp]).order_by(
+                    thing_revision.c.revision_id)
+        out = [ tuple(row) for row in conn.execute(query) ]
+        assert out == [(u'r0', times[0]), (u'r1', times[1])], out
+        conn.close()
+
+
+class Test_17_RevisionSequence:
+    '''Numbering the revisions of existing tables (the ORM with a seq is in
+    test_sequence.py as the demo revision table has none).'''
+
+    def test_migration(self):
+        from sqlalchemy import create_engine
+        from vdm.sqlalchemy.temporal import add_sequence, refresh_sequence
+        old_engine = create_engine('sqlite://')
+        old_meta = MetaData()
+        old_revision = vdm.sqlalchemy.make_revision_table(old_meta)
+        thing = Table('thing', old_meta, Column('id', Integer,
+            primary_key=True), Column('name', UnicodeText))
+        old_thing_revision = vdm.sqlalchemy.make_revisioned_table(thing)
+        old_meta.create_all(bind=old_engine)
+        new_meta = MetaData()
+        revision = vdm.sqlalchemy.make_revision_table(new_meta, sequence=True)
+        new_thing = Table('thing', new_meta, Column('id', Integer,
+            primary_key=True), Column('name', UnicodeText))
+        thing_revision = vdm.sqlalchemy.make_revisioned_table(new_thing,
+                sequence=True)
+
+        conn = old_engine.connect()
+        times = [ datetime(2011, 1, day) for day in [2, 1] ]
+        for ii, timestamp in enumerate(times):
+            conn.execute(old_revision.insert(), id=u'r%s' % ii,
+                    timestamp=timestamp)
+            conn.execute(old_thing_revision.insert(), id=1, continuity_id=1,
+                    name=u'n', revision_id=u'r%s' % ii)
+        add_sequence(conn, revision, [thing_revision])
+        refresh_sequence(conn, revision, [thing_revision])
+        query = select([thing_revision.c.revision_id,
+            thing_revision.c.revision_seq]).order_by(
+                    thing_revision.c.revision_id)
+        out = [ tuple(row) for row in conn.execute(query) ]
+        assert out == [(u'r0', 2), (u'r1', 1)], out
+        # new revisions carry on from there
+        conn.execute(revision.insert(), id=u'r2', timestamp=datetime.now())
+        seq = conn.execute(select([revision.c.seq],
+            revision.c.id == u'r2')).scalar()
+        assert seq == 3, seq
+        conn.close()
+
+
+class Test_18_RevisionView:
+    '''Walking objects as of a revision with a RevisionView.'''
+
+    @classmethod
+    def setup_class(self):
+        Session.remove()
+        repo.rebuild_db()
+        self.rev1 = repo.new_revision()
+        lic1 = License(name=u'view-l1')
+        lic2 = License(name=u'view-l2')
+        tags = [ Tag(name=u'view-t%s' % ii) for ii in range(3) ]
+        for ii in range(10):
+            pkg = Package(name=u'view%s' % ii, license=lic1)
+            Session.add(pkg)
+            pkg.tags = tags[:2]
+        Session.add(lic2)
+        repo.commit()
+        self.rev2 = repo.new_revision()
+        lic1.name = u'view-l1-renamed'
+        for pkg in Session.query(Package):
+            pkg.license = lic2
+            pkg.tags = tags[1:]
+        repo.commit_and_remove()
+
+    @classmethod
+    def teardown_class(self):
+        Session.remove()
+        repo.rebuild_db()
+
+    def _walk(self, revision):
+        with vdm.sqlalchemy.RevisionView(Session, revision) as view:
+            return sorted([ (pkg.name, pkg.license.name,
+                sorted([ tag.name for tag in pkg.tags ]))
+                for pkg in view.find(Package) ])
+
+    def test_walk(self):
+        rev1 = Session.query(Revision).get(self.rev1.id)
+        with executed_statements() as statements:
+            out = self._walk(rev1)
+        assert len(out) == 10, out
+        assert out[0] == (u'view0', u'view-l1', [u'view-t0', u'view-t1']), out
+        # packages, licenses, package tags and tags
+        assert len(statements) == 4, statements
+
+        rev2 = Session.query(Revision).get(self.rev2.id)
+        out = self._walk(rev2)
+        assert out[0] == (u'view0', u'view-l2', [u'view-t1', u'view-t2']), out
+        assert vdm.sqlalchemy.SQLAlchemySession.at_HEAD(Session)
+        Session.remove()
+
+    def test_m2m_state(self):
+        rev2 = Session.query(Revision).get(self.rev2.id)
+        with vdm.sqlalchemy.RevisionView(Session, rev2) as view:
+            pkg = view.find(Package, PackageRevision.name == u'view3')[0]
+            assert len(pkg.tags_active) == 2
+            assert [ pkgtag.tag.name for pkgtag in pkg.tags_deleted ] == \
+                    [u'view-t0']
+            assert len(pkg.package_tags) == 3
+        Session.remove()
+
+    def test_identity(self):
+        rev1 = Session.query(Revision).get(self.rev1.id)
+        pkg = Session.query(Package).filter_by(name=u'view0').one()
+        with vdm.sqlalchemy.RevisionView(Session, rev1) as view:
+            pkgrev = view.get(Package, pkg.id)
+            assert pkgrev.title is None
+            assert pkg.get_as_of() is pkgrev
+            assert view.find(Package)[0] in view.get_many(Package,
+                    [ p.id for p in Session.query(Package) ]).values()
+            lic = pkgrev.license
+            assert lic is view.get(License, lic.id)
+            assert view.get(Package, u'missing') is None
+        Session.remove()
+
+    def test_read_only(self):
+        rev1 = Session.query(Revision).get(self.rev1.id)
+        with vdm.sqlalchemy.RevisionView(Session, rev1) as view:
+            pkg = Session.query(Package).filter_by(name=u'view0').one()
+            pkg.title = u'changed'
+            try:
+                Session.flush()
+            except ValueError:
+                pass
+            else:
+                assert 0, 'should raise'
+        Session.remove()
+
+
+class Test_19_AsOfCache:
+    '''get_as_of results are cached per session.'''
+
+    @classmethod
+    def setup_class(self):
+        Session.remove()
+        repo.rebuild_db()
+        self.rev1 = repo.new_revision()
+        for ii in range(3):
+            Session.add(Package(name=u'cache%s' % ii, title=u'1'))
+        repo.commit()
+        self.rev2 = repo.new_revision()
+        for pkg in Session.query(Package):
+            pkg.title = u'2'
+        repo.commit_and_remove()
+
+    @classmethod
+    def teardown_class(self):
+        Session.remove()
+        repo.rebuild_db()
+
+    def _cache(self):
+        return vdm.sqlalchemy.SQLAlchemySession.as_of_cache(Session)
+
+    def test_get_as_of(self):
+        rev1 = Session.query(Revision).get(self.rev1.id)
+        pkg = Session.query(Package).filter_by(name=u'cache0').one()
+        cache = self._cache()
+        first = pkg.get_as_of(rev1)
+        assert first.title == u'1'
+        assert cache.as_dict() == {'hits': 0, 'misses': 1, 'size': 1}, \
+                cache.as_dict()
+        assert pkg.get_as_of(rev1) is first
+        assert pkg.get_as_of() is first
+        assert cache.hits == 2
+        Session.remove()
+        # new session, new cache
+        assert self._cache().as_dict() == {'hits': 0, 'misses': 0, 'size': 0}
+
+    def test_get_many_as_of(self):
+        rev1 = Session.query(Revision).get(self.rev1.id)
+        pkgs = Session.query(Package).all()
+        out = Package.get_many_as_of(pkgs, rev1)
+        cache = self._cache()
+        assert len(cache) == 3
+        for pkg in pkgs:
+            assert pkg.get_as_of(rev1) is out[pkg.id]
+        assert cache.hits == 3
+        out = Package.get_many_as_of([ pkg.id for pkg in pkgs ], rev1,
+                session=Session())
+        assert cache.hits == 6
+        Session.remove()
+
+    def test_cleared(self):
+        rev1 = Session.query(Revision).get(self.rev1.id)
+        rev2 = Session.query(Revision).get(self.rev2.id)
+        pkg = Session.query(Package).filter_by(name=u'cache0').one()
+        cache = self._cache()
+        pkg.get_as_of(rev1)
+        assert len(cache) == 1
+        # revision changed
+        assert pkg.get_as_of(rev2).title == u'2'
+        assert len(cache) == 1
+        assert pkg.get_as_of(rev1).title == u'1'
+        assert cache.hits == 0
+        Session.expunge_all()
+        pkg = Session.query(Package).filter_by(name=u'cache0').one()
+        assert pkg.get_as_of(rev1).title == u'1'
+        assert cache.hits == 0
+        Session.remove()
+
+
+class Test_20_HistoryCache:
+    '''Object revisions are cached for all sessions of the process.'''
+
+    @classmethod
+    def setup_class(self):
+        Session.remove()
+        repo.rebuild_db()
+        self.cache = vdm.sqlalchemy.HistoryCache(metadata)
+        self.revision_table = class_mapper(PackageRevision).mapped_table
+        self.rev1 = repo.new_revision()
+        for ii in range(3):
+            Session.add(Package(name=u'hist%s' % ii, title=u'1'))
+        repo.commit()
+        self.rev2 = repo.new_revision()
+        for pkg in Session.query(Package):
+            pkg.title = u'2'
+        repo.commit_and_remove()
+
+    @classmethod
+    def teardown_class(self):
+        self.cache.close()
+        Session.remove()
+        repo.rebuild_db()
+
+    def _package(self, name=u'hist0'):
+        # (with its last revision in the session)
+        self.revisions = Session.query(Revision).all()
+        return Session.query(Package).filter_by(name=name).one()
+
+    def test_1_get_as_of(self):
+        assert vdm.sqlalchemy.HistoryCache.for_metadata(metadata) is \
+                self.cache
+        rev1 = Session.query(Revision).get(self.rev1.id)
+        pkg = self._package()
+        assert pkg.get_as_of(rev1).title == u'1'
+        assert self.cache.misses == 1
+        Session.remove()
+        # another session gets it without a query
+        rev1 = Session.query(Revision).get(self.rev1.id)
+        pkg = self._package()
+        with executed_statements() as statements:
+            pkgrev = pkg.get_as_of(rev1)
+        assert len(statements) == 0, statements
+        assert pkgrev.title == u'1'
+        assert pkgrev.continuity is pkg
+        assert pkgrev.revision.id == rev1.id
+        assert pkgrev in Session
+        assert self.cache.hits == 1
+        Session.remove()
+
+    def test_2_get_many_as_of(self):
+        rev1 = Session.query(Revision).get(self.rev1.id)
+        pkgs = Session.query(Package).all()
+        ids = [ pkg.id for pkg in pkgs ]
+        Package.get_many_as_of(ids, rev1, session=Session())
+        Session.remove()
+        rev1 = Session.query(Revision).get(self.rev1.id)
+        with executed_statements() as statements:
+            out = Package.get_many_as_of(ids, rev1, Session())
+        assert len(statements) == 0, statements
+        assert sorted([ obj.title for obj in out.values() ]) == [u'1'] * 3
+        Session.remove()
+
+    def test_3_snapshot(self):
+        pkg = Session.query(Package).filter_by(name=u'hist0').one()
+        snapshot = self.cache.get_as_of(self.revision_table, pkg.id,
+                self.rev1.id)
+        assert snapshot.title == u'1', snapshot
+        try:
+            snapshot.title = u'x'
+        except AttributeError:
+            pass
+        else:
+            assert False, 'snapshot should be read only'
+        Session.remove()
+
+    def test_4_all_revisions(self):
+        pkg = Session.query(Package).filter_by(name=u'hist1').one()
+        assert [ obj.title for obj in pkg.all_revisions ] == [u'2', u'1']
+        Session.remove()
+        pkg = Session.query(Package).filter_by(name=u'hist1').one()
+        with executed_statements() as statements:
+            revobjs = pkg.all_revisions
+        assert len(statements) == 0, statements
+        assert [ obj.title for obj in revobjs ] == [u'2', u'1']
+        assert [ obj.revision_id for obj in revobjs ] == [self.rev2.id,
+                self.rev1.id]
+        Session.remove()
+
+    def test_5_invalidated_on_write(self):
+        pkg = Session.query(Package).filter_by(name=u'hist1').one()
+        pkg.all_revisions
+        rev1 = Session.query(Revision).get(self.rev1.id)
+        pkg.get_as_of(rev1)
+        Session.remove()
+        repo.new_revision()
+        pkg = Session.query(Package).filter_by(name=u'hist1').one()
+        pkg.title = u'3'
+        Session.flush()
+        assert self.cache.get_all_revisions(self.revision_table, pkg.id) is \
+                self.cache.missing
+        # not cached while the revision is uncommitted
+        assert len(pkg.all_revisions) == 3
+        assert self.cache.get_all_revisions(self.revision_table, pkg.id) is \
+                self.cache.missing
+        repo.commit_and_remove()
+        pkg = Session.query(Package).filter_by(name=u'hist1').one()
+        assert [ obj.title for obj in pkg.all_revisions ] == [u'3', u'2',
+                u'1']
+        Session.remove()
+
+    def test_6_invalidated_by_bulk_update(self):
+        pkg = Session.query(Package).filter_by(name=u'hist2').one()
+        assert len(pkg.all_revisions) == 2
+        Session.remove()
+        repo.new_revision()
+        repo.bulk_update(Package, Package.name == u'hist2', {'title': u'4'})
+        repo.commit_and_remove()
+        pkg = Session.query(Package).filter_by(name=u'hist2').one()
+        assert [ obj.title for obj in pkg.all_revisions ] == [u'4', u'2',
+                u'1']
+        Session.remove()
+
+    def test_7_invalidated_by_purge(self):
+        pkg = Session.query(Package).filter_by(name=u'hist2').one()
+        assert len(pkg.all_revisions) == 3
+        revision_id = pkg.all_revisions[0].revision_id
+        Session.remove()
+        repo.purge_revision(Session.query(Revision).get(revision_id))
+        pkg = Session.query(Package).filter_by(name=u'hist2').one()
+        assert [ obj.title for obj in pkg.all_revisions ] == [u'2', u'1']
+        Session.remove()
+
+    def test_8_eviction(self):
+        max_bytes = self.cache.max_bytes
+        self.cache.clear()
+        self.cache.reset_stats()
+        try:
+            rev1 = Session.query(Revision).get(self.rev1.id)
+            pkg = Session.query(Package).filter_by(name=u'hist0').one()
+            pkg.get_as_of(rev1)
+            self.cache.max_bytes = self.cache.bytes * 2
+            pkgs = Session.query(Package).all()
+            Package.get_many_as_of(pkgs, rev1)
+            assert len(self.cache) == 2
+            assert self.cache.evictions > 0
+            assert self.cache.bytes <= self.cache.max_bytes
+            stats = self.cache.as_dict()
+            assert stats['entries'] == len(self.cache)
+            assert stats['evictions'] == self.cache.evictions
+            assert stats['hit_ratio'] == 0.0, stats
+        finally:
+            self.cache.max_bytes = max_bytes
+            Session.remove()
+
+
+class Test_21_ChangeCounter:
+    '''Changes are published to other processes through counters in the
+    db.'''
+
+    @classmethod
+    def setup_class(self):
+        Session.remove()
+        self.counter = vdm.sqlalchemy.ChangeCounter(metadata, interval=0)
+        self.cache = vdm.sqlalchemy.HistoryCache(metadata)
+        repo.rebuild_db()
+        self.package_revision = class_mapper(PackageRevision).mapped_table
+        self.rev1 = repo.new_revision()
+        Session.add(Package(name=u'changes', title=u'1'))
+        Session.add(License(name=u'changes'))
+        repo.commit()
+        self.rev2 = repo.new_revision()
+        Session.query(Package).one().title = u'2'
+        repo.commit_and_remove()
+
+    @classmethod
+    def teardown_class(self):
+        self.cache.close()
+        self.counter.close()
+        Session.remove()
+        repo.clean_db()
+        metadata.remove(self.counter.table)
+        repo.rebuild_db()
+
+    def _cached(self):
+        # is Package as of rev1 in the cache
+        pkg = Session.query(Package).one()
+        return self.cache.get_as_of(self.package_revision, pkg.id,
+                self.rev1.id) is not self.cache.missing
+
+    def test_1_counters(self):
+        counters = self.counter.counters()
+        assert counters[u'package_revision'] == 2, counters
+        assert counters[u'license_revision'] == 1, counters
+        assert counters[u'package_tag_revision'] == 0, counters
+
+    def test_2_own_changes(self):
+        assert self.counter.poll(force=True) is None
+        rev1 = Session.query(Revision).get(self.rev1.id)
+        Session.query(Package).one().get_as_of(rev1)
+        repo.new_revision()
+        Session.query(License).one().name = u'changed'
+        repo.commit_and_remove()
+        assert self.counter.counters()[u'license_revision'] == 2
+        # already dealt with in this process
+        assert self.counter.poll() == []
+        assert self._cached()
+        Session.remove()
+
+    def test_3_changed_elsewhere(self):
+        assert self._cached()
+        # as done by another process
+        self.counter.increment(engine, [u'package_revision'])
+        assert self.counter.poll() == [self.package_revision]
+        assert not self._cached()
+        Session.remove()
+
+    def test_4_bulk_update(self):
+        before = self.counter.counters()[u'package_revision']
+        repo.new_revision()
+        repo.bulk_update(Package, None, {'title': u'3'})
+        assert self.counter.counters()[u'package_revision'] == before
+        repo.commit_and_remove()
+        assert self.counter.counters()[u'package_revision'] == before + 1
+        assert self.counter.poll() == []
+
+    def test_5_purge(self):
+        before = self.counter.counters()
+        repo.new_revision()
+        Session.query(Package).one().title = u'4'
+        repo.commit_and_remove()
+        rev = Session.query(Revision).order_by(Revision.timestamp.desc()
+                ).first()
+        repo.purge_revision(rev)
+        after = self.counter.counters()
+        assert after[u'revision'] == before[u'revision'] + 1, after
+        assert after[u'package_revision'] == \
+                before[u'package_revision'] + 2, after
+        assert after[u'license_revision'] == before[u'license_revision']
+        assert self.counter.poll() == []
+
+
+class Test_22_RevisionTimeline:
+    '''Revision lookups answered from the in-memory timeline.'''
+
+    @classmethod
+    def setup_class(self):
+        Session.remove()
+        self.timeline = vdm.sqlalchemy.RevisionTimeline(metadata, interval=0)
+        repo.rebuild_db()
+        self.revs = []
+        for ii in range(3):
+            self.revs.append(repo.new_revision())
+            if ii == 0:
+                Session.add(Package(name=u'timeline', title=u'0'))
+            else:
+                Session.query(Package).one().title = u'%s' % ii
+            repo.commit()
+            time.sleep(0.01)
+        Session.remove()
+
+    @classmethod
+    def teardown_class(self):
+        self.timeline.close()
+        Session.remove()
+        repo.rebuild_db()
+
+    def test_1_youngest(self):
+        assert len(self.timeline) == 3
+        assert self.timeline.youngest() == self.revs[2].id
+        assert Revision.youngest(Session).id == self.revs[2].id
+        assert repo.youngest_revision().id == self.revs[2].id
+        Session.remove()
+
+    def test_2_previous(self):
+        assert self.timeline.previous(self.revs[2]) == self.revs[1].id
+        assert self.timeline.previous(self.revs[0]) is None
+        pkg = Session.query(Package).one()
+        rev = Session.query(Revision).get(self.revs[2].id)
+        assert pkg.diff(rev)['title'] == '- 1\n+ 2', pkg.diff(rev)
+        Session.remove()
+
+    def test_3_at(self):
+        from datetime import timedelta
+        rev1 = Session.query(Revision).get(self.revs[1].id)
+        assert Revision.at(Session, rev1.timestamp) is rev1
+        assert Revision.at(Session, rev1.timestamp +
+                timedelta(microseconds=1)) is rev1
+        assert Revision.at(Session, self.revs[0].timestamp -
+                timedelta(seconds=1)) is None
+        pkg = Session.query(Package).one()
+        assert pkg.get_as_of(rev1.timestamp).title == u'1'
+        Session.remove()
+        pkg = Session.query(Package).one()
+        assert pkg.get_as_of(self.revs[0].timestamp -
+                timedelta(seconds=1)) is None
+        Session.remove()
+
+    def test_4_new_revisions(self):
+        rev = repo.new_revision()
+        Session.query(Package).one().title = u'3'
+        repo.commit_and_remove()
+        assert self.timeline.youngest() == rev.id
+        # committed elsewhere
+        from datetime import datetime
+        revision_table = class_mapper(Revision).mapped_table
+        engine.execute(revision_table.insert(), id=u'elsewhere',
+                timestamp=datetime.utcnow(), state=u'active')
+        assert self.timeline.youngest() == u'elsewhere'
+        assert len(self.timeline) == 5
+        engine.execute(revision_table.delete(revision_table.c.id ==
+            u'elsewhere'))
+        self.timeline.expire(reload=True)
+        assert self.timeline.youngest() == rev.id
+
+    def test_5_purge(self):
+        youngest = Session.query(Revision).get(self.timeline.youngest())
+        repo.purge_revision(youngest)
+        assert self.timeline.youngest() == self.revs[2].id
+        assert len(self.timeline) == 3
+
+    def test_6_pending(self):
+        # a revision of the session's transaction is not in the timeline
+        rev = repo.new_revision()
+        Session.query(Package).one().title = u'4'
+        Session.flush()
+        assert self.timeline.pending(Session())
+        assert Revision.youngest(Session) is rev
+        assert repo.youngest_revision() is rev
+        assert Revision.at(Session, rev.timestamp) is rev
+        repo.commit_and_remove()
+        assert self.timeline.youngest() == rev.id
+
+    def test_7_not_active(self):
+        active = self.timeline.youngest()
+        rev = repo.new_revision()
+        rev.state = State.DELETED
+        repo.commit_and_remove()
+        assert self.timeline.youngest() == rev.id
+        assert Revision.youngest(Session).id == rev.id
+        # (active ones only)
+        assert self.timeline.youngest(active_only=True) == active
+        assert repo.youngest_revision().id == active
+        assert Revision.at(Session, rev.timestamp).id == active
+        Session.remove()
+
+    def test_id_array(self):
+        from vdm.sqlalchemy.timeline import IdArray
+        ids = IdArray()
+        uuids = [ vdm.sqlalchemy.base.make_uuid() for ii in range(3) ]
+        for id in uuids:
+            ids.append(id)
+        assert ids.nbytes() == 48
+        ids.insert(1, u'other')
+        assert [ ids[ii] for ii in range(4) ] == [uuids[0], u'other'] + \
+                uuids[1:]
+        assert ids.pop(1) == u'other'
+        assert ids[-1] == uuids[2]
@@ -0,0 +1,111 @@
+'''Revisions numbered and ordered by their seq (see temporal.py).
+
+vdm maps its one Revision class to a single revision table, and the demo one
+(test_demo.py) has no seq, so these build their own metadata, revision table
+and mappers and are run in a python process of their own.
+'''
+import os
+import subprocess
+import sys
+from datetime import datetime
+
+import vdm.sqlalchemy
+
+
+def test_revision_sequence():
+    root = os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    proc = subprocess.Popen([sys.executable, '-m', __name__], cwd=root,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    out = proc.communicate()[0]
+    assert proc.returncode == 0, out
+
+
+## Only run in the process of its own
+
+def _model():
+    '''Map the tables of a new metadata, whose revision table has a seq.'''
+    from sqlalchemy import create_engine, MetaData, Table, Column
+    from sqlalchemy import Integer, UnicodeText
+    from sqlalchemy.orm import scoped_session, sessionmaker, mapper
+
+    engine = create_engine('sqlite:///:memory:',
+            connect_args={'isolation_level': None})
+    metadata = MetaData(bind=engine)
+    revision_table = vdm.sqlalchemy.make_revision_table(metadata,
+            sequence=True)
+    thing_table = Table('thing', metadata,
+            Column('id', Integer, primary_key=True),
+            Column('name', UnicodeText),
+            Column('title', UnicodeText),
+            )
+    vdm.sqlalchemy.make_table_stateful(thing_table)
+    thing_revision_table = vdm.sqlalchemy.make_revisioned_table(thing_table,
+            sequence=True)
+
+    class Thing(vdm.sqlalchemy.RevisionedObjectMixin,
+            vdm.sqlalchemy.StatefulObjectMixin,
+            vdm.sqlalchemy.SQLAlchemyMixin
+            ):
+        def __init__(self, **kwargs):
+            for k,v in kwargs.items():
+                setattr(self, k, v)
+
+    Session = scoped_session(sessionmaker(autoflush=True,
+        expire_on_commit=False, autocommit=False,
+        extension=vdm.sqlalchemy.RevisionerSessionExtension()))
+    Revision = vdm.sqlalchemy.make_Revision(mapper, revision_table)
+    mapper(Thing, thing_table,
+        extension=vdm.sqlalchemy.Revisioner(thing_revision_table)
+        )
+    vdm.sqlalchemy.modify_base_object_mapper(Thing, Revision,
+            vdm.sqlalchemy.State)
+    vdm.sqlalchemy.create_object_version(mapper, Thing, thing_revision_table)
+    repo = vdm.sqlalchemy.Repository(metadata, Session,
+            versioned_objects=[Thing])
+    return repo, Session, Revision, Thing
+
+def _check(repo, Session, Revision, Thing):
+    State = vdm.sqlalchemy.State
+    repo.rebuild_db()
+    # all revisions at the same time so only seq orders them
+    timestamp = datetime(2011, 1, 1)
+    titles = [u's1', u's2', u's3']
+    states = [State.ACTIVE, State.DELETED, State.ACTIVE]
+    ids = []
+    for title, state in zip(titles, states):
+        rev = repo.new_revision()
+        rev.timestamp = timestamp
+        ids.append(rev.id)
+        thing = Session.query(Thing).first()
+        if thing is None:
+            thing = Thing(name=u'seq')
+            Session.add(thing)
+        thing.title = title
+        thing.state = state
+        repo.commit()
+    Session.remove()
+
+    # numbered
+    revs = Session.query(Revision).order_by(Revision.seq).all()
+    assert [ rev.seq for rev in revs ] == [1, 2, 3]
+    assert [ rev.id for rev in revs ] == ids
+    assert repo.youngest_revision().seq == 3
+    thing = Session.query(Thing).one()
+    assert len(thing.all_revisions_unordered) == 3
+    for thingrev in thing.all_revisions_unordered:
+        assert thingrev.revision_seq == thingrev.revision.seq
+
+    # as of
+    for rev, title, state in zip(revs, titles, states):
+        assert thing.get_as_of(rev).title == title
+        assert thing.get_as_of(rev).state == state
+    out = Thing.get_many_as_of([thing], revs[1])
+    assert out[thing.id].title == u's2'
+    assert [ r.title for r in thing.all_revisions ] == [u's3', u's2', u's1']
+    diff = thing.diff(revs[2], revs[0])
+    assert 's3' in diff['title'], diff
+    Session.remove()
+
+if __name__ == '__main__':
+    _check(*_model())
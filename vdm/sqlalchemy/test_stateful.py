@@ -105,7 +105,7 @@ class TestStatefulList:
         # obviously this would't work since it is setting to list object itself
         # self.slist = [1,2,3]
         # in our vdm code does not matter since OurAssociationProxy has a
-        # special __set__ which takes of this (converts to clear() + set)
+        # special __set__ which takes of this (converts to replace())
         self.slist[:] = []
         assert len(self.baselist) == self.startlen_base
         assert len(self.slist) == 0
@@ -133,6 +133,88 @@ class TestStatefulList:
         out = repr(self.slist)
         assert out, out
 
+class Target(list):
+    # (plain lists cannot be weakly referenced)
+    pass
+
+
+class TestActiveIndex:
+
+    def setup(self):
+        self.baselist = [ Stateful(str(ii), state=[ACTIVE, DELETED][ii % 3 == 1])
+                for ii in range(50) ]
+        self.slist = StatefulList(self.baselist, is_active=is_active)
+        self.slist_deleted = StatefulListDeleted(self.baselist,
+                is_active=is_active)
+
+    def setup_method(self, name=''):
+        self.setup()
+
+    def _check(self):
+        active = [ item for item in self.baselist if is_active(item) ]
+        deleted = [ item for item in self.baselist if not is_active(item) ]
+        assert len(self.slist) == len(active)
+        assert len(self.slist_deleted) == len(deleted)
+        for ii in range(len(active)):
+            assert self.slist[ii] is active[ii]
+            assert self.slist[-ii-1] is active[-ii-1]
+        for ii in range(len(deleted)):
+            assert self.slist_deleted[ii] is deleted[ii]
+
+    def test_shared(self):
+        assert self.slist._index is self.slist_deleted._index
+        self._check()
+
+    def test_changes(self):
+        del self.slist[5]
+        self._check()
+        del self.slist_deleted[0]
+        self._check()
+        for ii in range(20):
+            self.slist.append(Stateful('new%s' % ii))
+        self._check()
+        self.slist.insert(3, Stateful('inserted'))
+        self._check()
+        self.slist[:] = list(self.slist)[:10]
+        self._check()
+
+    def test_index_out_of_range(self):
+        try:
+            self.slist[len(self.slist)]
+        except IndexError:
+            pass
+        else:
+            assert False, 'should raise IndexError'
+
+    def test_changed_elsewhere(self):
+        # length changes are noticed
+        self.baselist.append(Stateful('x'))
+        self._check()
+        # state changes need a state_version (or refresh)
+        self.baselist[0].delete()
+        self.slist.refresh()
+        self._check()
+        changes = StateChanges()
+        slist = StatefulList(Target(self.baselist), is_active=is_active,
+                state_version=changes)
+        slist.target[0].undelete()
+        changes.bump()
+        assert slist[0] is self.baselist[0]
+        # changes to other targets are not noticed
+        slist.target[0].delete()
+        changes.bump_target(Target())
+        assert slist[0] is self.baselist[0]
+        changes.bump_target(slist.target)
+        assert slist[0] is self.baselist[2]
+
+    def test_not_indexed(self):
+        slist = StatefulList(self.baselist, is_active=is_active,
+                indexed=False)
+        assert slist._index is None
+        assert len(slist) == len(self.slist)
+        assert slist[-1] is self.slist[-1]
+
+
 class TestStatefulListComplex:
     active = ACTIVE
     deleted = DELETED
@@ -189,6 +271,150 @@ class TestStatefulListComplex:
         assert len(self.slist) == self.startlen
         assert len(self.baselist) == self.startlen_base
 
+    def test_replace(self):
+        unneeded = []
+        self.slist._unneeded_deleter = unneeded.append
+        changed = []
+        self.slist.delete = lambda x: changed.append(x) or x.delete()
+        self.slist.undelete = lambda x: changed.append(x) or x.undelete()
+        self.slist._set_stateful_operators()
+        newsb = Stateful('b')
+        newsd = Stateful('d')
+        self.slist[:] = [newsd, newsb, self.se]
+        # d untouched, b undeleted, a deleted and e added then d and b
+        # swapped for the order asked for
+        sd = self.baselist[1]
+        assert self.baselist == [self.sa, sd, self.sc, self.sb, self.se]
+        assert list(self.slist) == [sd, self.sb, self.se]
+        assert unneeded == [newsd, newsb]
+        assert changed == [self.sa, self.sb, self.se], changed
+
+    def test_replace_order(self):
+        sd = self.baselist[3]
+        self.slist[:] = [sd, self.sa, self.se]
+        assert [ x.name for x in self.slist ] == ['d', 'a', 'e']
+        assert self.slist[0] == sd
+        assert self.slist[-1] == self.se
+        # hidden items stay in place
+        assert self.baselist[1:3] == [self.sb, self.sc]
+        self.slist.replace(['e', 'd'], create=Stateful)
+        assert [ x.name for x in self.slist ] == ['e', 'd']
+
+    def test_replace_with_identifiers(self):
+        self.slist.replace(['d', 'f'], create=Stateful)
+        assert [ x.name for x in self.slist ] == ['d', 'f']
+        assert len(self.baselist) == self.startlen_base + 1
+        assert self.sa.state == self.deleted
+
+
+class TestStatefulSet:
+    active = ACTIVE
+    deleted = DELETED
+
+    def setup(self):
+        self.sb = Stateful('b', state=self.deleted)
+        self.baselist = [
+                Stateful('a'),
+                self.sb,
+                Stateful('c', state=self.deleted),
+                Stateful('d'),
+                ]
+        self.sa = self.baselist[0]
+        self.unneeded = []
+        kwargs = dict(is_active=is_active, identifier=lambda x: x.name,
+                unneeded_deleter=self.unneeded.append)
+        self.sset = StatefulSet(self.baselist, **kwargs)
+        self.sset_deleted = StatefulSetDeleted(self.baselist, **kwargs)
+
+    # py.test
+    def setup_method(self, name=''):
+        self.setup()
+
+    def test_shared(self):
+        assert self.sset._index is self.sset_deleted._index
+
+    def test___contains__(self):
+        assert self.sa in self.sset
+        assert Stateful('a') in self.sset
+        assert self.sb not in self.sset
+        assert self.sb in self.sset_deleted
+        assert self.sset.has_key('d')
+        assert not self.sset.has_key('e')
+
+    def test___len__(self):
+        assert len(self.sset) == 2
+        assert len(self.sset_deleted) == 2
+
+    def test___iter__(self):
+        assert set(self.sset) == set([self.sa, self.baselist[3]])
+
+    def test_add(self):
+        newsb = Stateful('b')
+        self.sset.add(newsb)
+        # existing deleted one undeleted
+        assert self.sb.state == self.active
+        assert self.unneeded == [newsb]
+        self.sset.add(Stateful('e'))
+        assert len(self.baselist) == 5
+        assert len(self.sset) == 4
+        assert len(self.sset_deleted) == 1
+        # already there
+        self.sset.add(self.sa)
+        assert len(self.baselist) == 5
+        assert len(self.sset) == 4
+
+    def test_discard(self):
+        self.sset.discard(Stateful('a'))
+        assert self.sa.state == self.deleted
+        assert len(self.sset) == 1
+        assert len(self.sset_deleted) == 3
+        self.sset.discard(Stateful('x'))
+        try:
+            self.sset.remove(Stateful('x'))
+        except KeyError:
+            pass
+        else:
+            assert False, 'should raise KeyError'
+
+    def test_deleted(self):
+        self.sset_deleted.discard(self.sb)
+        assert self.sb in self.sset
+        self.sset_deleted.add(Stateful('a'))
+        assert self.sa not in self.sset
+        assert len(self.sset) == 2
+
+    def test_replace(self):
+        self.sset.replace([Stateful('b'), Stateful('d'), Stateful('e')])
+        assert set([ x.name for x in self.sset ]) == set(['b', 'd', 'e'])
+        assert self.sa.state == self.deleted
+        assert len(self.baselist) == 5
+        self.sset.clear()
+        assert len(self.sset) == 0
+
+    def test_pop(self):
+        popped = set()
+        for ii in range(2):
+            item = self.sset.pop()
+            assert item.state == self.deleted
+            popped.add(item.name)
+        assert popped == set(['a', 'd'])
+        assert len(self.sset) == 0
+        assert len(self.sset_deleted) == 4
+        try:
+            self.sset.pop()
+        except KeyError:
+            pass
+        else:
+            assert 0, 'should have raised'
+        assert self.sset_deleted.pop().state == self.active
+
+    def test_changed_elsewhere(self):
+        self.baselist.append(Stateful('x'))
+        assert len(self.sset) == 3
+        self.sa.delete()
+        self.sset.refresh()
+        assert len(self.sset) == 2
+
 
 class TestStatefulDict:
     active = ACTIVE
@@ -285,6 +511,26 @@ class TestStatefulDict:
         assert isinstance(out, list)
         assert len(out) == 2
 
+    def test_deleted(self):
+        sdict_deleted = StatefulDictDeleted(self.basedict, is_active=is_active)
+        assert sdict_deleted._index is self.sdict._index
+        assert sorted(sdict_deleted.keys()) == ['b', 'c']
+        del self.sdict['a']
+        assert len(self.sdict) == 1
+        assert len(sdict_deleted) == 3
+        del sdict_deleted['b']
+        assert sorted(self.sdict.keys()) == ['b', 'd']
+        assert self.sdict.show_key('a') is self.sa
+        assert len(self.sdict) == 3
+        assert len(sdict_deleted) == 1
+
+    def test_changed_elsewhere(self):
+        self.basedict['e'] = self.se
+        assert len(self.sdict) == 3
+        self.sa.delete()
+        self.sdict.refresh()
+        assert len(self.sdict) == 2
+
     def values(self):
         out = self.sdict.values()
         assert isinstance(out, list)
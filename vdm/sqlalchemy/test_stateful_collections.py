@@ -18,11 +18,21 @@ package_table = Table('package', metadata,
 
 package_license_table = Table('package_license', metadata,
         Column('id', Integer, primary_key=True),
-        Column('package_id', Integer, ForeignKey('package.id')),
+        Column('package_id', String(100), ForeignKey('package.id')),
         Column('license_id', Integer, ForeignKey('license.id')),
         Column('state', String, default='active'),
         )
 
+package_extra_table = Table('package_extra', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('package_id', String(100), ForeignKey('package.id')),
+        Column('key', String(100)),
+        Column('value', String(100)),
+        Column('state', String, default='active'),
+        # (a state column of another name with other values)
+        Column('status', String, default='live'),
+        )
+
 metadata.create_all(engine)
 
 
@@ -57,6 +67,15 @@ def undelete(st):
 def is_active(st):
     return st.state == 'active'
 
+def is_live(st):
+    return st.status == 'live'
+
+def retire(st):
+    st.status = 'gone'
+
+def revive(st):
+    st.status = 'live'
+
 def _create_pl_by_license(license):
     return PackageLicense(license=license)
 
@@ -91,6 +110,14 @@ class PackageLicense(object):
     # for testing versioned m2m
     def get_as_of(self):
         return self
+class PackageExtra(object):
+    def __init__(self, key=None, value=None, state='active'):
+        self.key = key
+        self.value = value
+        self.state = state
+
+    def get_as_of(self):
+        return self
 
 add_stateful_m2m(Package, PackageLicense,  'licenses', 'license',
         'package_licenses', is_active=is_active, delete=delete,
@@ -99,11 +126,36 @@ from base import add_stateful_versioned_m2m
 add_stateful_versioned_m2m(Package, PackageLicense,  'licenses3', 'license',
         'package_licenses', is_active=is_active, delete=delete,
         undelete=undelete)
+add_stateful_m2m(Package, PackageLicense,  'licenses4', 'license',
+        'package_licenses', is_active=is_active, delete=delete,
+        undelete=undelete, collection_type='set')
+add_stateful_versioned_m2m(Package, PackageLicense,  'licenses5', 'license',
+        'package_licenses', is_active=is_active, delete=delete,
+        undelete=undelete, collection_type='set')
+add_stateful_m2m(Package, PackageExtra, 'extras', 'value',
+        'package_extras', is_active=is_active, delete=delete,
+        undelete=undelete, collection_type='dict', key_attr='key')
+add_stateful_versioned_m2m(Package, PackageExtra, 'extras2', 'value',
+        'package_extras', is_active=is_active, delete=delete,
+        undelete=undelete, collection_type='dict', key_attr='key')
+add_stateful_m2m(Package, PackageLicense,  'licenses6', 'license',
+        'package_licenses', is_active=is_active, delete=delete,
+        undelete=undelete, load_active_only=True)
+add_stateful_versioned_m2m(Package, PackageLicense,  'licenses7', 'license',
+        'package_licenses', is_active=is_active, delete=delete,
+        undelete=undelete, collection_type='set', load_active_only=True)
+add_stateful_m2m(Package, PackageExtra, 'extras3', 'value',
+        'package_extras', is_active=is_live, delete=retire,
+        undelete=revive, collection_type='dict', key_attr='key',
+        load_active_only=True, state_column='status', active_state='live')
 
 mapper(Package, package_table, properties={
     'package_licenses':relation(PackageLicense),
+    'package_extras':relation(PackageExtra,
+        collection_class=attribute_mapped_collection('key')),
     })
 mapper(License, license_table)
+mapper(PackageExtra, package_extra_table)
 mapper(PackageLicense, package_license_table, properties={
         'package':relation(Package),
         'license':relation(License),
@@ -245,3 +297,275 @@ class TestSimple:
         p1 = session.query(Package).get('pkg3')
         assert p1.package_licenses[0].package == p1
 
+
+
+class TestStateChangedDirectly(object):
+    # noticed by the (indexed) stateful lists
+
+    def test_1(self):
+        pkg = Package('pkg4')
+        session.add(pkg)
+        for name in ['a', 'b', 'c']:
+            pkg.licenses_active.append(PackageLicense(pkg, License(name)))
+        session.flush()
+        _clear()
+
+        pkg = session.query(Package).get('pkg4')
+        assert pkg.licenses_active._index is not None
+        assert len(pkg.licenses) == 3
+        pkglic = pkg.licenses_active[1]
+        delete(pkglic)
+        assert len(pkg.licenses) == 2
+        assert len(pkg.licenses_deleted) == 1
+        assert pkg.licenses_deleted[0] is pkglic
+        assert pkg.licenses[1].name == 'c'
+        undelete(pkglic)
+        assert pkg.licenses[1].name == 'b'
+        pkg.package_licenses.append(PackageLicense(pkg, License('e')))
+        assert len(pkg.licenses) == 4
+        assert pkg.licenses[-1].name == 'e'
+        session.flush()
+        package_license_table.update(
+                package_license_table.c.id == pkglic.id).execute(
+                state='deleted')
+        session.expire(pkglic)
+        assert len(pkg.licenses) == 3
+        _clear()
+
+    def test_2_only_owner_invalidated(self):
+        for name in ['pkg5', 'pkg6']:
+            pkg = Package(name)
+            session.add(pkg)
+            pkg.licenses_active.append(PackageLicense(pkg, License(name)))
+        session.flush()
+        _clear()
+
+        pkg5 = session.query(Package).get('pkg5')
+        pkg6 = session.query(Package).get('pkg6')
+        changes = pkg5.licenses_active._index.state_version
+        targets = [pkg5.package_licenses, pkg6.package_licenses]
+        before = [ changes(target) for target in targets ]
+        pkglic = pkg5.licenses_active[0]
+        delete(pkglic)
+        assert changes(targets[0]) != before[0]
+        assert changes(targets[1]) == before[1]
+        assert len(pkg5.licenses) == 0
+        assert len(pkg6.licenses) == 1
+        session.flush()
+        before = [ changes(target) for target in targets ]
+        session.expire(pkglic, ['state'])
+        assert changes(targets[0]) != before[0]
+        assert changes(targets[1]) == before[1]
+        assert len(pkg5.licenses) == 0
+        _clear()
+
+    def test_3_without_events(self):
+        # (as with sqlalchemy < 0.7) states may always have changed
+        import stateful
+        event = stateful.event
+        stateful.event = None
+        try:
+            changes = MappedStateChanges(Package, PackageLicense,
+                    'package_licenses')
+            target = []
+            assert changes(target) != changes(target)
+            assert not changes._listening
+        finally:
+            stateful.event = event
+
+
+class TestStatefulSetCollections(object):
+
+    def _test_set(self, name):
+        pkg = Package('pkg-%s' % name)
+        session.add(pkg)
+        names = [ '%s-%s' % (name, x) for x in 'abc' ]
+        lics = [ License(x) for x in names ]
+        setattr(pkg, name, set(lics[:2]))
+        licenses = getattr(pkg, name)
+        assert len(pkg.package_licenses) == 2
+        assert lics[0] in licenses
+        assert lics[2] not in licenses
+        licenses.discard(lics[0])
+        assert lics[0] not in licenses
+        assert len(getattr(pkg, name + '_deleted')) == 1
+        # undeletes the existing PackageLicense
+        licenses.add(lics[0])
+        assert len(pkg.package_licenses) == 2
+        assert len(licenses) == 2
+        licenses.add(lics[2])
+        assert len(pkg.package_licenses) == 3
+        assert set(licenses) == set(lics)
+        session.flush()
+        _clear()
+
+        pkg = session.query(Package).get('pkg-%s' % name)
+        lics = session.query(License).filter(License.name.in_(names)).\
+                order_by(License.name).all()
+        setattr(pkg, name, lics[1:])
+        licenses = getattr(pkg, name)
+        assert len(licenses) == 2
+        assert len(pkg.package_licenses) == 3
+        states = dict([ (pkglic.license.name, pkglic.state) for pkglic in
+            pkg.package_licenses ])
+        assert states[names[0]] == 'deleted', states
+        session.flush()
+        _clear()
+
+    def test_set(self):
+        self._test_set('licenses4')
+
+    def test_versioned_set(self):
+        self._test_set('licenses5')
+
+
+class TestStatefulDictCollections(object):
+
+    def _test_dict(self, name):
+        pkg = Package('pkg-%s' % name)
+        session.add(pkg)
+        setattr(pkg, name, {'a': 'x', 'b': 'y'})
+        extras = getattr(pkg, name)
+        extras_deleted = getattr(pkg, name + '_deleted')
+        assert len(pkg.package_extras) == 2
+        assert extras['a'] == 'x'
+        assert len(extras) == 2
+        del extras['a']
+        assert 'a' not in extras
+        assert len(extras) == 1
+        assert len(extras_deleted) == 1
+        # reuses (and undeletes) the deleted PackageExtra
+        pkgextra = pkg.package_extras['a']
+        extras['a'] = 'z'
+        assert pkg.package_extras['a'] is pkgextra
+        assert pkgextra.value == 'z'
+        assert pkgextra.state == 'active'
+        assert len(extras) == 2
+        assert len(extras_deleted) == 0
+        extras['c'] = 'w'
+        assert len(pkg.package_extras) == 3
+        assert dict(extras.items()) == {'a': 'z', 'b': 'y', 'c': 'w'}
+        session.flush()
+        _clear()
+
+        pkg = session.query(Package).get('pkg-%s' % name)
+        extras = getattr(pkg, name)
+        assert len(extras) == 3
+        setattr(pkg, name, {'b': 'y', 'c': 'v'})
+        assert sorted(extras.keys()) == ['b', 'c']
+        assert extras['c'] == 'v'
+        assert pkg.package_extras['a'].state == 'deleted'
+        assert len(pkg.package_extras) == 3
+        session.flush()
+        _clear()
+
+    def test_dict(self):
+        self._test_dict('extras')
+
+    def test_versioned_dict(self):
+        self._test_dict('extras2')
+
+    def test_assign_active(self):
+        pkg = Package('pkg-assign-active')
+        session.add(pkg)
+        pkg.extras = {'a': 'x', 'b': 'y'}
+        pkgextra = pkg.package_extras['b']
+        pkg.extras_active = {'b': pkgextra}
+        assert pkg.extras.keys() == ['b']
+        assert pkg.extras_active['b'] is pkgextra
+        assert pkg.package_extras['a'].state == 'deleted'
+        session.flush()
+        _clear()
+
+    def test_state_changed_directly(self):
+        pkg = Package('pkg-direct')
+        session.add(pkg)
+        pkg.extras = {'a': 'x', 'b': 'y'}
+        session.flush()
+        delete(pkg.package_extras['a'])
+        assert pkg.extras.keys() == ['b']
+        undelete(pkg.package_extras['a'])
+        assert len(pkg.extras) == 2
+        _clear()
+
+
+class TestLoadActiveOnly(object):
+
+    def _setup(self, name):
+        pkg = Package('pkg-%s' % name)
+        session.add(pkg)
+        lics = [ License('%s-%s' % (name, x)) for x in 'abc' ]
+        for lic in lics:
+            pkg.licenses_active.append(PackageLicense(pkg, lic))
+        del pkg.licenses_active[0]
+        session.flush()
+        _clear()
+        return session.query(Package).get('pkg-%s' % name)
+
+    def _loaded(self, pkg, name):
+        from sqlalchemy.orm.attributes import instance_state
+        return name in instance_state(pkg).dict
+
+    def _test_read_and_write(self, name):
+        pkg = self._setup(name)
+        licenses = getattr(pkg, name)
+        assert len(licenses) == 2
+        assert sorted([ lic.name for lic in licenses ]) == \
+            ['%s-b' % name, '%s-c' % name]
+        assert self._loaded(pkg, 'package_licenses_active_rows')
+        assert not self._loaded(pkg, 'package_licenses')
+        # the deleted view needs the deleted ones
+        assert len(getattr(pkg, name + '_deleted')) == 1
+        assert self._loaded(pkg, 'package_licenses')
+        _clear()
+
+        # adding a license with a deleted PackageLicense undeletes it
+        pkg = session.query(Package).get('pkg-%s' % name)
+        active = getattr(pkg, name + '_active')
+        assert len(active) == 2
+        lic = session.query(License).filter_by(name='%s-a' % name).one()
+        if name == 'licenses7':
+            getattr(pkg, name).add(lic)
+        else:
+            getattr(pkg, name).append(lic)
+        assert self._loaded(pkg, 'package_licenses')
+        assert len(pkg.package_licenses) == 3
+        # the collection got before the write now reads the full one
+        assert active.target is pkg.package_licenses
+        assert len(active) == 3
+        assert len(getattr(pkg, name)) == 3
+        session.flush()
+        _clear()
+        pkg = session.query(Package).get('pkg-%s' % name)
+        assert len(getattr(pkg, name)) == 3
+        assert not self._loaded(pkg, 'package_licenses')
+        _clear()
+
+    def test_0_relations_added_with_mapper(self):
+        # (not on first use)
+        mapper = class_mapper(Package)
+        assert mapper.has_property('package_licenses_active_rows')
+        assert mapper.has_property('package_extras_active_rows')
+
+    def test_list(self):
+        self._test_read_and_write('licenses6')
+
+    def test_versioned_set(self):
+        self._test_read_and_write('licenses7')
+
+    def test_state_column(self):
+        pkg = Package('pkg-status')
+        session.add(pkg)
+        pkg.extras3 = {'a': 'x', 'b': 'y'}
+        del pkg.extras3['a']
+        session.flush()
+        _clear()
+        pkg = session.query(Package).get('pkg-status')
+        assert pkg.extras3.keys() == ['b']
+        assert self._loaded(pkg, 'package_extras_active_rows')
+        assert not self._loaded(pkg, 'package_extras')
+        pkg.extras3['a'] = 'z'
+        assert self._loaded(pkg, 'package_extras')
+        assert sorted(pkg.extras3.keys()) == ['a', 'b']
+        session.flush()
+        _clear()
@@ -0,0 +1,380 @@
+'''In-memory index of the revisions in revision order.
+
+Finding the youngest revision, the revision before another one (as `diff`
+does) or the revision current at some time each take an ordered query on the
+revision table. A `RevisionTimeline` keeps the ordering keys (seq or
+timestamp, see `temporal.revision_key`), timestamps and ids of all revisions
+in sorted arrays (and the ids of those not active in a set) and answers these
+by binary search::
+
+    timeline = RevisionTimeline(metadata)
+    timeline.youngest() # id of the youngest revision
+    timeline.youngest(active_only=True) # id of the youngest active one
+    timeline.previous(revision) # id of the one before revision
+    timeline.at(datetime(2011, 10, 1)) # id of the active one current then
+
+`Revision.youngest`, `Revision.at`, `Repository.youngest_revision`, `diff`
+and `get_as_of` (which also accepts a datetime) use the timeline for their
+metadata when there is one, unless the session has new revisions not yet
+committed (which the timeline cannot know about, see `pending`).
+
+The arrays take about 32 bytes per revision (ids are packed into 16 bytes
+when they are uuids as made by vdm) so a few million revisions fit in tens of
+MB. They are refreshed before lookups at most every `interval` seconds by
+reading the revisions from the last `overlap` revisions known on (an indexed
+range query when revisions have a seq) and straight away after this process
+commits a new revision. Revisions purged by `Repository.purge_revision` are
+dropped, in other processes too if a ChangeCounter (see changes.py) is used.
+
+NB: a revision committed by another process with a key before those of the
+last `overlap` revisions known (i.e. after that many others which started
+later) is only seen after `reload`.
+'''
+from __future__ import with_statement
+from array import array
+from bisect import bisect_left, bisect_right
+import calendar
+from datetime import datetime
+import threading
+import time
+import uuid
+
+from sqlalchemy import select
+from sqlalchemy.orm import object_mapper
+
+from base import State
+from changes import ChangeCounter
+from temporal import revision_key
+
+
+def to_seconds(when):
+    '''Convert (naive UTC) datetime `when` to seconds since the epoch.'''
+    return calendar.timegm(when.utctimetuple()) + when.microsecond / 1e6
+
+
+class IdArray(object):
+    '''Sequence of revision ids stored as 16 bytes each while they are all
+    uuids (in their usual string form) and as a list otherwise.'''
+
+    def __init__(self):
+        self._packed = bytearray()
+        self._list = None
+
+    def __len__(self):
+        if self._list is not None:
+            return len(self._list)
+        return len(self._packed) // 16
+
+    def __getitem__(self, index):
+        if self._list is not None:
+            return self._list[index]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return unicode(uuid.UUID(bytes=str(
+            self._packed[index*16:(index+1)*16])))
+
+    def _pack(self, id):
+        # 16 bytes for id or None if it cannot be packed
+        try:
+            packed = uuid.UUID(id)
+        except (ValueError, TypeError, AttributeError):
+            return None
+        if unicode(packed) != id:
+            return None
+        return packed.bytes
+
+    def _unpack_all(self):
+        self._list = [ self[index] for index in range(len(self)) ]
+        self._packed = None
+
+    def insert(self, index, id):
+        if self._list is None:
+            packed = self._pack(id)
+            if packed is not None:
+                self._packed[index*16:index*16] = packed
+                return
+            self._unpack_all()
+        self._list.insert(index, id)
+
+    def append(self, id):
+        self.insert(len(self), id)
+
+    def pop(self, index):
+        id = self[index]
+        if self._list is not None:
+            del self._list[index]
+        else:
+            del self._packed[index*16:(index+1)*16]
+        return id
+
+    def nbytes(self):
+        if self._list is not None:
+            return sum([ 40 + len(id) for id in self._list ])
+        return len(self._packed)
+
+
+class RevisionTimeline(object):
+    '''Sorted arrays of the revisions (see module docs).
+
+    There is one timeline per metadata (i.e. per vdm database).
+    '''
+    # metadata:timeline
+    _registry = {}
+    # on sessions: set of timelines with revisions added in the current
+    # transaction
+    session_attr = '_vdm_new_revisions'
+
+    def __init__(self, metadata, bind=None, interval=1.0, overlap=100):
+        '''
+        @param bind: engine to read revisions with (defaults to the one
+            bound to metadata).
+        @param interval: minimum number of seconds between refreshes.
+        @param overlap: number of the latest revisions known read again on
+            refresh to pick up revisions committed late.
+        '''
+        self.metadata = metadata
+        self.revision_table = metadata.tables['revision']
+        self.key = revision_key(self.revision_table)
+        self._bind = bind
+        self.interval = interval
+        self.overlap = overlap
+        self._lock = threading.RLock()
+        self._clear()
+        # time of the last refresh (0 when due) and whether it must reload
+        # everything
+        self._refreshed = 0
+        self._stale = True
+        self._registry[metadata] = self
+
+    @property
+    def bind(self):
+        return self._bind or self.metadata.bind
+
+    @classmethod
+    def for_metadata(self, metadata):
+        '''Get the timeline used for `metadata` (None if none).'''
+        return self._registry.get(metadata)
+
+    @classmethod
+    def for_table(self, table):
+        '''Get the timeline used for `table`'s metadata (None if none).'''
+        return self._registry.get(table.metadata)
+
+    def close(self):
+        '''Stop using this timeline.'''
+        self._clear()
+        if self._registry.get(self.metadata) is self:
+            del self._registry[self.metadata]
+
+    def _clear(self):
+        if self.key == 'seq':
+            self._keys = array('l')
+            # running maximum of the timestamps (equal to the keys when
+            # revisions are ordered by timestamp)
+            self._max_times = array('d')
+        else:
+            self._keys = array('d')
+            self._max_times = self._keys
+        self._ids = IdArray()
+        # ids of the revisions not active
+        self._inactive = set()
+
+    def __len__(self):
+        with self._lock:
+            self._refresh_if_due()
+            return len(self._keys)
+
+    def nbytes(self):
+        '''Memory used by the arrays in bytes.'''
+        size = self._keys.itemsize * len(self._keys) + self._ids.nbytes()
+        if self._max_times is not self._keys:
+            size += self._max_times.itemsize * len(self._max_times)
+        return size
+
+    def expire(self, reload=False):
+        '''Refresh on the next lookup (reading all revisions again if
+        `reload`).'''
+        with self._lock:
+            self._refreshed = 0
+            if reload:
+                self._stale = True
+
+    def pending(self, session):
+        '''Whether `session` has new revisions not yet committed (and so not
+        in the timeline).'''
+        if self in getattr(session, self.session_attr, ()):
+            return True
+        for obj in session.new:
+            if object_mapper(obj).mapped_table is self.revision_table:
+                return True
+        return False
+
+    def youngest(self, active_only=False):
+        '''Get the id of the youngest (active) revision (None if none).'''
+        with self._lock:
+            self._refresh_if_due()
+            return self._active_from(len(self._keys) - 1, active_only)
+
+    def _active_from(self, index, active_only=True):
+        # id at index or (if active_only) of the first active one before
+        while index >= 0:
+            id = self._ids[index]
+            if not active_only or id not in self._inactive:
+                return id
+            index -= 1
+        return None
+
+    def previous(self, revision):
+        '''Get the id of the revision just before `revision` (None if
+        none).'''
+        key = self._key(getattr(revision, self.key))
+        with self._lock:
+            self._refresh_if_due()
+            index = bisect_left(self._keys, key)
+            return self._active_from(index - 1, active_only=False)
+
+    def at(self, when):
+        '''Get the id of the active revision current at (naive UTC) datetime
+        `when` i.e. the last with a timestamp no later (None if none).'''
+        seconds = to_seconds(when)
+        with self._lock:
+            self._refresh_if_due()
+            index = bisect_right(self._max_times, seconds)
+            return self._active_from(index - 1)
+
+    def _key(self, value):
+        if self.key == 'seq':
+            return value
+        return to_seconds(value)
+
+    def _refresh_if_due(self):
+        if time.time() - self._refreshed >= self.interval:
+            self.refresh()
+
+    def refresh(self, connection=None):
+        '''Read revisions added (or all revisions if expired with reload)
+        since the last refresh.'''
+        counter = ChangeCounter.for_metadata(self.metadata)
+        if counter is not None:
+            # may expire us
+            counter.poll()
+        with self._lock:
+            self._refreshed = time.time()
+            if self._stale:
+                self.reload(connection)
+                return
+            t = self.revision_table
+            column = t.c[self.key]
+            start = max(0, len(self._keys) - self.overlap)
+            # (labelled as the key column may be the timestamp)
+            query = select([column.label('key'), t.c.timestamp, t.c.id,
+                t.c.state]).order_by(column)
+            if self._keys:
+                since = self._keys[start]
+                if self.key != 'seq':
+                    # (allowing for rounding)
+                    since = datetime.utcfromtimestamp(since - 0.001)
+                query = query.where(column >= since)
+            known = set([ self._ids[index] for index in range(start,
+                len(self._ids)) ])
+            for key, timestamp, id, state in (connection or
+                    self.bind).execute(query):
+                if id not in known and key is not None:
+                    self._insert(self._key(key), to_seconds(timestamp), id)
+                    if state != State.ACTIVE:
+                        self._inactive.add(id)
+
+    def reload(self, connection=None):
+        '''Read all the revisions again.'''
+        t = self.revision_table
+        column = t.c[self.key]
+        query = select([column.label('key'), t.c.timestamp, t.c.id,
+            t.c.state]).order_by(column)
+        with self._lock:
+            self._clear()
+            max_time = float('-inf')
+            for key, timestamp, id, state in (connection or
+                    self.bind).execute(query):
+                if key is None:
+                    continue
+                if state != State.ACTIVE:
+                    self._inactive.add(id)
+                self._keys.append(self._key(key))
+                if self._max_times is not self._keys:
+                    max_time = max(max_time, to_seconds(timestamp))
+                    self._max_times.append(max_time)
+                self._ids.append(id)
+            self._stale = False
+            self._refreshed = time.time()
+
+    def _insert(self, key, seconds, id):
+        index = bisect_right(self._keys, key)
+        self._keys.insert(index, key)
+        self._ids.insert(index, id)
+        if self._max_times is not self._keys:
+            self._max_times.insert(index, seconds)
+            self._update_max_times(index)
+
+    def _update_max_times(self, index):
+        # restore the running maximum from index on
+        times = self._max_times
+        current = index and times[index-1] or float('-inf')
+        for index in range(index, len(times)):
+            if times[index] < current:
+                times[index] = current
+            current = times[index]
+
+    def remove(self, revision_id, key):
+        '''Drop revision `revision_id` (with key (seq or timestamp) `key`).'''
+        key = self._key(key)
+        with self._lock:
+            start = bisect_left(self._keys, key)
+            end = bisect_right(self._keys, key)
+            for index in range(start, end):
+                if self._ids[index] == revision_id:
+                    del self._keys[index]
+                    self._ids.pop(index)
+                    self._inactive.discard(revision_id)
+                    if self._max_times is not self._keys:
+                        # (the running maximum cannot be undone so reload
+                        # if it might have come from this one)
+                        del self._max_times[index]
+                        self._stale = True
+                    return
+
+    @classmethod
+    def record(self, session, revision):
+        '''Note that new `revision` is being written in the transaction of
+        `session` (the timeline is refreshed once it commits).'''
+        timeline = self.for_table(object_mapper(revision).mapped_table)
+        if timeline is None:
+            return
+        timelines = getattr(session, self.session_attr, None)
+        if timelines is None:
+            timelines = set()
+            setattr(session, self.session_attr, timelines)
+        timelines.add(timeline)
+
+    @classmethod
+    def end_transaction(self, session, committed):
+        '''Refresh timelines with revisions added in the transaction of
+        `session` which has just committed (or rolled back).'''
+        timelines = getattr(session, self.session_attr, None)
+        if timelines is None:
+            return
+        delattr(session, self.session_attr)
+        if committed:
+            for timeline in timelines:
+                timeline.expire()
+
+
+def _changed_elsewhere(metadata, tables):
+    # revisions may have been purged
+    timeline = RevisionTimeline.for_metadata(metadata)
+    if timeline is not None and (tables is None or
+            timeline.revision_table in tables):
+        timeline.expire(reload=True)
+
+ChangeCounter.listeners.append(_changed_elsewhere)
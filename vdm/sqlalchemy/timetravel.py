@@ -0,0 +1,268 @@
+'''Read-only views of versioned objects as of a revision ("time travel").
+
+Walking objects at an old revision with `get_as_of` costs a query per object
+and per relation traversed (fake relations on object revisions and versioned
+m2m lists call get_as_of on each related object in turn). A `RevisionView`
+pins a session to one revision and instead loads objects and their relations
+in batches::
+
+    with RevisionView(Session, revision) as view:
+        for pkg in view.find(Package):
+            pkg.license # License as of revision
+            pkg.tags # Tags of Package as of revision
+            ...
+
+When a relation is first traversed on an object from the view it is loaded
+for all objects of that class in the view which have not had it loaded yet
+(one query per `chunk_size` objects, like a "select in" eager load) so
+walking e.g. packages -> license -> tags takes a fixed number of queries
+however many packages there are. Object revisions are kept in the view's
+identity map (one per object) so traversals and `get_as_of` on the pinned
+session return the same instances.
+
+Relations are followed using the foreign keys in the object revisions
+themselves, so e.g. the license of a package as of a revision is the license
+it had then (not its current one). Simple (many to one and one to many)
+relations and stateful m2m attributes (see `add_stateful_m2m`) are
+supported.
+
+While pinned the session is read only: flushing changes raises ValueError
+(needs RevisionerSessionExtension).
+
+NB: object revisions still in a history outbox are only seen when looking up
+objects by id (not when loading one to many relations).
+'''
+from sqlalchemy.orm import class_mapper
+from sqlalchemy.orm.interfaces import MANYTOONE, ONETOMANY
+from sqlalchemy.orm.properties import RelationshipProperty
+
+from base import SQLAlchemySession
+
+
+class RevisionView(object):
+    '''Read-only view of the versioned domain objects as of one revision
+    (see module docs).'''
+    # see SQLAlchemySession.get_view
+    session_attr = 'revision_view'
+
+    def __init__(self, session, revision, chunk_size=500):
+        '''Pin `session` to `revision` (until `close`).
+
+        @param chunk_size: maximum number of objects loaded per query.
+        '''
+        self.session = SQLAlchemySession.session(session)
+        self.revision = revision
+        self.chunk_size = chunk_size
+        # (class, id):object (revision) or None where class is the continuity
+        # class for versioned objects
+        self._objects = {}
+        # (class, id, name):related object(s)
+        self._related = {}
+        self._previous = (SQLAlchemySession.get_revision(self.session),
+                SQLAlchemySession.at_HEAD(self.session),
+                SQLAlchemySession.getattr(self.session, self.session_attr,
+                    None))
+        SQLAlchemySession.setattr(self.session, 'revision', revision)
+        SQLAlchemySession.set_not_at_HEAD(self.session)
+        SQLAlchemySession.setattr(self.session, self.session_attr, self)
+
+    def pinned(self, session):
+        '''Is `session` (still) at this view's revision.'''
+        revision = SQLAlchemySession.get_revision(session)
+        return not SQLAlchemySession.at_HEAD(session) and \
+                revision is not None and revision.id == self.revision.id
+
+    def close(self):
+        '''Unpin the session (restoring its previous revision).'''
+        if SQLAlchemySession.getattr(self.session, self.session_attr,
+                None) is self:
+            revision, head, view = self._previous
+            SQLAlchemySession.setattr(self.session, 'revision', revision)
+            SQLAlchemySession.setattr(self.session, 'HEAD', head)
+            SQLAlchemySession.setattr(self.session, self.session_attr, view)
+        self._objects = {}
+        self._related = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def find(self, cls, *criterion):
+        '''Get all objects of `cls` (optionally meeting `criterion`, on the
+        columns of its revision class) as of the revision.
+
+        @return: list of object revisions (or objects if `cls` is not
+            versioned).
+        '''
+        if is_revisioned(cls):
+            query = cls.query_as_of(self.session, self.revision)
+        else:
+            query = self.session.query(cls)
+        for clause in criterion:
+            query = query.filter(clause)
+        return self._register(cls, query.all())
+
+    def get(self, cls, id):
+        '''Get object `id` (or continuity object) of `cls` as of the
+        revision (None if it did not exist then).'''
+        return self.get_many(cls, [id]).values()[0]
+
+    def get_many(self, cls, ids):
+        '''Like `get` for many objects at once.
+
+        @param ids: ids (or continuity objects).
+        @return: dict keyed by id.
+        '''
+        keys = [ isinstance(id, cls) and object_id(id) or id for id in ids ]
+        missing = [ id for id, key in zip(ids, keys) if (cls, key) not in
+                self._objects ]
+        if missing:
+            if is_revisioned(cls):
+                found = cls.get_many_as_of(missing, self.revision,
+                        session=self.session, chunk_size=self.chunk_size)
+                self._register(cls, [ obj for obj in found.values() if obj is
+                    not None ])
+            else:
+                column = class_mapper(cls).primary_key[0]
+                self._register(cls, self._query(cls, column.key, missing))
+            for key in keys:
+                self._objects.setdefault((cls, key), None)
+        return dict([ (key, self._objects[(cls, key)]) for key in keys ])
+
+    def related(self, obj, name):
+        '''Get related object(s) `name` of `obj` (an object from this view)
+        as of the revision, loading them for all the similar objects in the
+        view at the same time.'''
+        cls = continuity_class(obj)
+        key = (cls, object_id(obj), name)
+        if key not in self._related:
+            self._register(cls, [obj])
+            self.prefetch(cls, name)
+        return self._related[key]
+
+    def prefetch(self, cls, name):
+        '''Load relation `name` of all objects of `cls` in the view which do
+        not have it loaded yet.'''
+        objs = [ obj for (objcls, id), obj in self._objects.items() if
+                objcls is cls and obj is not None and
+                (cls, id, name) not in self._related ]
+        if not objs:
+            return
+        m2m = stateful_m2m(cls, name)
+        if m2m is None:
+            self._load_relation(cls, objs, name)
+            return
+        basic_m2m_name, attr, which = m2m
+        self.prefetch(cls, basic_m2m_name)
+        joins = dict([ (object_id(obj),
+            self._related[(cls, object_id(obj), basic_m2m_name)]) for obj in
+            objs ])
+        if which == 'deleted':
+            is_wanted = lambda joinobj: not joinobj.is_active()
+        else:
+            is_wanted = lambda joinobj: joinobj.is_active()
+        for id, joinobjs in joins.items():
+            joins[id] = [ joinobj for joinobj in joinobjs if
+                    is_wanted(joinobj) ]
+        if which == 'objects':
+            joincls = class_mapper(cls).get_property(basic_m2m_name).\
+                    mapper.class_
+            self.prefetch(joincls, attr)
+            for id, joinobjs in joins.items():
+                joins[id] = [ self._related[(joincls, object_id(joinobj),
+                    attr)] for joinobj in joinobjs ]
+        for id, related in joins.items():
+            self._related[(cls, id, name)] = related
+
+    def _load_relation(self, cls, objs, name):
+        prop = class_mapper(cls).get_property(name)
+        if not isinstance(prop, RelationshipProperty) or \
+                prop.secondary is not None or \
+                len(prop.local_remote_pairs) != 1:
+            raise ValueError('Cannot load %s.%s as of a revision' % (
+                cls.__name__, name))
+        (local, remote), = prop.local_remote_pairs
+        target = prop.mapper.class_
+        if prop.direction is MANYTOONE:
+            values = dict([ (object_id(obj), getattr(obj, local.key)) for obj
+                in objs ])
+            wanted = set(values.values())
+            wanted.discard(None)
+            if remote.primary_key:
+                found = self.get_many(target, list(wanted))
+            else:
+                found = dict([ (getattr(relobj, remote.key), relobj) for
+                    relobj in self._register(target,
+                        self._query(target, remote.key, list(wanted))) ])
+            for id, value in values.items():
+                self._related[(cls, id, name)] = found.get(value)
+        elif prop.direction is ONETOMANY:
+            ids = [ object_id(obj) for obj in objs ]
+            children = {}
+            for child in self._register(target,
+                    self._query(target, remote.key, ids)):
+                children.setdefault(getattr(child, remote.key), []).append(
+                        child)
+            for id in ids:
+                self._related[(cls, id, name)] = children.get(id, [])
+        else:
+            raise ValueError('Cannot load %s.%s as of a revision' % (
+                cls.__name__, name))
+
+    def _query(self, cls, key, values):
+        # objects (revisions) of cls with key in values in chunks
+        results = []
+        for start in range(0, len(values), self.chunk_size):
+            chunk = values[start:start+self.chunk_size]
+            if is_revisioned(cls):
+                revision_table = class_mapper(
+                        cls.__revision_class__).mapped_table
+                query = cls.query_as_of(self.session, self.revision,
+                        revision_table.c[key].in_(chunk))
+            else:
+                query = self.session.query(cls).filter(
+                        getattr(cls, key).in_(chunk))
+            results.extend(query)
+        return results
+
+    def _register(self, cls, objs):
+        # put objs in the identity map (keeping any already there)
+        results = []
+        for obj in objs:
+            key = (cls, object_id(obj))
+            if self._objects.get(key) is None:
+                self._objects[key] = obj
+            results.append(self._objects[key])
+        return results
+
+
+def is_revisioned(cls):
+    return getattr(cls, '__revisioned__', False)
+
+def continuity_class(obj):
+    '''Get the (continuity) class of `obj` (which may be an object
+    revision).'''
+    return getattr(obj, '__continuity_class__', obj.__class__)
+
+def object_id(obj):
+    '''Get the id of (continuity) object `obj` (or of the continuity of
+    object revision `obj`).'''
+    column = class_mapper(continuity_class(obj)).primary_key[0]
+    return getattr(obj, column.key)
+
+def stateful_m2m(cls, name):
+    '''If `name` is a stateful m2m attribute of `cls` (added with
+    `add_stateful_m2m`) get (basic_m2m_name, attr, which) where which is
+    'objects', 'active' or 'deleted'.'''
+    registry = getattr(cls, '__stateful_m2m__', {})
+    for suffix, which in [('', 'objects'), ('_active', 'active'),
+            ('_deleted', 'deleted')]:
+        if suffix and not name.endswith(suffix):
+            continue
+        m2m_property_name = name[:len(name)-len(suffix)]
+        if m2m_property_name in registry:
+            basic_m2m_name, attr = registry[m2m_property_name]
+            return basic_m2m_name, attr, which
+    return None
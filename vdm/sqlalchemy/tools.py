@@ -2,7 +2,12 @@
 
 Primarily organized within a `Repository` object.
 '''
+from __future__ import with_statement
+from contextlib import contextmanager
+
 from sqlalchemy import MetaData
+from sqlalchemy import Integer, Sequence, select, func, and_, or_
+from sqlalchemy import DateTime, literal
 
 import logging
 logger = logging.getLogger('vdm')
@@ -37,9 +42,20 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import ScopedSession
 from sqlalchemy.orm import class_mapper
 from sqlalchemy.orm import object_session
+from sqlalchemy.orm.properties import PropertyLoader
+from sqlalchemy.orm.interfaces import ONETOMANY
 from sqlalchemy import __version__ as sqla_version
 
 from base import SQLAlchemySession, State, Revision
+from sqla import InsertFromSelect
+from outbox import HistoryOutbox
+from history_cache import HistoryCache
+from changes import ChangeCounter
+from timeline import RevisionTimeline
+from group_commit import GroupCommit, GroupCommitAborted, GroupCommitStats
+from temporal import has_intervals, set_interval, refresh_intervals
+from temporal import set_timestamp, set_revision_seq, revision_key
+from temporal import VALID_TO_OPEN
 
 class Repository(object):
     '''Manage repository-wide type changes for versioned domain models.
@@ -47,19 +63,61 @@ class Repository(object):
     For example:
         * creating, cleaning and initializing the repository (DB).
         * purging revisions
+
+    Group commit
+    ------------
+
+    With `group_commit` set (transactional sessions only) `commit` only
+    flushes the revision and its changes and returns a `CommitHandle`. The
+    actual commit of the session's transaction is done for the whole group
+    of pending revisions once `group_commit_size` revisions are pending or
+    the oldest has waited `group_commit_wait` seconds, or when forced by
+    `CommitHandle.wait`, `flush_group_commit` or `commit_and_remove`. If
+    the session's thread does not use the repository in the meantime a
+    timer thread commits the group when the wait is up. It does not do so
+    while a revision is being made (between `new_revision` or
+    `using_revision` and `commit`) and, as it uses the session, the session
+    must not be used otherwise while revisions are pending (call
+    `flush_group_commit` first). Each revision keeps its own
+    Revision row and timestamp. If the group commit fails all its handles
+    get the error. Pending revisions are lost if the session is rolled back
+    or closed (e.g. Session.remove()) in the meantime: their handles then
+    get a `GroupCommitAborted` error (so call `flush_group_commit` first).
+    NB: needs RevisionerSessionExtension to hear of the end of transactions
+    other than through the repository.
+
+    Groups are per session (i.e. per thread with a ScopedSession) as a
+    transaction cannot be shared between sessions: revisions made
+    concurrently by different threads are not grouped, only those made in
+    quick succession by one thread (e.g. a worker importing many changes).
+    Figures on batch sizes and latencies (from `commit` to durable) for all
+    threads are in `group_commit_stats`.
     '''
-    def __init__(self, our_metadata, our_session, versioned_objects=None, dburi=None):
+    def __init__(self, our_metadata, our_session, versioned_objects=None,
+            dburi=None, defer_revision_flush=False, group_commit=False,
+            group_commit_size=100, group_commit_wait=0.05):
         '''
         @param versioned_objects: list of classes of objects which are
         versioned (NB: not the object *versions* but the continuity objects
         themselves). Needed because this will vary from vdm to vdm.
         @param dburi: sqlalchemy dburi. If supplied will create engine and bind
         it to metadata and session.
+        @param defer_revision_flush: default for `new_revision` defer_flush.
+        @param group_commit: commit revisions in groups (see above).
+        @param group_commit_size: maximum number of revisions in a group.
+        @param group_commit_wait: maximum time (in seconds) a revision waits
+            to be committed (longer only if another revision is being made
+            on the session at the time, see above). None for no limit.
         '''
         self.metadata = our_metadata
         self.session = our_session
         self.versioned_objects = versioned_objects
         self.dburi = dburi
+        self.defer_revision_flush = defer_revision_flush
+        self.group_commit = group_commit
+        self.group_commit_size = group_commit_size
+        self.group_commit_wait = group_commit_wait
+        self.group_commit_stats = GroupCommitStats()
         self.have_scoped_session = isinstance(self.session, ScopedSession)
         self.transactional = False 
         if self.have_scoped_session:
@@ -82,6 +140,9 @@ class Repository(object):
     def clean_db(self):
         logger.info('Cleaning DB')
         self.metadata.drop_all(bind=self.metadata.bind)
+        cache = HistoryCache.for_metadata(self.metadata)
+        if cache is not None:
+            cache.clear()
         
     def rebuild_db(self):
         logger.info('Rebuilding DB')
@@ -95,8 +156,13 @@ class Repository(object):
         self.session.remove()
 
     def commit(self):
-        '''Commit/flush (as appropriate) the Sqlalchemy session.'''
+        '''Commit/flush (as appropriate) the Sqlalchemy session.
+
+        @return: a `CommitHandle` in group commit mode.
+        '''
         # TODO: should we do something like set the revision state as well ...
+        if self.group_commit and self.transactional:
+            return self._commit_in_group()
         if self.transactional:
             try:
                 self.session.commit()
@@ -110,25 +176,402 @@ class Repository(object):
     
     def commit_and_remove(self):
         self.commit()
+        self.flush_group_commit()
         self.session.remove()
+
+    def _group(self, create=True):
+        group = SQLAlchemySession.getattr(self.session,
+                GroupCommit.session_attr, None)
+        if group is None and create:
+            group = GroupCommit(self, SQLAlchemySession.session(self.session))
+            SQLAlchemySession.setattr(self.session, GroupCommit.session_attr,
+                    group)
+        return group
+
+    def _commit_in_group(self):
+        group = self._group()
+        revision = SQLAlchemySession.get_revision(self.session)
+        group.flushing = True
+        try:
+            self.session.flush()
+        except Exception, inst:
+            # the flush failure loses the whole transaction
+            group.flushing = False
+            group.fail(inst)
+            self.session.rollback()
+            self.session.remove()
+            raise
+        group.flushing = False
+        return group.add(revision)
+
+    def _begin_revision(self):
+        if self.group_commit:
+            group = self._group(create=False)
+            if group is not None:
+                group.begin_revision()
+
+    def flush_group_commit(self):
+        '''Commit the revisions pending in group commit mode (if any).'''
+        group = self._group(create=False)
+        if group is not None:
+            group.commit()
     
-    def new_revision(self):                                   
+    def new_revision(self, defer_flush=None):
         '''Convenience method to create new revision and set it on session.
         
         NB: if in transactional mode do *not* need to call `begin` as we are
         automatically within a transaction at all times if session was set up
         as transactional (every commit is paired with a begin)
         <http://groups.google.com/group/sqlalchemy/browse_thread/thread/a54ce150b33517db/17587ca675ab3674>
+
+        @param defer_flush: if True the revision is not flushed now but
+            inserted along with the first objects flushed in it (NB: its
+            timestamp is then only set at that point). Defaults to the
+            repository's `defer_revision_flush`.
         '''
+        if defer_flush is None:
+            defer_flush = self.defer_revision_flush
+        self._begin_revision()
         rev = Revision()
         self.session.add(rev)
-        SQLAlchemySession.set_revision(self.session, rev)             
+        SQLAlchemySession.set_revision(self.session, rev,
+                defer_flush=defer_flush)
         return rev
 
+    @contextmanager
+    def using_revision(self, revision=None, defer_flush=None):
+        '''Context manager to make changes in `revision` (a new revision
+        if not supplied) on the current session::
+
+            with repo.using_revision() as rev:
+                ...
+                repo.commit()
+
+        The revision previously set on the session is restored afterwards.
+        '''
+        if defer_flush is None:
+            defer_flush = self.defer_revision_flush
+        if revision is None:
+            revision = Revision()
+        self._begin_revision()
+        with SQLAlchemySession.using_revision(self.session, revision,
+                defer_flush=defer_flush):
+            yield revision
+
+    def bulk_import(self, data, revision=None, chunk_size=1000):
+        '''Import many new versioned objects in one revision without going
+        through the ORM.
+
+        Continuity rows and their object revisions are written directly to
+        the tables in chunks of `chunk_size` rows with one executemany per
+        chunk and table. The resulting history is the same as if the objects
+        had been created through the ORM in `revision`. (NB: objects already
+        in the session are not affected.)
+
+        Column defaults are evaluated here so that continuity and revision
+        rows agree (context sensitive defaults are not supported). Integer
+        primary keys without a value are taken from the key's sequence (or
+        that of its serial column) in one query on PostgreSQL. Elsewhere, and
+        for other kinds of keys, rows without a key are inserted one at a time
+        to find out their key.
+
+        @param data: dict of lists of column value dicts keyed by versioned
+            class e.g. {Package: [{'name': u'abc'}, ...], ...}. Classes are
+            imported in table dependency order.
+        @param revision: revision to import in (defaults to the revision set
+            on the session).
+        @return: dict keyed by class giving list of primary keys (in the
+            order of the supplied rows).
+        '''
+        revision = self._bulk_revision(revision)
+        sorted_tables = self.metadata.sorted_tables
+        classes = sorted(data.keys(),
+                key=lambda cls: sorted_tables.index(
+                    class_mapper(cls).mapped_table))
+        results = {}
+        for cls in classes:
+            rows = data[cls]
+            connection = self.session.connection(mapper=class_mapper(cls))
+            keys = []
+            for start in range(0, len(rows), chunk_size):
+                chunk = rows[start:start+chunk_size]
+                keys.extend(self._bulk_import_chunk(connection, cls, chunk,
+                    revision))
+            results[cls] = keys
+            self._invalidate_history(cls, keys)
+        return results
+
+    def _bulk_revision(self, revision):
+        if revision is None:
+            revision = SQLAlchemySession.get_revision(self.session)
+        assert revision, 'No revision is currently set for this Session'
+        if revision.id is None:
+            SQLAlchemySession.set_revision(self.session, revision)
+        # ensure revision (and any pending changes) are in the db
+        self.session.flush()
+        return revision
+
+    def _invalidate_history(self, cls, continuity_ids=None):
+        # drop cached object revisions of cls (see history_cache.py) now and
+        # again when the session's transaction ends, and in other processes
+        # once it has committed (see changes.py)
+        revision_table = class_mapper(cls.__revision_class__).mapped_table
+        session = SQLAlchemySession.session(self.session)
+        ChangeCounter.record(session, revision_table)
+        cache = HistoryCache.for_table(revision_table)
+        if cache is not None:
+            cache.invalidate(revision_table, continuity_ids, session)
+
+    def bulk_update(self, cls, criterion, values, revision=None):
+        '''Update all objects of versioned class `cls` matching `criterion`
+        in `revision` without loading them.
+
+        Like query(cls).filter(criterion).update(values) but the object
+        revisions are also written (using INSERT ... SELECT from the updated
+        continuity rows). As with changes through the ORM only objects which
+        really change get a new revision. Instances of `cls` in the session
+        are expired.
+
+        @param criterion: sql expression selecting objects (None for all).
+        @param values: dict of new column values keyed by column name.
+        @param revision: revision to make the changes in (defaults to the
+            revision set on the session).
+        @return: number of objects changed.
+        '''
+        revision = self._bulk_revision(revision)
+        self.flush_history()
+        table = class_mapper(cls).mapped_table
+        revision_table = class_mapper(cls.__revision_class__).mapped_table
+        connection = self.session.connection(mapper=class_mapper(cls))
+
+        changed = []
+        for key, value in values.items():
+            col = table.c[key]
+            if value is None:
+                changed.append(col != None)
+            else:
+                changed.append(or_(col != value, col == None))
+        where = or_(*changed)
+        if criterion is not None:
+            where = and_(criterion, where)
+        newvalues = dict(values)
+        newvalues['revision_id'] = revision.id
+        result = connection.execute(table.update(where).values(newvalues))
+        num_changed = result.rowcount
+        self._invalidate_history(cls)
+        logger.debug('bulk_update: %s %s objects' % (cls.__name__,
+            num_changed))
+
+        # (re)write object revisions for everything changed in this revision
+        pkcol = list(table.primary_key.columns)[0]
+        in_revision = table.c.revision_id == revision.id
+        connection.execute(revision_table.delete(and_(
+            revision_table.c.revision_id == revision.id,
+            revision_table.c.continuity_id.in_(
+                select([pkcol], in_revision))
+            )))
+        columns = table.c.keys() + ['continuity_id']
+        selected = list(table.c) + [pkcol.label('continuity_id')]
+        if has_intervals(revision_table):
+            connection.execute(revision_table.update(and_(
+                revision_table.c.valid_to == VALID_TO_OPEN,
+                revision_table.c.continuity_id.in_(
+                    select([pkcol], in_revision))
+                )).values(valid_to=revision.timestamp))
+            columns += ['valid_from', 'valid_to']
+            selected += [
+                literal(revision.timestamp, DateTime).label('valid_from'),
+                literal(VALID_TO_OPEN, DateTime).label('valid_to')]
+        elif 'revision_timestamp' in revision_table.c:
+            columns += ['revision_timestamp']
+            selected += [ literal(revision.timestamp,
+                DateTime).label('revision_timestamp') ]
+        if 'revision_seq' in revision_table.c:
+            columns += ['revision_seq']
+            selected += [ literal(revision.seq,
+                Integer).label('revision_seq') ]
+        query = select(selected, in_revision)
+        connection.execute(InsertFromSelect(revision_table, columns, query))
+        if revision.written_versions is not None:
+            for row in connection.execute(select([pkcol], in_revision)):
+                revision.written_versions.add((revision_table.name, row[0]))
+
+        for obj in self.session:
+            if isinstance(obj, cls):
+                self.session.expire(obj)
+        return num_changed
+
+    def bulk_set_state(self, cls, criterion, state, cascade=False,
+            revision=None):
+        '''Put all objects of stateful versioned class `cls` matching
+        `criterion` into `state` (see `bulk_update`).
+
+        @param cascade: if True also change the state of the stateful
+            versioned objects in one-to-many relations of the objects
+            changed (e.g. the join objects of stateful m2m relations such as
+            PackageTags for Packages). Objects already in `state` are left
+            alone and so are their related objects. When making objects
+            active again only the related objects deleted along with them
+            (in the revision they were deleted in) are, not those deleted
+            before or after.
+        @return: dict giving number of objects changed keyed by class.
+        '''
+        if not getattr(cls, '__stateful__', False):
+            msg = 'Can only change state of stateful objects: %s' % \
+                    cls.__name__
+            raise ValueError(msg)
+        assert state in State.all, state
+        results = {}
+        if cascade:
+            table = class_mapper(cls).mapped_table
+            pkcol = list(table.primary_key.columns)[0]
+            changing = table.c.state != state
+            if criterion is not None:
+                changing = and_(criterion, changing)
+            for prop, remote_col in self._stateful_dependents(cls):
+                related_cls = prop.mapper.class_
+                related = remote_col.table
+                if state == State.ACTIVE:
+                    matched = select([pkcol], and_(changing,
+                        table.c.revision_id == related.c.revision_id)
+                        ).correlate(related)
+                else:
+                    matched = select([pkcol], changing)
+                num = self.bulk_update(related_cls, remote_col.in_(matched),
+                        {'state': state}, revision=revision)
+                results[related_cls] = results.get(related_cls, 0) + num
+        results[cls] = self.bulk_update(cls, criterion, {'state': state},
+                revision=revision)
+        return results
+
+    def _stateful_dependents(self, cls):
+        '''Get one-to-many relations of `cls` to stateful versioned objects.
+
+        @return: list of (relation property, foreign key column on related
+            table).
+        '''
+        out = []
+        for prop in class_mapper(cls).iterate_properties:
+            if not isinstance(prop, PropertyLoader) or \
+                    prop.direction is not ONETOMANY:
+                continue
+            related_cls = prop.mapper.class_
+            if getattr(related_cls, '__stateful__', False) and \
+                    getattr(related_cls, '__revisioned__', False):
+                for local_col, remote_col in prop.local_remote_pairs:
+                    out.append((prop, remote_col))
+        return out
+
+    def bulk_delete(self, cls, criterion, cascade=False, revision=None):
+        '''Delete (i.e. put into deleted state) all objects of stateful
+        versioned class `cls` matching `criterion`.
+
+        See `bulk_set_state`.
+        '''
+        return self.bulk_set_state(cls, criterion, State.DELETED,
+                cascade=cascade, revision=revision)
+
+    def bulk_undelete(self, cls, criterion, cascade=False, revision=None):
+        '''Undelete (i.e. put into active state) all objects of stateful
+        versioned class `cls` matching `criterion`.
+
+        See `bulk_set_state`.
+        '''
+        return self.bulk_set_state(cls, criterion, State.ACTIVE,
+                cascade=cascade, revision=revision)
+
+    def _bulk_import_chunk(self, connection, cls, rows, revision):
+        table = class_mapper(cls).mapped_table
+        revision_table = class_mapper(cls.__revision_class__).mapped_table
+        pkcol = list(table.primary_key.columns)[0]
+        colvalues_list = [ self._bulk_colvalues(connection, table, row,
+            revision) for row in rows ]
+        missing_keys = [ colvalues for colvalues in colvalues_list if
+                colvalues.get(pkcol.key) is None ]
+        if missing_keys:
+            new_keys = self._next_keys(connection, pkcol, len(missing_keys))
+            if new_keys is not None:
+                for colvalues, key in zip(missing_keys, new_keys):
+                    colvalues[pkcol.key] = key
+        with_keys = [ colvalues for colvalues in colvalues_list if
+                colvalues.get(pkcol.key) is not None ]
+        if with_keys:
+            connection.execute(table.insert(), with_keys)
+        for colvalues in colvalues_list:
+            if colvalues.get(pkcol.key) is None:
+                del colvalues[pkcol.key]
+                result = connection.execute(table.insert(), colvalues)
+                colvalues[pkcol.key] = result.inserted_primary_key[0]
+
+        keys = []
+        revision_rows = []
+        for colvalues in colvalues_list:
+            key = colvalues[pkcol.key]
+            keys.append(key)
+            colvalues = dict(colvalues)
+            colvalues['continuity_id'] = key
+            if has_intervals(revision_table):
+                set_interval(colvalues, revision)
+            elif 'revision_timestamp' in revision_table.c:
+                set_timestamp(colvalues, revision)
+            if 'revision_seq' in revision_table.c:
+                set_revision_seq(colvalues, revision)
+            revision_rows.append(colvalues)
+            if revision.written_versions is not None:
+                revision.written_versions.add((revision_table.name, key))
+        connection.execute(revision_table.insert(), revision_rows)
+        return keys
+
+    def _bulk_colvalues(self, connection, table, row, revision):
+        colvalues = {}
+        for col in table.c:
+            if col.key in row:
+                value = row[col.key]
+            elif col.key == 'revision_id':
+                value = revision.id
+            elif col.default is not None and not col.default.is_sequence:
+                if col.default.is_callable:
+                    value = col.default.arg(None)
+                elif col.default.is_clause_element:
+                    value = connection.scalar(select([col.default.arg]))
+                else:
+                    value = col.default.arg
+            else:
+                value = None
+            colvalues[col.key] = value
+        return colvalues
+
+    def _next_keys(self, connection, pkcol, num):
+        '''Get `num` new values for integer primary key `pkcol` from its
+        sequence in one query (PostgreSQL only).
+
+        @return: list of keys or None if not supported or there is no
+            sequence.
+        '''
+        if not isinstance(pkcol.type, Integer) or \
+                connection.dialect.name != 'postgresql':
+            return None
+        preparer = connection.dialect.identifier_preparer
+        if isinstance(pkcol.default, Sequence):
+            seqname = preparer.format_sequence(pkcol.default)
+        else: # serial column
+            seqname = connection.scalar(select([func.pg_get_serial_sequence(
+                preparer.format_table(pkcol.table), pkcol.name)]))
+            if seqname is None:
+                return None
+        nextval = func.nextval(seqname)
+        query = select([nextval]).select_from(func.generate_series(1, num))
+        return [ row[0] for row in connection.execute(query) ]
+
     def youngest_revision(self):
-        '''Get the youngest (most recent) revision.'''
+        '''Get the youngest (most recent) active revision.'''
+        timeline = Revision.timeline(self.session)
+        if timeline is not None:
+            id = timeline.youngest(active_only=True)
+            return id and self.session.query(Revision).get(id)
         q = self.history()
-        q = q.order_by(Revision.timestamp.desc())
+        key = revision_key(class_mapper(Revision).mapped_table)
+        q = q.order_by(getattr(Revision, key).desc())
         return q.first()
         
     def history(self):
@@ -143,6 +586,7 @@ class Repository(object):
 
         @return: dictionary of changed instances keyed by object class.
         '''
+        self.flush_history()
         results = {}
         for o in self.versioned_objects:
             revobj = o.__revision_class__
@@ -150,6 +594,13 @@ class Repository(object):
             results[o] = items
         return results
 
+    def flush_history(self):
+        '''Move any object revisions waiting in the history outbox (see
+        outbox.py) to the revision tables in the session's transaction.'''
+        outbox = HistoryOutbox.for_metadata(self.metadata)
+        if outbox is not None:
+            outbox.flush(self.session)
+
     def purge_revision(self, revision, leave_record=False):
         '''Purge all changes associated with a revision.
 
@@ -171,19 +622,25 @@ class Repository(object):
             (should only be these ...)
         '''
         logger.debug('Purging revision: %s' % revision.id)
+        self.flush_history()
+        revision_table = class_mapper(Revision).mapped_table
+        revision_id = revision.id
+        revision_key_value = getattr(revision, revision_key(revision_table))
         to_purge = []
+        # class:continuity ids with object revisions purged
+        changed = {}
         SQLAlchemySession.setattr(self.session, 'revisioning_disabled', True)
         self.session.autoflush = False
         for o in self.versioned_objects:
             revobj = o.__revision_class__
             items = self.session.query(revobj).filter_by(revision=revision).all()
+            changed[o] = [ item.continuity_id for item in items ]
             for item in items:
                 continuity = item.continuity
 
                 if continuity.revision == revision: # need to change continuity
-                    trevobjs = self.session.query(revobj).join('revision').  filter(
-                            revobj.continuity==continuity
-                            ).order_by(Revision.timestamp.desc()).limit(2).all()
+                    query, order = continuity._history_query(self.session)
+                    trevobjs = query.limit(2).all()
                     if len(trevobjs) == 0:
                         raise Exception('Should have at least one revision.')
                     if len(trevobjs) == 1:
@@ -200,7 +657,25 @@ class Repository(object):
             revision.message = u'PURGED: %s UTC' % datetime.datetime.utcnow()
         else:
             self.session.delete(revision)
+        self.session.flush()
+        session = SQLAlchemySession.session(self.session)
+        for o in self.versioned_objects:
+            if not changed.get(o):
+                continue
+            rev_table = class_mapper(o.__revision_class__).mapped_table
+            if has_intervals(rev_table):
+                refresh_intervals(
+                    self.session.connection(mapper=class_mapper(o)),
+                    rev_table, changed[o])
+            self._invalidate_history(o, changed[o])
+            ChangeCounter.record(session, rev_table)
+        if not leave_record:
+            # (see timeline.py)
+            ChangeCounter.record(session, revision_table)
         self.commit_and_remove()
+        timeline = RevisionTimeline.for_metadata(self.metadata)
+        if timeline is not None and not leave_record:
+            timeline.remove(revision_id, revision_key_value)
 
     def revert(self, continuity, new_correct_revobj):
         '''Revert continuity object back to a particular revision_object.
@@ -217,6 +692,7 @@ class Repository(object):
             # logger.debug('%s::%s' % (key, value))
             # logger.debug('old: %s' % getattr(continuity, key))
             setattr(continuity, key, value)
+        self._invalidate_history(continuity.__class__, [continuity.id])
         logger.debug('revert: end: %s' % continuity)
         logger.debug(object_session(continuity))
         logger.debug(self.session)